@@ -1,3 +1,6 @@
+import contextlib
+import threading
+
 import torch
 import torch.autograd as autograd
 import torch.nn as nn
@@ -6,29 +9,263 @@ import torch.optim as optim
 
 import math
 
-# pure transformer model
-class PositionalEncoding(nn.Module):
-  def __init__(self,dim_model,dropout_p,max_len):
-    super().__init__()
+# autocast dtype of every precision Transformer.set_precision accepts, None runs in fp32
+PRECISIONS = {'fp32': None, 'bf16': torch.bfloat16}
 
-    self.dropout = nn.Dropout(dropout_p)
+# attention implementations of Transformer.set_attention: 'default' runs nn.Transformer's layers
+# (explicit float masks), 'sdpa' routes inference attention through F.scaled_dot_product_attention
+ATTENTION_MODES = ('default', 'sdpa')
+
+# causal masks and sinusoidal tables shared by every model in the process, per device, built on
+# first use (see causal_mask and positional_table)
+_causal_masks = {}
+_positional_tables = {}
+
+# bf16 forwards running in this process (see mha_fastpath_disabled), and the fast path setting
+# to restore once none is left
+_fastpath_lock = threading.Lock()
+_fastpath_users = 0
+_fastpath_restore = True
+
+
+@contextlib.contextmanager
+def mha_fastpath_disabled():
+  # the fused inference fast path of nn.Transformer layers only notices CUDA autocast and would run
+  # (or fail) in fp32 under CPU autocast. The switch is process-wide, so it is off only while a bf16
+  # forward runs (counted across threads); fp32 models elsewhere keep the fast path otherwise.
+  global _fastpath_users,_fastpath_restore
+  with _fastpath_lock:
+    if _fastpath_users == 0:
+      _fastpath_restore = torch.backends.mha.get_fastpath_enabled()
+      torch.backends.mha.set_fastpath_enabled(False)
+    _fastpath_users += 1
+  try:
+    yield
+  finally:
+    with _fastpath_lock:
+      _fastpath_users -= 1
+      if _fastpath_users == 0:
+        torch.backends.mha.set_fastpath_enabled(_fastpath_restore)
 
-    pos_encoding = torch.zeros(max_len,dim_model)
-    positions_list = torch.arange(0, max_len, dtype=torch.float).view(-1, 1) # 0, 1, 2, 3, 4, 5
+
+def causal_mask(size,device=None):
+  """
+  Additive causal mask [size, size] (0 on and below the diagonal, -inf above it), built once per
+  size and device and shared by every caller, so it must not be modified in place
+  """
+  device = torch.device(device or 'cpu')
+  key = (size,device)
+  mask = _causal_masks.get(key)
+  if mask is None:
+    mask = torch.full((size,size),float('-inf')).triu(1).to(device)
+    _causal_masks[key] = mask
+  return mask
+
+
+def positional_table(dim_model,length,device=None):
+  """
+  Sinusoidal positional encodings [>= length, 1, dim_model], shared per dimension and device and
+  grown on demand to the longest length asked for (rows do not depend on the table length)
+  """
+  device = torch.device(device or 'cpu')
+  key = (dim_model,device)
+  table = _positional_tables.get(key)
+  if table is None or table.size(0) < length:
+    # a few rows of headroom so slowly growing lengths do not rebuild the table every call
+    length = max(length,64,2*table.size(0) if table is not None else 0)
+    table = torch.zeros(length,dim_model)
+    positions_list = torch.arange(0, length, dtype=torch.float).view(-1, 1) # 0, 1, 2, 3, 4, 5
     division_term = torch.exp(torch.arange(0, dim_model, 2).float() * (-math.log(10000.0)) / dim_model) # 1000^(2i/dim_model)
 
     # PE(pos, 2i) = sin(pos/1000^(2i/dim_model))
-    pos_encoding[:, 0::2] = torch.sin(positions_list * division_term)
+    table[:, 0::2] = torch.sin(positions_list * division_term)
 
     # PE(pos, 2i + 1) = cos(pos/1000^(2i/dim_model))
-    pos_encoding[:, 1::2] = torch.cos(positions_list * division_term)
+    table[:, 1::2] = torch.cos(positions_list * division_term)
+
+    table = table.unsqueeze(0).transpose(0, 1).to(device)
+    _positional_tables[key] = table
+  return table
 
-    pos_encoding = pos_encoding.unsqueeze(0).transpose(0, 1)
-    self.register_buffer("pos_encoding",pos_encoding)
+
+# pure transformer model
+class PositionalEncoding(nn.Module):
+  def __init__(self,dim_model,dropout_p,max_len=None):
+    # max_len: unused, the shared table grows to the lengths actually used
+    super().__init__()
+
+    self.dropout = nn.Dropout(dropout_p)
+    self.dim_model = dim_model
+
+  def _load_from_state_dict(self,state_dict,prefix,*args,**kwargs):
+    # checkpoints from before the shared table carry a 5000-row pos_encoding buffer, same values
+    state_dict.pop(prefix + "pos_encoding",None)
+    super()._load_from_state_dict(state_dict,prefix,*args,**kwargs)
 
   def forward(self, token_embedding: torch.tensor) -> torch.tensor:
       # Residual connection + pos encoding
-      return self.dropout(token_embedding + self.pos_encoding[:token_embedding.size(0), :])
+      # Note: inputs are batch_first, so dim 0 indexes the batch and every row of a training
+      # batch gets one constant offset. Trained weights depend on this, so it is kept for
+      # training; in eval mode every row gets the offset a batch of one gets, which makes
+      # batched inference give the same results as harmonizing melodies one at a time.
+      rows = token_embedding.size(0) if self.training else 1
+      pos_encoding = positional_table(self.dim_model,rows,token_embedding.device)
+      return self.dropout(token_embedding + pos_encoding[:rows, :])
+
+
+def sdpa_attention(q,k,v,attn_mask=None,key_padding_mask=None,is_causal=False):
+  """
+  Fused attention of q/k/v [batch, heads, length, head_dim] without materializing the weights.
+  attn_mask: additive float mask or bool mask with True marking disallowed positions (the nn
+  convention, SDPA's bool masks mean the opposite); key_padding_mask: [batch, keys], True = padding.
+  is_causal replaces attn_mask by the causal flag.
+  """
+  mask = None
+  if not is_causal and attn_mask is not None:
+    mask = ~attn_mask if attn_mask.dtype == torch.bool else attn_mask
+  if key_padding_mask is not None:
+    keep = ~key_padding_mask[:,None,None,:]
+    if is_causal:
+      # SDPA takes either the flag or a mask
+      mask = causal_mask(q.size(-2),q.device)
+      is_causal = False
+    if mask is None:
+      mask = keep
+    elif mask.dtype == torch.bool:
+      mask = mask & keep
+    else:
+      mask = mask.masked_fill(~keep,float('-inf'))
+  return F.scaled_dot_product_attention(q,k,v,attn_mask=mask,is_causal=is_causal)
+
+
+def _sdpa_multihead(attention,query,memory=None,key_padding_mask=None,is_causal=False):
+  # nn.MultiheadAttention's packed projections around sdpa_attention; self-attention when memory is None
+  batch_size, query_len, embed_dim = query.shape
+  if memory is None:
+    q,k,v = F.linear(query,attention.in_proj_weight,attention.in_proj_bias).chunk(3,dim=-1)
+  else:
+    q = F.linear(query,attention.in_proj_weight[:embed_dim],attention.in_proj_bias[:embed_dim])
+    k,v = F.linear(memory,attention.in_proj_weight[embed_dim:],attention.in_proj_bias[embed_dim:]).chunk(2,dim=-1)
+  heads = attention.num_heads
+  q,k,v = (x.view(batch_size,x.size(1),heads,embed_dim//heads).transpose(1,2) for x in (q,k,v))
+  out = sdpa_attention(q,k,v,key_padding_mask=key_padding_mask,is_causal=is_causal)
+  return attention.out_proj(out.transpose(1,2).reshape(batch_size,query_len,embed_dim))
+
+
+# layers of a pruned transformer: same math and parameter names as nn.Transformer's
+# post-norm layers, but every attention block has its own number of heads
+class HeadAttention(nn.Module):
+  def __init__(self,embed_dim,num_heads,head_dim,dropout_p):
+    super().__init__()
+    self.num_heads = num_heads
+    self.head_dim = head_dim
+
+    self.q_proj = nn.Linear(embed_dim,num_heads*head_dim)
+    self.k_proj = nn.Linear(embed_dim,num_heads*head_dim)
+    self.v_proj = nn.Linear(embed_dim,num_heads*head_dim)
+    self.out_proj = nn.Linear(num_heads*head_dim,embed_dim)
+    self.dropout = nn.Dropout(dropout_p)
+    # set by Transformer.set_attention, used in eval mode only
+    self.fused = False
+
+  def forward(self,query,key,value,attn_mask=None,key_padding_mask=None,is_causal=False):
+    batch_size, query_len, _ = query.shape
+    key_len = key.size(1)
+
+    q = self.q_proj(query).view(batch_size,query_len,self.num_heads,self.head_dim).transpose(1,2)
+    k = self.k_proj(key).view(batch_size,key_len,self.num_heads,self.head_dim).transpose(1,2)
+    v = self.v_proj(value).view(batch_size,key_len,self.num_heads,self.head_dim).transpose(1,2)
+
+    if self.fused and not self.training:
+      out = sdpa_attention(q,k,v,attn_mask,key_padding_mask,is_causal)
+      return self.out_proj(out.transpose(1,2).reshape(batch_size,query_len,self.num_heads*self.head_dim))
+
+    scores = q @ k.transpose(-2,-1) / math.sqrt(self.head_dim)
+    if attn_mask is not None:
+      # float masks are additive (0 / -inf), bool masks mark disallowed positions with True
+      scores = scores.masked_fill(attn_mask,float('-inf')) if attn_mask.dtype == torch.bool else scores + attn_mask
+    if key_padding_mask is not None:
+      scores = scores.masked_fill(key_padding_mask[:,None,None,:],float('-inf'))
+
+    weights = self.dropout(torch.softmax(scores,dim=-1))
+    out = (weights @ v).transpose(1,2).reshape(batch_size,query_len,self.num_heads*self.head_dim)
+
+    return self.out_proj(out)
+
+
+class PrunedEncoderLayer(nn.Module):
+  def __init__(self,d_model,num_heads,head_dim,dim_feedforward,dropout_p):
+    super().__init__()
+    self.self_attn = HeadAttention(d_model,num_heads,head_dim,dropout_p)
+    self.linear1 = nn.Linear(d_model,dim_feedforward)
+    self.linear2 = nn.Linear(dim_feedforward,d_model)
+    self.norm1 = nn.LayerNorm(d_model)
+    self.norm2 = nn.LayerNorm(d_model)
+    self.dropout = nn.Dropout(dropout_p)
+    self.dropout1 = nn.Dropout(dropout_p)
+    self.dropout2 = nn.Dropout(dropout_p)
+
+  def forward(self,src,src_mask=None,src_key_padding_mask=None):
+    x = self.norm1(src + self.dropout1(self.self_attn(src,src,src,src_mask,src_key_padding_mask)))
+    return self.norm2(x + self.dropout2(self.linear2(self.dropout(F.relu(self.linear1(x))))))
+
+
+class PrunedDecoderLayer(nn.Module):
+  def __init__(self,d_model,self_heads,cross_heads,head_dim,dim_feedforward,dropout_p):
+    super().__init__()
+    self.self_attn = HeadAttention(d_model,self_heads,head_dim,dropout_p)
+    self.multihead_attn = HeadAttention(d_model,cross_heads,head_dim,dropout_p)
+    self.linear1 = nn.Linear(d_model,dim_feedforward)
+    self.linear2 = nn.Linear(dim_feedforward,d_model)
+    self.norm1 = nn.LayerNorm(d_model)
+    self.norm2 = nn.LayerNorm(d_model)
+    self.norm3 = nn.LayerNorm(d_model)
+    self.dropout = nn.Dropout(dropout_p)
+    self.dropout1 = nn.Dropout(dropout_p)
+    self.dropout2 = nn.Dropout(dropout_p)
+    self.dropout3 = nn.Dropout(dropout_p)
+
+  def forward(self,tgt,memory,tgt_mask=None,memory_key_padding_mask=None,tgt_is_causal=False):
+    x = self.norm1(tgt + self.dropout1(self.self_attn(tgt,tgt,tgt,tgt_mask,is_causal=bool(tgt_is_causal))))
+    x = self.norm2(x + self.dropout2(self.multihead_attn(x,memory,memory,key_padding_mask=memory_key_padding_mask)))
+    return self.norm3(x + self.dropout3(self.linear2(self.dropout(F.relu(self.linear1(x))))))
+
+
+class PrunedEncoder(nn.Module):
+  def __init__(self,layers,d_model):
+    super().__init__()
+    self.layers = nn.ModuleList(layers)
+    self.norm = nn.LayerNorm(d_model)
+
+  def forward(self,src,mask=None,src_key_padding_mask=None):
+    for layer in self.layers:
+      src = layer(src,mask,src_key_padding_mask)
+    return self.norm(src)
+
+
+class PrunedDecoder(nn.Module):
+  def __init__(self,layers,d_model):
+    super().__init__()
+    self.layers = nn.ModuleList(layers)
+    self.norm = nn.LayerNorm(d_model)
+
+  def forward(self,tgt,memory,tgt_mask=None,memory_key_padding_mask=None,tgt_is_causal=None):
+    # tgt_is_causal: tgt_mask is the causal mask, fused attention then uses the causal flag instead
+    for layer in self.layers:
+      tgt = layer(tgt,memory,tgt_mask,memory_key_padding_mask,tgt_is_causal)
+    return self.norm(tgt)
+
+
+class PrunedTransformer(nn.Module):
+  # drop-in for nn.Transformer built from a per-layer head schema:
+  # layer_heads = {'encoder': [heads per encoder layer], 'decoder_self': [...], 'decoder_cross': [...]}
+  def __init__(self,d_model,layer_heads,head_dim,dim_feedforward,dropout_p):
+    super().__init__()
+    self.encoder = PrunedEncoder(
+      [PrunedEncoderLayer(d_model,heads,head_dim,dim_feedforward,dropout_p) for heads in layer_heads['encoder']],d_model)
+    self.decoder = PrunedDecoder(
+      [PrunedDecoderLayer(d_model,self_heads,cross_heads,head_dim,dim_feedforward,dropout_p)
+       for self_heads,cross_heads in zip(layer_heads['decoder_self'],layer_heads['decoder_cross'])],d_model)
 
 
 class Transformer(nn.Module):
@@ -43,55 +280,142 @@ class Transformer(nn.Module):
       num_encoder_layers,
       num_decoder_layers,
       dropout_p,
-      dim_feedforward
+      dim_feedforward,
+      layer_heads=None
   ):
+    # layer_heads: per-layer head counts of a pruned model (see PrunedTransformer), num_heads
+    # then only sets the head size (input_embedding_dim // num_heads)
 
     super().__init__()
     self.model_type = "Transformer"
     self.kwargs = {'inputVocab':inputVocab,'outputVocab':outputVocab, 'input_embedding_dim': input_embedding_dim, 'output_embedding_dim': output_embedding_dim,'num_heads':num_heads, 'num_encoder_layers': num_encoder_layers,'num_decoder_layers':num_decoder_layers,'dropout_p':dropout_p,'dim_feedforward':dim_feedforward}
+    if layer_heads is not None:
+      self.kwargs['layer_heads'] = layer_heads
     self.input_embedding_dim = input_embedding_dim
     self.output_embedding_dim = output_embedding_dim
 
-    self.input_positional_encoder = PositionalEncoding(dim_model=input_embedding_dim,dropout_p=dropout_p,max_len=5000)
-    self.output_positional_encoder = PositionalEncoding(dim_model=output_embedding_dim,dropout_p=dropout_p,max_len=5000)
+    self.input_positional_encoder = PositionalEncoding(dim_model=input_embedding_dim,dropout_p=dropout_p)
+    self.output_positional_encoder = PositionalEncoding(dim_model=output_embedding_dim,dropout_p=dropout_p)
 
 
 
     self.inputEmbedding = nn.Embedding(inputVocab,input_embedding_dim)
     self.targetEmbedding = nn.Embedding(outputVocab,output_embedding_dim)
 
-    self.transformer = nn.Transformer(
-            d_model=input_embedding_dim,
-            nhead=num_heads,
-            num_encoder_layers=num_encoder_layers,
-            num_decoder_layers=num_decoder_layers,
-            dropout=dropout_p, batch_first=True,
-            dim_feedforward = dim_feedforward
-        )
+    if layer_heads is not None:
+      self.transformer = PrunedTransformer(input_embedding_dim,layer_heads,input_embedding_dim//num_heads,
+                                           dim_feedforward,dropout_p)
+    else:
+      self.transformer = nn.Transformer(
+              d_model=input_embedding_dim,
+              nhead=num_heads,
+              num_encoder_layers=num_encoder_layers,
+              num_decoder_layers=num_decoder_layers,
+              dropout=dropout_p, batch_first=True,
+              dim_feedforward = dim_feedforward
+          )
 
     self.out = nn.Linear(output_embedding_dim,outputVocab)
 
+    # compute precision of encode/decode, weights always stay fp32 (see set_precision)
+    self.precision = 'fp32'
+    # attention implementation in eval mode (see set_attention)
+    self.attention = 'default'
+    # bumped whenever encode() may produce different memory for the same input, so
+    # inference_cache.encoder_cache never serves memory of older weights or settings
+    self.cache_version = 0
+
+  def load_state_dict(self,state_dict,*args,**kwargs):
+    result = super().load_state_dict(state_dict,*args,**kwargs)
+    self.cache_version += 1
+    return result
+
+  def set_precision(self,precision):
+    # 'bf16' runs encode/decode under bfloat16 autocast: matmuls in bf16 against the fp32 (master)
+    # weights, logits returned in fp32. bf16 has fp32's exponent range, so training needs no loss scaling.
+    # Memory cached by inference_cache.encoder_cache before the switch is not reused (cache_version).
+    if precision not in PRECISIONS:
+      raise ValueError(f"unknown precision {precision!r}, expected one of {list(PRECISIONS)}")
+    self.precision = precision
+    self.cache_version += 1
+    return self
+
+  def set_attention(self,attention):
+    # 'sdpa': in eval mode, attention runs through F.scaled_dot_product_attention with the causal
+    # flag instead of an added float mask and without computing attention weights. The decoder
+    # stack of nn.Transformer is then run layer by layer here (same weights and post-norm math,
+    # see _sdpa_decode), pruned layers switch HeadAttention to it. The nn.TransformerEncoder
+    # already uses its native fused kernel in eval mode, with nested tensors for padded batches.
+    # Training is unaffected.
+    if attention not in ATTENTION_MODES:
+      raise ValueError(f"unknown attention {attention!r}, expected one of {list(ATTENTION_MODES)}")
+    self.attention = attention
+    self.cache_version += 1
+    for module in self.modules():
+      if isinstance(module,HeadAttention):
+        module.fused = attention == 'sdpa'
+    return self
+
+  @contextlib.contextmanager
+  def autocast(self,device_type):
+    dtype = PRECISIONS[self.precision]
+    if dtype is None:
+      yield
+      return
+    # traced graphs don't take the fast path, the switch only matters eagerly
+    fastpath = contextlib.nullcontext() if torch.compiler.is_compiling() else mha_fastpath_disabled()
+    with fastpath, torch.autocast(device_type=device_type,dtype=dtype):
+      yield
+
   def forward(self,src,tgt,tgt_mask=None):
        # Src size must be (batch_size, src sequence length)
         # Tgt size must be (batch_size, tgt sequence length)
-        src = self.inputEmbedding(src) * math.sqrt(self.input_embedding_dim)
-        tgt = self.targetEmbedding(tgt) * math.sqrt(self.output_embedding_dim)
+        memory = self.encode(src)
+        out = self.decode(tgt, memory, tgt_mask=tgt_mask)
 
-        src = self.input_positional_encoder(src)
-        tgt = self.output_positional_encoder(tgt)
+        return out
 
-        transformer_out = self.transformer(src, tgt, tgt_mask=tgt_mask)
-        out = self.out(transformer_out)
+  def encode(self,src,src_key_padding_mask=None):
+    # runs only the encoder, output (memory) can be reused for every decoding step
+    # src_key_padding_mask: (batch_size, src sequence length), True marks padded frames
+    with self.autocast(src.device.type):
+      src = self.inputEmbedding(src) * math.sqrt(self.input_embedding_dim)
+      src = self.input_positional_encoder(src)
 
+      return self.transformer.encoder(src, src_key_padding_mask=src_key_padding_mask)
 
-        return out
+  def decode(self,tgt,memory,tgt_mask=None,memory_key_padding_mask=None,tgt_is_causal=None):
+    # runs decoder + output projection against precomputed encoder memory
+    # tgt_is_causal=True vouches that tgt_mask is the causal mask, which skips comparing it
+    # against one on every call (a graph break under torch.compile)
+    fused = self.attention == 'sdpa' and not self.training
+    if fused and tgt_is_causal is None:
+      # the shared causal mask is recognised by identity, without comparing values
+      tgt_is_causal = tgt_mask is causal_mask(tgt.size(1),tgt.device)
+
+    with self.autocast(tgt.device.type):
+      tgt = self.targetEmbedding(tgt) * math.sqrt(self.output_embedding_dim)
+      tgt = self.output_positional_encoder(tgt)
+
+      if fused and tgt_is_causal and isinstance(self.transformer,nn.Transformer):
+        transformer_out = self._sdpa_decode(tgt,memory,memory_key_padding_mask)
+      else:
+        transformer_out = self.transformer.decoder(tgt, memory, tgt_mask=tgt_mask, memory_key_padding_mask=memory_key_padding_mask,
+                                                   tgt_is_causal=tgt_is_causal)
 
+      # sampling and the loss see fp32 logits
+      return self.out(transformer_out).float()
 
-  def get_tgt_mask(self,size):
-    mask = torch.tril(torch.ones(size,size) == 1)
-    mask = mask.float()
 
-    mask = mask.masked_fill(mask == 0, float('-inf'))
-    mask = mask.masked_fill(mask == 1, float(0.0))
+  def _sdpa_decode(self,tgt,memory,memory_key_padding_mask=None):
+    # nn.TransformerDecoder with the layer defaults used here (post-norm, relu), causal self-attention
+    decoder = self.transformer.decoder
+    for layer in decoder.layers:
+      tgt = layer.norm1(tgt + _sdpa_multihead(layer.self_attn,tgt,is_causal=True))
+      tgt = layer.norm2(tgt + _sdpa_multihead(layer.multihead_attn,tgt,memory,memory_key_padding_mask))
+      tgt = layer.norm3(tgt + layer.linear2(F.relu(layer.linear1(tgt))))
+    return decoder.norm(tgt)
 
-    return mask
\ No newline at end of file
+  def get_tgt_mask(self,size,device=None):
+    # shared, cached causal mask on device (see causal_mask), callers must not modify it
+    return causal_mask(size,device)
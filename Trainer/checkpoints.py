@@ -0,0 +1,93 @@
+"""
+Training checkpoints: atomic writes, rotation of the periodic checkpoints and the RNG
+state needed to resume an interrupted run exactly where its last checkpoint left off.
+
+Every checkpoint keeps the inference layout {'model': [kwargs, state_dict, model_type], ...},
+so a periodic or best checkpoint also loads with --model / HARMONY_MODEL_PATH; the training
+state lives under an extra 'trainer' key.
+"""
+import os
+import random
+import re
+import tempfile
+
+import numpy as np
+import torch
+
+CHECKPOINT_NAME = "checkpoint_epoch_{:04d}.pth"
+CHECKPOINT_PATTERN = re.compile(r"^checkpoint_epoch_(\d+)\.pth$")
+BEST_NAME = "best_model.pth"
+
+
+def atomic_save(obj, path):
+    """
+    torch.save through a temporary file in the same directory and a rename, so a crash
+    mid-write leaves the previous file intact instead of a truncated one
+    """
+    directory = os.path.dirname(os.path.abspath(path))
+    os.makedirs(directory, exist_ok=True)
+    handle, tmp_path = tempfile.mkstemp(dir=directory, prefix=".tmp_", suffix=".pth")
+    try:
+        with os.fdopen(handle, "wb") as tmp_file:
+            torch.save(obj, tmp_file)
+            tmp_file.flush()
+            os.fsync(tmp_file.fileno())
+        os.replace(tmp_path, path)
+    except BaseException:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
+
+
+def rng_state():
+    return {
+        'python': random.getstate(),
+        'numpy': np.random.get_state(),
+        'torch': torch.get_rng_state(),
+        'cuda': torch.cuda.get_rng_state_all() if torch.cuda.is_available() else None,
+    }
+
+
+def set_rng_state(state):
+    random.setstate(state['python'])
+    np.random.set_state(state['numpy'])
+    torch.set_rng_state(state['torch'])
+    if state['cuda'] is not None and torch.cuda.is_available():
+        torch.cuda.set_rng_state_all(state['cuda'])
+
+
+class CheckpointManager:
+    """
+    Parameters:
+    - directory: where checkpoint_epoch_NNNN.pth and best_model.pth are written
+    - keep: (int) number of periodic checkpoints kept, older ones are deleted (0 keeps all)
+    """
+
+    def __init__(self, directory, keep=3):
+        self.directory = directory
+        self.keep = keep
+        self.best_path = os.path.join(directory, BEST_NAME)
+
+    def checkpoints(self):
+        """Periodic checkpoint paths, oldest first"""
+        if not os.path.isdir(self.directory):
+            return []
+        epochs = sorted(int(match.group(1)) for match in map(CHECKPOINT_PATTERN.match, os.listdir(self.directory))
+                        if match)
+        return [os.path.join(self.directory, CHECKPOINT_NAME.format(epoch)) for epoch in epochs]
+
+    def latest(self):
+        checkpoints = self.checkpoints()
+        return checkpoints[-1] if checkpoints else None
+
+    def save(self, checkpoint, epoch):
+        path = os.path.join(self.directory, CHECKPOINT_NAME.format(epoch))
+        atomic_save(checkpoint, path)
+        if self.keep:
+            for old_path in self.checkpoints()[:-self.keep]:
+                os.remove(old_path)
+        return path
+
+    def save_best(self, checkpoint):
+        atomic_save(checkpoint, self.best_path)
+        return self.best_path
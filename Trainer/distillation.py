@@ -0,0 +1,210 @@
+import os
+import time
+
+import torch
+import torch.nn.functional as F
+from torch.utils.data import DataLoader
+
+from Trainer.trainer import Trainer
+from Trainer.run_log import grad_norm
+
+
+def compute_teacher_logits(teacher, dataset, device, batch_size=128):
+    """
+    Runs the teacher over every [input frames, output chords] pair with teacher forcing.
+
+    Returns:
+    float16 tensor [len(dataset), target length - 1, chord vocab] of teacher logits
+    """
+    teacher.eval()
+    logits = []
+    with torch.no_grad():
+        for start in range(0, len(dataset), batch_size):
+            batch = dataset[start:start + batch_size]
+            inputs = torch.tensor([inputs for inputs, _ in batch], device=device)
+            targets = torch.tensor([targets for _, targets in batch], device=device)
+
+            target_input = targets[:, :-1]
+            tgt_mask = teacher.get_tgt_mask(target_input.size(1), device)
+            logits.append(teacher(inputs, target_input, tgt_mask).half().cpu())
+    return torch.cat(logits)
+
+
+def load_teacher_logits(cache_path, teacher, teacher_path, dataset, device):
+    """
+    Returns the teacher logits for dataset, computing them only if cache_path is missing
+    or was written for another teacher checkpoint or dataset.
+    """
+    fingerprint = {
+        'teacher': os.path.abspath(teacher_path),
+        'teacher_mtime': os.path.getmtime(teacher_path),
+        'examples': len(dataset),
+        'target_length': len(dataset[0][1]),
+        'vocab': teacher.kwargs['outputVocab'],
+    }
+
+    if os.path.exists(cache_path):
+        cached = torch.load(cache_path)
+        if cached['fingerprint'] == fingerprint:
+            print("Loaded cached teacher logits from", cache_path)
+            return cached['logits']
+
+    print("Computing teacher logits...")
+    logits = compute_teacher_logits(teacher, dataset, device)
+    torch.save({'fingerprint': fingerprint, 'logits': logits}, cache_path)
+    print("Saved teacher logits to", cache_path)
+    return logits
+
+
+def distillation_loss(student_logits, teacher_logits, targets, temperature=2.0, alpha=0.5):
+    """
+    alpha * T^2 * KL(teacher || student) on temperature-softened distributions
+    + (1 - alpha) * cross entropy with the hard labels
+
+    Parameters:
+    - student_logits, teacher_logits: [batch, length, vocab]
+    - targets: [batch, length] expected chord ids
+    - temperature: (float) softening temperature T, T^2 keeps gradient scale comparable
+    - alpha: (float) weight of the soft-target term
+    """
+    vocab = student_logits.size(-1)
+    soft_student = F.log_softmax(student_logits / temperature, dim=-1).reshape(-1, vocab)
+    soft_teacher = F.softmax(teacher_logits.float() / temperature, dim=-1).reshape(-1, vocab)
+    kl = F.kl_div(soft_student, soft_teacher, reduction='batchmean') * temperature ** 2
+
+    hard = F.cross_entropy(student_logits.reshape(-1, vocab), targets.reshape(-1))
+    return alpha * kl + (1 - alpha) * hard
+
+
+class DistillationTrainer(Trainer):
+    """
+    Trains a student model on the cached soft targets of a teacher mixed with the
+    hard labels. Validation uses the regular Trainer test epoch.
+
+    Parameters:
+    - teacher_logits: tensor [len(train dataset), target length - 1, vocab] aligned with the
+        training split (see load_teacher_logits)
+    - temperature, alpha: see distillation_loss
+    - batch_size: (int) batch size of the distillation dataloader
+    """
+
+    def __init__(self, model, optimizer, train_dataloader, test_dataloader, device, scheduler, teacher_logits,
+                 temperature=2.0, alpha=0.5, batch_size=128):
+        super().__init__(model, optimizer=optimizer, loss_fn=torch.nn.CrossEntropyLoss(),
+                         train_dataloader=train_dataloader, test_dataloader=test_dataloader, device=device,
+                         scheduler=scheduler, train_losses=[], test_losses=[])
+        self.temperature = temperature
+        self.alpha = alpha
+
+        dataset = train_dataloader.dataset
+        examples = [(dataset[i][0], dataset[i][1], teacher_logits[i]) for i in range(len(dataset))]
+        self.distillation_dataloader = DataLoader(examples, batch_size=batch_size, shuffle=True,
+                                                  collate_fn=self._collate)
+
+    @staticmethod
+    def _collate(batch):
+        inputs, targets, logits = zip(*batch)
+        return torch.tensor(inputs), torch.tensor(targets), torch.stack(logits)
+
+    def run_epoch(self):
+        self.model.train()
+
+        self.run_log.epoch_begin(self.epoch)
+        for inputs, targets, teacher_logits in self.distillation_dataloader:
+            self.run_log.step_begin(self.global_step + 1)
+
+            inputs = inputs.to(self.device)
+            targets = targets.to(self.device)
+            teacher_logits = teacher_logits.to(self.device)
+
+            target_input = targets[:, :-1]
+            target_expected = targets[:, 1:]
+
+            tgt_mask = self.model.get_tgt_mask(target_input.size(1), self.device)
+
+            output = self.train_model(inputs, target_input, tgt_mask)
+
+            loss = distillation_loss(output, teacher_logits, target_expected, self.temperature, self.alpha)
+            self.run_log.mark('forward')
+
+            self.optimizer.zero_grad()
+            loss.backward()
+            self.run_log.mark('backward')
+
+            norm = grad_norm(self.model.parameters()) if self.run_log.enabled else None
+            self.optimizer.step()
+            self.run_log.mark('optimizer')
+
+            self.after_step(loss, target_expected, norm)
+
+        if self.scheduler is not None:
+            self.scheduler.step()
+
+        self.print("Distillation loss:", loss.item())
+        self.train_losses.append(loss.item())
+        self.end_epoch()
+
+
+def chord_accuracy(model, dataloader, device):
+    """Teacher-forced next-chord accuracy over a whole dataloader"""
+    model.eval()
+    correct = total = 0
+    with torch.no_grad():
+        for inputs, targets in dataloader:
+            inputs = inputs.to(device)
+            targets = targets.to(device)
+
+            target_input = targets[:, :-1]
+            tgt_mask = model.get_tgt_mask(target_input.size(1), device)
+            predicted = torch.argmax(model(inputs, target_input, tgt_mask), dim=-1)
+
+            correct += (predicted == targets[:, 1:]).sum().item()
+            total += targets[:, 1:].numel()
+    return correct / total if total else 0.0
+
+
+def decode_latency_ms(model, dataset, device, start_token, phrases=50):
+    """
+    Median wall time of greedily harmonizing one phrase (batch of one, encoder + one
+    decoder pass per chord), the way the DAW plugin and the server run the model.
+    """
+    model.eval()
+    timings = []
+    with torch.no_grad():
+        for inputs, targets in dataset[:phrases]:
+            src = torch.tensor([inputs], device=device)
+            sequence = torch.full((1, 1), start_token, dtype=torch.long, device=device)
+
+            start = time.perf_counter()
+            memory = model.encode(src)
+            for _ in range(len(targets) - 2):
+                tgt_mask = model.get_tgt_mask(sequence.size(1), device)
+                output = model.decode(sequence, memory, tgt_mask)
+                sequence = torch.cat((sequence, torch.argmax(output[:, -1], dim=-1, keepdim=True)), dim=1)
+            timings.append((time.perf_counter() - start) * 1000)
+
+    timings.sort()
+    return timings[len(timings) // 2]
+
+
+def latency_accuracy_table(models, test_dataloader, device, start_token):
+    """
+    Prints and returns one row per model: parameters, validation chord accuracy and
+    median single-phrase decode latency.
+
+    Parameters:
+    - models: dict of name -> model
+    """
+    rows = []
+    for name, model in models.items():
+        rows.append({
+            'model': name,
+            'parameters': sum(p.numel() for p in model.parameters()),
+            'accuracy': chord_accuracy(model, test_dataloader, device),
+            'latency_ms': decode_latency_ms(model, test_dataloader.dataset, device, start_token),
+        })
+
+    print(f"{'model':<10}{'parameters':>12}{'accuracy':>10}{'latency (ms)':>14}")
+    for row in rows:
+        print(f"{row['model']:<10}{row['parameters']:>12,}{row['accuracy']:>10.3f}{row['latency_ms']:>14.2f}")
+    return rows
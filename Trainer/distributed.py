@@ -0,0 +1,155 @@
+"""
+Data-parallel training over several CPU processes (one machine or several over TCP) with
+torch.distributed's gloo backend and DistributedDataParallel. Every process trains on its
+shard of the training split and gradients are averaged after each backward pass; logging,
+validation and checkpoints happen on rank 0 only.
+
+Launch (the script reads the RANK/WORLD_SIZE/MASTER_ADDR environment, so torchrun works too):
+python3 -m Trainer.distributed --nproc-per-node 4 melody_harmonizer.py --train
+python3 -m Trainer.distributed --nproc-per-node 8 --nnodes 2 --node-rank 0 --master-addr host0 melody_harmonizer.py --train
+"""
+import argparse
+import math
+import os
+import subprocess
+import sys
+import time
+
+import torch
+import torch.distributed as dist
+from torch.nn.parallel import DistributedDataParallel
+from torch.utils.data import DataLoader
+from torch.utils.data.distributed import DistributedSampler
+
+DEFAULT_PORT = 29500
+
+
+class DistributedContext:
+    """
+    Rank and world size of this process, a single process when world_size is 1
+
+    Parameters:
+    - rank: (int) global rank, 0 logs and checkpoints
+    - world_size: (int) number of training processes on all machines
+    - local_world_size: (int) training processes on this machine, they share its cores
+    """
+
+    def __init__(self, rank=0, world_size=1, local_world_size=1):
+        self.rank = rank
+        self.world_size = world_size
+        self.local_world_size = local_world_size
+
+    @property
+    def enabled(self):
+        return self.world_size > 1
+
+    @property
+    def is_main(self):
+        return self.rank == 0
+
+    def wrap(self, model):
+        """DistributedDataParallel around model when distributed, model itself otherwise"""
+        return DistributedDataParallel(model) if self.enabled else model
+
+    def shard(self, dataloader, shuffle=False, seed=0):
+        """
+        Dataloader over this rank's shard of dataloader's dataset. The global batch size stays
+        dataloader.batch_size (split evenly between ranks), so the learning rate needs no change.
+        """
+        if not self.enabled:
+            return dataloader
+        sampler = DistributedSampler(dataloader.dataset, num_replicas=self.world_size, rank=self.rank,
+                                     shuffle=shuffle, seed=seed)
+        return DataLoader(dataloader.dataset, batch_size=math.ceil(dataloader.batch_size / self.world_size),
+                          sampler=sampler, collate_fn=dataloader.collate_fn)
+
+    def any(self, flag):
+        """True on every rank if flag is True on any rank (e.g. rank 0 decided to stop)"""
+        if not self.enabled:
+            return flag
+        value = torch.tensor([int(bool(flag))])
+        dist.all_reduce(value, op=dist.ReduceOp.MAX)
+        return bool(value.item())
+
+    def barrier(self):
+        if self.enabled:
+            dist.barrier()
+
+    def close(self):
+        if self.enabled and dist.is_initialized():
+            dist.destroy_process_group()
+
+
+def init_distributed(backend="gloo"):
+    """
+    Joins the process group described by the launcher's environment (RANK, WORLD_SIZE,
+    MASTER_ADDR, MASTER_PORT) and gives each process its share of this machine's cores.
+
+    Returns:
+    DistributedContext, a single-process one when WORLD_SIZE is not set
+    """
+    world_size = int(os.environ.get("WORLD_SIZE", 1))
+    if world_size <= 1:
+        return DistributedContext()
+
+    rank = int(os.environ["RANK"])
+    local_world_size = int(os.environ.get("LOCAL_WORLD_SIZE", world_size))
+    dist.init_process_group(backend, init_method="env://", rank=rank, world_size=world_size)
+    # intra-op threads of all local processes together should not oversubscribe the cores
+    torch.set_num_threads(max(1, (os.cpu_count() or 1) // local_world_size))
+    return DistributedContext(rank, world_size, local_world_size)
+
+
+def launch(script_args, nproc_per_node, nnodes=1, node_rank=0, master_addr="127.0.0.1", master_port=DEFAULT_PORT):
+    """
+    Starts nproc_per_node copies of a script on this machine as ranks
+    node_rank * nproc_per_node ... and waits for them; if one fails the others are stopped.
+
+    Returns:
+    exit code of the first failing process, 0 if all succeeded
+    """
+    world_size = nproc_per_node * nnodes
+    processes = []
+    for local_rank in range(nproc_per_node):
+        env = dict(os.environ, RANK=str(node_rank * nproc_per_node + local_rank), LOCAL_RANK=str(local_rank),
+                   WORLD_SIZE=str(world_size), LOCAL_WORLD_SIZE=str(nproc_per_node), MASTER_ADDR=master_addr,
+                   MASTER_PORT=str(master_port))
+        processes.append(subprocess.Popen([sys.executable, *script_args], env=env))
+
+    exit_code = 0
+    try:
+        while processes:
+            for process in list(processes):
+                code = process.poll()
+                if code is None:
+                    continue
+                processes.remove(process)
+                if code != 0 and exit_code == 0:
+                    exit_code = code
+                    for other in processes:
+                        other.terminate()
+            time.sleep(0.1)
+    except KeyboardInterrupt:
+        for process in processes:
+            process.terminate()
+        raise
+    return exit_code
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Launch data-parallel training processes (gloo)")
+    parser.add_argument("--nproc-per-node", type=int, default=os.cpu_count() or 1)
+    parser.add_argument("--nnodes", type=int, default=1)
+    parser.add_argument("--node-rank", type=int, default=0)
+    parser.add_argument("--master-addr", default="127.0.0.1", help="address of the node with rank 0")
+    parser.add_argument("--master-port", type=int, default=DEFAULT_PORT)
+    parser.add_argument("script", help="training script, e.g. melody_harmonizer.py")
+    parser.add_argument("script_args", nargs=argparse.REMAINDER)
+    args = parser.parse_args()
+
+    sys.exit(launch([args.script, *args.script_args], args.nproc_per_node, args.nnodes, args.node_rank,
+                    args.master_addr, args.master_port))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,263 @@
+"""
+Training instrumentation: per-step and per-epoch throughput, time split between data loading,
+forward, backward and optimizer, learning rate, grad norm and peak memory, written as one JSON
+object per line. Optionally profiles a window of steps with torch.profiler.
+
+Summarize or compare runs:
+python3 -m Trainer.run_log run.jsonl [other_run.jsonl ...] [--epochs]
+"""
+import argparse
+import json
+import os
+import resource
+import threading
+import time
+
+import torch
+
+PHASES = ('data', 'forward', 'backward', 'optimizer')
+
+
+def peak_memory_mb(device):
+    """Peak CUDA memory allocated on device, or peak resident memory of the process on CPU"""
+    if device.type == 'cuda':
+        return torch.cuda.max_memory_allocated(device) / 2 ** 20
+    # ru_maxrss is in kilobytes on Linux
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 2 ** 10
+
+
+def grad_norm(parameters):
+    """Total L2 norm of the gradients (what clip_grad_norm_ would clip)"""
+    norms = [p.grad.detach().norm(2) for p in parameters if p.grad is not None]
+    return torch.norm(torch.stack(norms), 2).item() if norms else 0.0
+
+
+class RunLog:
+    """
+    Parameters:
+    - path: JSONL file to append records to, None only keeps the epoch summaries
+    - device: training device, phase timings synchronize CUDA when a log file is written
+    - profile_steps: optional (first, last) global steps to record with torch.profiler
+    - profile_dir: where the chrome trace of the profiled window is written
+    """
+
+    def __init__(self, path=None, device=torch.device("cpu"), profile_steps=None, profile_dir=None):
+        self.path = path
+        self.device = device
+        self.enabled = path is not None
+        self.profile_steps = profile_steps
+        self.profile_dir = profile_dir or (os.path.dirname(path) if path else ".")
+        self._lock = threading.Lock()
+        self._file = None
+        if self.enabled:
+            os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+            self._file = open(path, "a")
+        self._profiler = None
+        self._last_mark = time.perf_counter()
+        self._phases = dict.fromkeys(PHASES, 0.0)
+        self._epoch = None
+
+    def write(self, record_type, **fields):
+        if not self.enabled:
+            return
+        record = {'type': record_type, 'time': time.time(), **fields}
+        with self._lock:
+            self._file.write(json.dumps(record) + "\n")
+            self._file.flush()
+
+    def _now(self):
+        if self.enabled and self.device.type == 'cuda':
+            torch.cuda.synchronize(self.device)
+        return time.perf_counter()
+
+    def epoch_begin(self, epoch):
+        if self.device.type == 'cuda':
+            # peak memory of step and epoch records is the peak of the current epoch
+            torch.cuda.reset_peak_memory_stats(self.device)
+        self._epoch = {'epoch': epoch, 'start': time.perf_counter(), 'steps': 0, 'samples': 0, 'tokens': 0,
+                       'loss_sum': 0.0, 'loss_tokens': 0, **{phase: 0.0 for phase in PHASES}}
+        self._last_mark = self._now()
+
+    def step_begin(self, step):
+        """Call once the batch is loaded, before it is moved to the device"""
+        if self.profile_steps and step == self.profile_steps[0] and self._profiler is None:
+            activities = [torch.profiler.ProfilerActivity.CPU]
+            if self.device.type == 'cuda':
+                activities.append(torch.profiler.ProfilerActivity.CUDA)
+            self._profiler = torch.profiler.profile(activities=activities, record_shapes=True, profile_memory=True)
+            self._profiler.__enter__()
+        self._phases = dict.fromkeys(PHASES, 0.0)
+        self.mark('data')
+
+    def mark(self, phase):
+        """Adds the time since the previous mark to phase"""
+        now = self._now()
+        self._phases[phase] += now - self._last_mark
+        self._last_mark = now
+
+    def step_end(self, step, loss, samples, tokens, lr, norm=None):
+        """
+        Records one optimizer step.
+
+        Parameters:
+        - loss: (float) training loss of the batch, None when it is not logged (reading it syncs the device)
+        - samples: (int) phrases in the batch
+        - tokens: (int) chord tokens predicted in the batch
+        - lr: (float) learning rate used for the step
+        - norm: (float) gradient norm before the optimizer step
+        """
+        step_time = sum(self._phases.values())
+        epoch = self._epoch
+        if epoch is not None:
+            epoch['steps'] += 1
+            epoch['samples'] += samples
+            epoch['tokens'] += tokens
+            if loss is not None:
+                epoch['loss_sum'] += loss * tokens
+                epoch['loss_tokens'] += tokens
+            for phase in PHASES:
+                epoch[phase] += self._phases[phase]
+
+        self.write('step', step=step, epoch=epoch['epoch'] if epoch else None, loss=loss, lr=lr, grad_norm=norm,
+                   samples=samples, tokens=tokens, step_time=step_time,
+                   samples_per_sec=samples / step_time if step_time else 0.0,
+                   tokens_per_sec=tokens / step_time if step_time else 0.0,
+                   **{f"{phase}_time": self._phases[phase] for phase in PHASES},
+                   peak_memory_mb=peak_memory_mb(self.device))
+
+        if self._profiler is not None and step >= self.profile_steps[1]:
+            self.stop_profiler(step)
+        self._last_mark = self._now()
+
+    def stop_profiler(self, step=None):
+        """Ends the profiled window early (e.g. training finished inside it)"""
+        if self._profiler is None:
+            return
+        step = self.profile_steps[1] if step is None else step
+        self._profiler.__exit__(None, None, None)
+        os.makedirs(self.profile_dir, exist_ok=True)
+        trace = os.path.join(self.profile_dir, f"trace_steps_{self.profile_steps[0]}-{step}.json")
+        self._profiler.export_chrome_trace(trace)
+        sort_by = "self_cuda_time_total" if self.device.type == 'cuda' else "self_cpu_time_total"
+        top = [{'name': event.key, 'calls': event.count, 'self_cpu_ms': event.self_cpu_time_total / 1000,
+                'cpu_ms': event.cpu_time_total / 1000}
+               for event in sorted(self._profiler.key_averages(), key=lambda event: getattr(event, sort_by),
+                                   reverse=True)[:20]]
+        self.write('profile', first_step=self.profile_steps[0], last_step=step, trace=trace, top_ops=top)
+        print("Profiler trace written to", trace)
+        self._profiler = None
+
+    def epoch_end(self):
+        """
+        Returns:
+        dict summarizing the epoch (also written to the log)
+        """
+        epoch = self._epoch
+        elapsed = time.perf_counter() - epoch['start']
+        summary = {
+            'epoch': epoch['epoch'],
+            'steps': epoch['steps'],
+            'epoch_time': elapsed,
+            'samples_per_sec': epoch['samples'] / elapsed if elapsed else 0.0,
+            'tokens_per_sec': epoch['tokens'] / elapsed if elapsed else 0.0,
+            'mean_loss': epoch['loss_sum'] / epoch['loss_tokens'] if epoch['loss_tokens'] else None,
+            **{f"{phase}_time": epoch[phase] for phase in PHASES},
+            'peak_memory_mb': peak_memory_mb(self.device),
+        }
+        self.write('epoch', **summary)
+        self._epoch = None
+        return summary
+
+    def close(self):
+        self.stop_profiler()
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+            self.enabled = False
+
+
+def read_run(path):
+    with open(path, "r") as log_file:
+        return [json.loads(line) for line in log_file if line.strip()]
+
+
+def summarize_run(records):
+    """
+    Returns:
+    dict of headline numbers of one run log
+    """
+    steps = [record for record in records if record['type'] == 'step']
+    epochs = [record for record in records if record['type'] == 'epoch']
+    validations = [record for record in records if record['type'] == 'validation']
+
+    phase_totals = {phase: sum(record[f"{phase}_time"] for record in steps) for phase in PHASES}
+    step_time = sum(phase_totals.values())
+    samples = sum(record['samples'] for record in steps)
+    tokens = sum(record['tokens'] for record in steps)
+    best = min(validations, key=lambda record: record['loss']) if validations else None
+    grad_norms = [record['grad_norm'] for record in steps if record.get('grad_norm') is not None]
+
+    summary = {
+        'steps': len(steps),
+        'epochs': len(epochs),
+        'train_time_s': sum(record['epoch_time'] for record in epochs) or step_time,
+        'samples_per_sec': samples / step_time if step_time else 0.0,
+        'tokens_per_sec': tokens / step_time if step_time else 0.0,
+        'final_train_loss': epochs[-1]['mean_loss'] if epochs else (steps[-1]['loss'] if steps else None),
+        'best_val_loss': best['loss'] if best else None,
+        'best_val_accuracy': best.get('accuracy') if best else None,
+        'best_val_step': best.get('step') if best else None,
+        'peak_memory_mb': max((record['peak_memory_mb'] for record in steps), default=None),
+        'mean_grad_norm': sum(grad_norms) / len(grad_norms) if grad_norms else None,
+    }
+    for phase in PHASES:
+        summary[f"{phase}_share"] = phase_totals[phase] / step_time if step_time else 0.0
+    return summary
+
+
+def print_comparison(names, summaries):
+    width = max(14, *(len(name) + 2 for name in names))
+    print(f"{'':<20}" + "".join(f"{name:>{width}}" for name in names))
+    for key in summaries[0]:
+        cells = []
+        for summary in summaries:
+            value = summary[key]
+            if value is None:
+                cells.append(f"{'-':>{width}}")
+            elif key.endswith('_share'):
+                cells.append(f"{value:>{width}.1%}")
+            elif isinstance(value, float):
+                cells.append(f"{value:>{width}.4g}")
+            else:
+                cells.append(f"{value:>{width}}")
+        print(f"{key:<20}" + "".join(cells))
+
+
+def print_epochs(name, records):
+    print(f"\n{name}")
+    print(f"{'epoch':>6}{'time (s)':>10}{'samples/s':>11}{'tokens/s':>11}{'loss':>9}"
+          + "".join(f"{phase:>11}" for phase in PHASES))
+    for record in records:
+        if record['type'] != 'epoch':
+            continue
+        print(f"{record['epoch']:>6}{record['epoch_time']:>10.2f}{record['samples_per_sec']:>11.1f}"
+              f"{record['tokens_per_sec']:>11.1f}{record['mean_loss']:>9.4f}"
+              + "".join(f"{record[f'{phase}_time']:>11.2f}" for phase in PHASES))
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Summarize and compare training run logs")
+    parser.add_argument("runs", nargs="+", help="JSONL run logs written by Trainer(run_log=...)")
+    parser.add_argument("--epochs", action="store_true", help="also print one row per epoch of every run")
+    args = parser.parse_args()
+
+    runs = [read_run(path) for path in args.runs]
+    names = [os.path.splitext(os.path.basename(path))[0] for path in args.runs]
+    print_comparison(names, [summarize_run(records) for records in runs])
+    if args.epochs:
+        for name, records in zip(names, runs):
+            print_epochs(name, records)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,390 @@
+"""
+Hyperparameter sweeps over the model/training keys of config.json. Trials run in a process pool,
+each worker pinned to its own share of the cores, and all of them read one memory-mapped copy of
+the encoded dataset. Every finished trial is appended to trials.jsonl; at the end each trial's
+greedy decoding latency is measured (serially, with all cores) and leaderboard.json ranks the
+trials by validation loss, marking the ones on the loss/latency Pareto front.
+
+Search space: the "sweep" section of config.json (or --space file.json), e.g.
+    "parameters": {"num_layers": [2, 4], "lr": {"low": 5e-5, "high": 5e-4, "log": true}}
+lists are choices, {"low", "high"[, "log"]} ranges are sampled (random and halving only).
+Methods: grid (every combination), random (trials samples), halving (successive halving:
+trials samples get min_epochs epochs, the best 1/eta continue with eta times the epochs until
+epochs is reached; continued trials resume from their checkpoints).
+
+python3 -m Trainer.sweep [--space file.json] [--method grid|random|halving] [--trials N] [--epochs E] [--workers W]
+"""
+import argparse
+import itertools
+import json
+import math
+import multiprocessing
+import os
+import random
+import time
+
+import numpy as np
+import torch
+from torch.optim.lr_scheduler import LambdaLR
+from torch.utils.data import DataLoader, Dataset
+
+METHODS = ('grid', 'random', 'halving')
+# config.json keys a search space may vary; embedding_dim sets both embedding dims (the decoder
+# attends to encoder memory, so they have to match)
+SEARCH_KEYS = ('num_layers', 'num_heads', 'embedding_dim', 'input_embedding_dim', 'output_embedding_dim',
+               'dim_feedforward', 'dropout_p', 'lr', 'batch_size')
+WARMUP_EPOCHS = 7
+
+
+class MappedPhrases(Dataset):
+    """(inputs, targets) rows start..stop of the memory-mapped dataset arrays"""
+
+    def __init__(self, inputs, targets, start, stop):
+        self.inputs = inputs
+        self.targets = targets
+        self.start = start
+        self.stop = stop
+
+    def __len__(self):
+        return self.stop - self.start
+
+    def __getitem__(self, index):
+        return self.inputs[self.start + index], self.targets[self.start + index]
+
+
+def _collate_mapped(batch):
+    inputs, targets = zip(*batch)
+    return torch.from_numpy(np.stack(inputs)).long(), torch.from_numpy(np.stack(targets)).long()
+
+
+def prepare_dataset(directory, vocabulary_options, limit=None):
+    """
+    Encodes the datasets once into directory/inputs.npy and targets.npy (training rows first,
+    then validation rows) plus meta.json, reused while the vocabulary options and limit match.
+
+    Parameters:
+    - limit: optional number of training phrases to keep (quick sweeps), validation stays whole
+
+    Returns:
+    meta dict (split, vocabulary sizes, validation groups, vocab_options)
+    """
+    from song_dataloader import Song_Dataloader
+
+    meta_path = os.path.join(directory, "meta.json")
+    if os.path.exists(meta_path):
+        with open(meta_path, "r") as meta_file:
+            meta = json.load(meta_file)
+        if meta['vocab_options'] == vocabulary_options and meta['limit'] == limit:
+            return meta
+
+    loader = Song_Dataloader(**vocabulary_options)
+    train_dataloader, test_dataloader, chord2in, _, note2in, _ = loader.load()
+    train = list(train_dataloader.dataset)[:limit]
+    test = list(test_dataloader.dataset)
+    rows = train + test
+
+    os.makedirs(directory, exist_ok=True)
+    # 14 note ids and a few hundred chord ids: uint8/int16 keep the shared pages small
+    np.save(os.path.join(directory, "inputs.npy"), np.array([inputs for inputs, _ in rows], dtype=np.uint8))
+    np.save(os.path.join(directory, "targets.npy"), np.array([targets for _, targets in rows], dtype=np.int16))
+    meta = {'split': len(train), 'rows': len(rows), 'input_vocab': len(note2in), 'output_vocab': len(chord2in),
+            'test_groups': loader.split_dataset_names()[1], 'vocab_options': loader.vocab_options, 'limit': limit}
+    with open(meta_path, "w") as meta_file:
+        json.dump(meta, meta_file)
+    return meta
+
+
+def sample_value(spec, rng):
+    if isinstance(spec, list):
+        return rng.choice(spec)
+    low, high = spec['low'], spec['high']
+    if spec.get('log'):
+        value = math.exp(rng.uniform(math.log(low), math.log(high)))
+    else:
+        value = rng.uniform(low, high)
+    return round(value) if isinstance(low, int) and isinstance(high, int) else value
+
+
+def trial_config(config, params):
+    """config.json values with a trial's parameters applied"""
+    merged = {**config, **params}
+    if 'embedding_dim' in params:
+        merged['input_embedding_dim'] = merged['output_embedding_dim'] = params['embedding_dim']
+    return merged
+
+
+def valid_params(params, config):
+    merged = trial_config(config, params)
+    return (merged['input_embedding_dim'] == merged['output_embedding_dim']
+            and merged['input_embedding_dim'] % merged['num_heads'] == 0)
+
+
+def generate_params(parameters, method, trials, config, seed=0):
+    """
+    Returns:
+    list of parameter dicts, one per trial; combinations the model cannot build (different
+    embedding dims, or not divisible by num_heads) are left out
+    """
+    unknown = set(parameters) - set(SEARCH_KEYS)
+    if unknown:
+        raise ValueError(f"cannot sweep {sorted(unknown)}, searchable keys are {list(SEARCH_KEYS)}")
+
+    if method == 'grid':
+        ranges = [name for name, spec in parameters.items() if not isinstance(spec, list)]
+        if ranges:
+            raise ValueError(f"grid search needs lists of values, {ranges} are ranges")
+        names = list(parameters)
+        candidates = [dict(zip(names, values)) for values in itertools.product(*parameters.values())]
+        return [params for params in candidates if valid_params(params, config)]
+
+    rng = random.Random(seed)
+    sampled = []
+    # invalid samples are drawn again, a bounded number of times
+    for _ in range(trials * 20):
+        if len(sampled) == trials:
+            break
+        params = {name: sample_value(spec, rng) for name, spec in parameters.items()}
+        if valid_params(params, config):
+            sampled.append(params)
+    return sampled
+
+
+# per-process state of a sweep worker, set by _init_sweep_worker
+_sweep_worker = {}
+
+
+def _init_sweep_worker(data_dir, meta, config, cores):
+    # each worker takes one group of cores and keeps it for all its trials
+    group = cores.get()
+    if hasattr(os, "sched_setaffinity"):
+        os.sched_setaffinity(0, group)
+    torch.set_num_threads(len(group))
+
+    inputs = np.load(os.path.join(data_dir, "inputs.npy"), mmap_mode="r")
+    targets = np.load(os.path.join(data_dir, "targets.npy"), mmap_mode="r")
+    _sweep_worker['train'] = MappedPhrases(inputs, targets, 0, meta['split'])
+    _sweep_worker['test'] = MappedPhrases(inputs, targets, meta['split'], meta['rows'])
+    _sweep_worker['meta'] = meta
+    _sweep_worker['config'] = config
+    _sweep_worker['cores'] = sorted(group)
+
+
+def _run_trial(trial):
+    from Model.Transformer import Transformer
+    from Trainer.trainer import Trainer
+
+    meta, params = _sweep_worker['meta'], trial['params']
+    config = trial_config(_sweep_worker['config'], params)
+    torch.manual_seed(trial['seed'])
+
+    model = Transformer(inputVocab=meta['input_vocab'], outputVocab=meta['output_vocab'],
+                        input_embedding_dim=config['input_embedding_dim'],
+                        output_embedding_dim=config['output_embedding_dim'], num_heads=config['num_heads'],
+                        num_encoder_layers=config['num_layers'], num_decoder_layers=config['num_layers'],
+                        dropout_p=config['dropout_p'], dim_feedforward=config['dim_feedforward'])
+    optimizer = torch.optim.Adam(model.parameters(), amsgrad=True, lr=config['lr'])
+    batch_size = config.get('batch_size', 128)
+    train_dataloader = DataLoader(_sweep_worker['train'], batch_size=batch_size, collate_fn=_collate_mapped)
+    test_dataloader = DataLoader(_sweep_worker['test'], batch_size=batch_size, collate_fn=_collate_mapped)
+
+    # one periodic checkpoint per trial, written after its last epoch; a later halving rung
+    # (or a rerun of an interrupted sweep) resumes from it
+    trainer = Trainer(model, optimizer, torch.nn.CrossEntropyLoss(), train_dataloader, test_dataloader,
+                      torch.device("cpu"), None, eval_batch_size=config.get('eval_batch_size', 512),
+                      test_groups=meta['test_groups'], eval_every_epochs=1, checkpoint_dir=trial['directory'],
+                      checkpoint_every=trial['epochs'], keep_checkpoints=1,
+                      checkpoint_metadata={'vocab_options': meta['vocab_options'], 'sweep_params': params})
+    trainer.scheduler = LambdaLR(trainer.optimizer, lr_lambda=lambda epoch: (epoch + 1) / WARMUP_EPOCHS
+                                 if epoch < WARMUP_EPOCHS else 1.0)
+    start_epoch = trainer.epoch
+    if trainer.checkpoints.latest() is not None:
+        trainer.resume()
+        start_epoch = trainer.epoch
+
+    start = time.perf_counter()
+    trainer.train(trial['epochs'])
+    seconds = time.perf_counter() - start
+
+    metrics = trainer.test_metrics[-1]
+    return {'id': trial['id'], 'params': params, 'epochs': trainer.epoch, 'loss': metrics['loss'],
+            'accuracy': metrics['accuracy'], 'best_loss': trainer.best_loss, 'train_seconds': seconds,
+            'epochs_trained': trainer.epoch - start_epoch, 'cores': _sweep_worker['cores'],
+            'parameters': sum(parameter.numel() for parameter in model.parameters()),
+            'checkpoint': trainer.checkpoints.latest()}
+
+
+def core_groups(workers):
+    """Splits the cores this process may run on into workers groups (shared round robin if fewer)"""
+    cores = sorted(os.sched_getaffinity(0)) if hasattr(os, "sched_getaffinity") else list(range(os.cpu_count() or 1))
+    if len(cores) < workers:
+        return [{cores[index % len(cores)]} for index in range(workers)]
+    size = len(cores) // workers
+    return [set(cores[index * size:(index + 1) * size]) for index in range(workers)]
+
+
+def measure_latency(model, src, sos_token, chords, repeats=3):
+    """
+    Median milliseconds to harmonize one phrase at batch size 1: encoder plus greedy decoding
+    of chords chords (the eager loop of melody_harmonizer.harmonize_melody)
+    """
+    timings = []
+    with torch.inference_mode():
+        for _ in range(repeats):
+            for row in range(src.size(0)):
+                start = time.perf_counter()
+                memory = model.encode(src[row:row + 1])
+                tokens = torch.full((1, chords + 1), sos_token, dtype=torch.long)
+                for step in range(1, chords + 1):
+                    output = model.decode(tokens[:, :step], memory, model.get_tgt_mask(step))
+                    tokens[:, step] = output[:, -1].argmax(dim=-1)
+                timings.append((time.perf_counter() - start) * 1000)
+    timings.sort()
+    return timings[len(timings) // 2]
+
+
+def pareto_front(results):
+    """ids of the trials no other trial beats on both validation loss and latency"""
+    front = set()
+    for result in results:
+        dominated = any(other['loss'] <= result['loss'] and other['latency_ms'] <= result['latency_ms']
+                        and (other['loss'] < result['loss'] or other['latency_ms'] < result['latency_ms'])
+                        for other in results)
+        if not dominated:
+            front.add(result['id'])
+    return front
+
+
+class Sweep:
+    """
+    Parameters:
+    - config: config.json contents, the defaults of every trial
+    - space: search space {"method", "parameters", "trials", "epochs", "workers", "seed",
+        "min_epochs", "eta", "directory", "limit", "latency_phrases"}
+    """
+
+    def __init__(self, config, space):
+        self.config = config
+        self.method = space.get('method', 'random')
+        if self.method not in METHODS:
+            raise ValueError(f"unknown sweep method {self.method!r}, expected one of {list(METHODS)}")
+        self.parameters = space['parameters']
+        self.trials = space.get('trials', 8)
+        self.epochs = space.get('epochs', config['num_epochs'])
+        self.workers = space.get('workers', os.cpu_count() or 1)
+        self.seed = space.get('seed', 0)
+        self.min_epochs = space.get('min_epochs', 1)
+        self.eta = space.get('eta', 3)
+        self.directory = space.get('directory', "Saved_Models/sweep")
+        self.limit = space.get('limit')
+        self.latency_phrases = space.get('latency_phrases', 16)
+        self.data_dir = os.path.join(self.directory, "dataset")
+        self.results = {}
+
+    def run_rung(self, pool, trials):
+        with open(os.path.join(self.directory, "trials.jsonl"), "a") as log_file:
+            for result in pool.imap_unordered(_run_trial, trials):
+                print(f"Trial {result['id']}: {result['epochs']} epochs, validation loss {result['loss']:.4f}, "
+                      f"accuracy {result['accuracy']:.4f} ({result['train_seconds']:.1f}s)")
+                log_file.write(json.dumps(result) + "\n")
+                log_file.flush()
+                self.results[result['id']] = result
+        return [self.results[trial['id']] for trial in trials]
+
+    def run(self):
+        """Trains every trial, measures latency and writes the leaderboard; returns its rows"""
+        meta = prepare_dataset(self.data_dir, self.config.get("vocabulary", {}), self.limit)
+        params = generate_params(self.parameters, self.method, self.trials, self.config, self.seed)
+        trials = [{'id': index, 'params': trial_params, 'seed': self.seed + index,
+                   'directory': os.path.join(self.directory, f"trial_{index:03d}")}
+                  for index, trial_params in enumerate(params)]
+        workers = max(1, min(self.workers, len(trials)))
+        print(f"{self.method} sweep: {len(trials)} trials, {workers} workers, {self.epochs} epochs, "
+              f"{meta['split']} training phrases")
+
+        context = multiprocessing.get_context("spawn")
+        cores = context.Queue()
+        for group in core_groups(workers):
+            cores.put(group)
+        with context.Pool(workers, initializer=_init_sweep_worker,
+                          initargs=(self.data_dir, meta, self.config, cores)) as pool:
+            if self.method == 'halving':
+                epochs = min(self.min_epochs, self.epochs)
+                while True:
+                    print(f"Rung: {len(trials)} trials to {epochs} epochs")
+                    results = self.run_rung(pool, [dict(trial, epochs=epochs) for trial in trials])
+                    if len(trials) <= 1 or epochs >= self.epochs:
+                        break
+                    keep = {result['id'] for result in sorted(results, key=lambda result: result['loss'])
+                            [:math.ceil(len(trials) / self.eta)]}
+                    trials = [trial for trial in trials if trial['id'] in keep]
+                    epochs = min(epochs * self.eta, self.epochs)
+            else:
+                self.run_rung(pool, [dict(trial, epochs=self.epochs) for trial in trials])
+
+        return self.write_leaderboard(meta)
+
+    def write_leaderboard(self, meta):
+        inputs = np.load(os.path.join(self.data_dir, "inputs.npy"), mmap_mode="r")
+        src = torch.from_numpy(np.array(inputs[meta['split']:meta['split'] + self.latency_phrases])).long()
+        targets = np.load(os.path.join(self.data_dir, "targets.npy"), mmap_mode="r")
+        # every target row starts with SOS and ends with EOS
+        sos_token, chords = int(targets[0][0]), targets.shape[1] - 2
+
+        from mapped_checkpoint import build_model
+
+        rows = []
+        for result in sorted(self.results.values(), key=lambda result: result['id']):
+            model_kwargs, model_state, _ = torch.load(result['checkpoint'], weights_only=False)['model']
+            model = build_model(model_kwargs, model_state)
+            rows.append(dict(result, latency_ms=measure_latency(model.eval(), src, sos_token, chords)))
+
+        front = pareto_front(rows)
+        rows.sort(key=lambda row: row['loss'])
+        for rank, row in enumerate(rows, 1):
+            row['rank'] = rank
+            row['pareto'] = row['id'] in front
+        with open(os.path.join(self.directory, "leaderboard.json"), "w") as leaderboard_file:
+            json.dump(rows, leaderboard_file, indent=2)
+        print_leaderboard(rows)
+        return rows
+
+
+def print_leaderboard(rows):
+    print(f"{'rank':>4}{'trial':>6}{'epochs':>7}{'loss':>9}{'accuracy':>10}{'latency (ms)':>14}{'params':>10}   "
+          f"hyperparameters")
+    for row in rows:
+        params = ", ".join(f"{name}={value:.3g}" if isinstance(value, float) else f"{name}={value}"
+                           for name, value in row['params'].items())
+        print(f"{row['rank']:>4}{row['id']:>6}{row['epochs']:>7}{row['loss']:>9.4f}{row['accuracy']:>10.4f}"
+              f"{row['latency_ms']:>14.2f}{row['parameters']:>10,}{' *' if row['pareto'] else '  '} {params}")
+    print("* on the loss/latency Pareto front")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Parallel hyperparameter sweep over config.json")
+    parser.add_argument("--config", default="config.json")
+    parser.add_argument("--space", help="JSON search space, defaults to the \"sweep\" section of the config")
+    parser.add_argument("--method", choices=list(METHODS))
+    parser.add_argument("--trials", type=int)
+    parser.add_argument("--epochs", type=int)
+    parser.add_argument("--workers", type=int)
+    parser.add_argument("--out", dest="directory", help="sweep directory (trials, checkpoints, leaderboard)")
+    parser.add_argument("--limit", type=int, help="training phrases to use (quick sweeps)")
+    args = parser.parse_args()
+
+    with open(args.config, "r") as json_file:
+        config = json.load(json_file)
+    if args.space:
+        with open(args.space, "r") as json_file:
+            space = json.load(json_file)
+    else:
+        space = dict(config["sweep"])
+    for name in ('method', 'trials', 'epochs', 'workers', 'directory', 'limit'):
+        if getattr(args, name) is not None:
+            space[name] = getattr(args, name)
+
+    Sweep(config, space).run()
+
+
+if __name__ == "__main__":
+    main()
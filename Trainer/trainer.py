@@ -1,33 +1,227 @@
+import multiprocessing
+import os
+
 import torch.nn.functional as F
 #import evaluation_helpers
 import torch
+from torch.utils.data import DataLoader
+from torch.utils.data.distributed import DistributedSampler
+
+from Trainer.checkpoints import CheckpointManager, rng_state, set_rng_state
+from Trainer.distributed import DistributedContext
+from Trainer.run_log import RunLog, grad_norm
+
+
+def _collate(batch):
+    input_data, output_data = zip(*batch)
+    return torch.tensor(input_data), torch.tensor(output_data)
+
+
+def evaluate(model, dataloader, device, groups=None):
+    """
+    Teacher-forced validation over a whole dataloader, in eval mode and under inference mode.
+    Losses and hits are accumulated on the device and copied back once at the end.
+
+    Parameters:
+    - model: harmony model, its train/eval mode is restored afterwards
+    - dataloader: unshuffled dataloader of (inputs, targets)
+    - device: CPU/GPU, etc
+    - groups: optional list with the source dataset name of every example, in dataloader order
+
+    Returns:
+    dict with token-weighted cross entropy 'loss', chord 'accuracy', 'tokens', 'examples' and,
+    given groups, 'datasets': {name: the same four values over that dataset's examples}
+    """
+    was_training = model.training
+    model.eval()
+
+    example_losses = []
+    example_hits = []
+    tokens_per_example = []
+    try:
+        with torch.inference_mode():
+            for inputs, targets in dataloader:
+                inputs = inputs.to(device)
+                targets = targets.to(device)
+
+                target_input = targets[:, :-1]
+                target_expected = targets[:, 1:]
+
+                tgt_mask = model.get_tgt_mask(target_input.size(1), device)
+                output = model(inputs, target_input, tgt_mask)
+
+                token_losses = F.cross_entropy(output.permute(0, 2, 1), target_expected, reduction='none')
+                example_losses.append(token_losses.sum(dim=1))
+                example_hits.append((output.argmax(dim=-1) == target_expected).sum(dim=1))
+                tokens_per_example.append(torch.full((targets.size(0),), target_expected.size(1), device=device))
+    finally:
+        model.train(was_training)
+
+    if not example_losses:
+        return {'loss': 0.0, 'accuracy': 0.0, 'tokens': 0, 'examples': 0}
+
+    example_losses = torch.cat(example_losses).double().cpu()
+    example_hits = torch.cat(example_hits).double().cpu()
+    tokens_per_example = torch.cat(tokens_per_example).double().cpu()
+
+    def summarize(selection):
+        tokens = tokens_per_example[selection].sum().item()
+        return {
+            'loss': example_losses[selection].sum().item() / tokens if tokens else 0.0,
+            'accuracy': example_hits[selection].sum().item() / tokens if tokens else 0.0,
+            'tokens': int(tokens),
+            'examples': int(tokens_per_example[selection].numel()),
+        }
+
+    metrics = summarize(slice(None))
+    if groups is not None:
+        names = sorted(set(groups), key=list(groups).index)
+        group_ids = torch.tensor([names.index(name) for name in groups])
+        metrics['datasets'] = {name: summarize(group_ids == i) for i, name in enumerate(names)}
+    return metrics
+
+
+def print_metrics(metrics, prefix="Validation"):
+    print(f"{prefix} Loss:", metrics['loss'], "Accuracy:", round(metrics['accuracy'], 4))
+    for name, dataset_metrics in metrics.get('datasets', {}).items():
+        print(f"   {name}: loss {dataset_metrics['loss']:.4f}, accuracy {dataset_metrics['accuracy']:.4f} "
+              f"({dataset_metrics['examples']} phrases)")
+
+
+# per-process state of the background evaluation worker, set by _init_eval_worker
+_eval_worker = {}
+
+
+def _init_eval_worker(model_kwargs, dataset, groups, batch_size, precision):
+    from Model.Transformer import Transformer
+
+    # leave the CPU to the training process
+    torch.set_num_threads(1)
+    _eval_worker['model'] = Transformer(**model_kwargs).set_precision(precision)
+    _eval_worker['dataloader'] = DataLoader(dataset, batch_size=batch_size, collate_fn=_collate)
+    _eval_worker['groups'] = groups
+
+
+def _run_eval(state_dict):
+    model = _eval_worker['model']
+    model.load_state_dict(state_dict)
+    return evaluate(model, _eval_worker['dataloader'], torch.device("cpu"), _eval_worker['groups'])
+
 
 class Trainer:
 
+    """
+    Parameters (besides the obvious ones):
+    - eval_batch_size: (int) batch size of validation, larger than training since no graph is kept
+    - test_groups: optional source dataset name of every validation example, for per-dataset metrics
+        (Song_Dataloader.split_dataset_names)
+    - eval_every_steps: (int) also validate every N optimizer steps, 0 = only every 5th epoch
+    - background_eval: run those step validations in a separate process on a CPU snapshot of the
+        weights, so training does not wait for them (results land in background_metrics)
+    - run_log: optional JSONL path for per-step/per-epoch instrumentation (see Trainer/run_log.py)
+    - profile_steps: optional (first, last) optimizer steps to record with torch.profiler
+    - eval_every_epochs: (int) validate after every N-th epoch (epochs 0, N, 2N, ...)
+    - checkpoint_dir: optional directory for periodic checkpoints of the full training state (model,
+        optimizer, scheduler, epoch, losses, RNG) and for best_model.pth, the weights with the lowest
+        validation loss so far (background validations are not considered, their weights are gone)
+    - checkpoint_every: (int) write a periodic checkpoint every N epochs (and after the last one)
+    - keep_checkpoints: (int) periodic checkpoints kept on disk, 0 keeps all
+    - early_stopping_patience: (int) stop after this many validations without a new best loss, 0 = never
+    - checkpoint_metadata: dict saved alongside the model in every checkpoint (e.g. vocab_options)
+    - precision: 'fp32' or 'bf16' (bfloat16 autocast with fp32 master weights, no loss scaling),
+        set on the model so validation runs in it too (see Transformer.set_precision)
+    - distributed: DistributedContext (Trainer/distributed.py) for data-parallel training, the train
+        dataloader should come from its shard(); only rank 0 logs, validates and writes checkpoints
+    - compile_mode: optional torch.compile mode ('default', 'reduce-overhead', 'max-autotune') of the
+        training forward pass; batches have fixed shapes, so it compiles once (plus once for a smaller
+        last batch)
+    """
+
     def __init__(self, model,
-                 optimizer, 
+                 optimizer,
                  loss_fn,
                  train_dataloader,
                  test_dataloader,
                  device,
                  scheduler,
-                 train_losses=[],
-                 test_losses=[]):
- 
-        self.model = model
+                 train_losses=None,
+                 test_losses=None,
+                 eval_batch_size=512,
+                 test_groups=None,
+                 eval_every_steps=0,
+                 background_eval=False,
+                 run_log=None,
+                 profile_steps=None,
+                 eval_every_epochs=5,
+                 checkpoint_dir=None,
+                 checkpoint_every=1,
+                 keep_checkpoints=3,
+                 early_stopping_patience=0,
+                 checkpoint_metadata=None,
+                 precision='fp32',
+                 distributed=None,
+                 compile_mode=None):
+
+        self.model = model.set_precision(precision)
+        self.distributed = distributed or DistributedContext()
+        # gradients are averaged over the ranks by DistributedDataParallel, self.model stays the
+        # plain module for validation and checkpoints
+        self.train_model = self.distributed.wrap(model)
+        if compile_mode:
+            self.train_model = torch.compile(self.train_model, mode=compile_mode, dynamic=False)
         self.optimizer = optimizer
-        self.loss_fn = loss_fn  
+        self.loss_fn = loss_fn
         self.train_dataloader = train_dataloader
         self.test_dataloader = test_dataloader
         self.device = device
-        self.train_losses = train_losses
-        self.test_losses = test_losses
+        # fresh lists per trainer unless the caller passes its own
+        self.train_losses = [] if train_losses is None else train_losses
+        self.test_losses = [] if test_losses is None else test_losses
         self.scheduler = scheduler
-    
+
+        self.eval_batch_size = eval_batch_size
+        self.test_groups = test_groups
+        self.eval_every_steps = eval_every_steps
+        self.background_eval = background_eval
+        self.test_metrics = []
+        self.background_metrics = []
+        self.global_step = 0
+        self.epoch = 0
+        self._eval_pool = None
+        self.run_log = RunLog(run_log if self.distributed.is_main else None, device, profile_steps)
+
+        self.eval_every_epochs = eval_every_epochs
+        self.checkpoints = CheckpointManager(checkpoint_dir, keep_checkpoints) if checkpoint_dir else None
+        self.checkpoint_every = checkpoint_every
+        self.early_stopping_patience = early_stopping_patience
+        self.checkpoint_metadata = checkpoint_metadata or {}
+        self.best_loss = None
+        self.best_step = None
+        self.stale_validations = 0
+
+        # same examples and order as test_dataloader, bigger batches
+        self.eval_dataloader = None
+        if test_dataloader is not None:
+            self.eval_dataloader = DataLoader(test_dataloader.dataset, batch_size=eval_batch_size,
+                                              collate_fn=test_dataloader.collate_fn)
+
+
+    def print(self, *args, **kwargs):
+        """print on rank 0 only"""
+        if self.distributed.is_main:
+            print(*args, **kwargs)
+
+    def set_sampler_epoch(self, dataloader):
+        # every epoch reshuffles the shards of a distributed sampler differently
+        if isinstance(dataloader.sampler, DistributedSampler):
+            dataloader.sampler.set_epoch(self.epoch)
 
     def run_epoch(self):
 
+        self.set_sampler_epoch(self.train_dataloader)
+        self.run_log.epoch_begin(self.epoch)
         for inputs,targets in self.train_dataloader:
+            self.run_log.step_begin(self.global_step + 1)
 
             inputs = inputs.to(self.device)
             targets = targets.to(self.device)
@@ -38,50 +232,213 @@ class Trainer:
             target_input = targets[:,:-1]
             target_expected = targets[:,1:]
 
-            tgt_mask = self.model.get_tgt_mask(target_input.size(1)).to(self.device)
+            tgt_mask = self.model.get_tgt_mask(target_input.size(1), self.device)
 
-            output = self.model(inputs,target_input, tgt_mask)
-            output = output.permute(0,2,1) 
+            output = self.train_model(inputs,target_input, tgt_mask)
+            output = output.permute(0,2,1)
 
             loss = self.loss_fn(output, target_expected)
+            self.run_log.mark('forward')
 
             # compute gradients
             self.optimizer.zero_grad()
             loss.backward()
+            self.run_log.mark('backward')
+
+            norm = grad_norm(self.model.parameters()) if self.run_log.enabled else None
             self.optimizer.step()
+            self.run_log.mark('optimizer')
+
+            self.after_step(loss, target_expected, norm)
 
         self.scheduler.step()
 
-        print("Loss:",loss.item())
+        self.print("Loss:",loss.item())
         self.train_losses.append(loss.item())
+        self.end_epoch()
+
+    def after_step(self, loss, target_expected, norm=None):
+        """Counts optimizer steps, logs them and runs the periodic step validation"""
+        self.global_step += 1
+        # samples and tokens of the whole (global) batch, loss of rank 0's shard; .item() waits for the
+        # device, so the loss is only read when it is logged
+        world_size = self.distributed.world_size
+        self.run_log.step_end(self.global_step, loss.item() if self.run_log.enabled else None,
+                              target_expected.size(0) * world_size, target_expected.numel() * world_size,
+                              self.optimizer.param_groups[0]['lr'], norm)
+        if self.eval_every_steps and self.global_step % self.eval_every_steps == 0 and self.distributed.is_main:
+            if self.background_eval:
+                self.submit_background_eval()
+            else:
+                print("Step", self.global_step, end=" ")
+                self.run_test_epoch()
+
+    def end_epoch(self):
+        summary = self.run_log.epoch_end()
+        self.epoch += 1
+        self.print(f"Throughput: {summary['samples_per_sec']:.1f} samples/s, {summary['tokens_per_sec']:.1f} tokens/s "
+              f"(data {summary['data_time']:.2f}s, forward {summary['forward_time']:.2f}s, "
+              f"backward {summary['backward_time']:.2f}s, optimizer {summary['optimizer_time']:.2f}s)")
 
     def run_test_epoch(self):
+        """
+        Validates on the whole validation split (see evaluate).
 
-        for inputs,targets in self.test_dataloader:
+        Returns:
+        metrics dict, also appended to test_metrics (its loss to test_losses)
+        """
+        metrics = evaluate(self.model, self.eval_dataloader, self.device, self.test_groups)
+        metrics['step'] = self.global_step
 
-            inputs = inputs.to(self.device)
-            targets = targets.to(self.device)
+        print_metrics(metrics)
+        self.run_log.write('validation', **metrics)
+        self.test_losses.append(metrics['loss'])
+        self.test_metrics.append(metrics)
+        self.track_best(metrics)
+        return metrics
 
-            # forward pass
-            # create mask for target sequence
+    def track_best(self, metrics):
+        if self.best_loss is not None and metrics['loss'] >= self.best_loss:
+            self.stale_validations += 1
+            return
+        self.best_loss = metrics['loss']
+        self.best_step = metrics['step']
+        self.stale_validations = 0
+        if self.checkpoints is not None and self.distributed.is_main:
+            best = self.model_checkpoint()
+            best['validation'] = metrics
+            path = self.checkpoints.save_best(best)
+            print(f"New best validation loss {metrics['loss']:.4f}, saved to", path)
 
-            target_input = targets[:,:-1]
-            target_expected = targets[:,1:]
+    def should_stop(self):
+        return bool(self.early_stopping_patience) and self.stale_validations >= self.early_stopping_patience
 
-            tgt_mask = self.model.get_tgt_mask(target_input.size(1)).to(self.device)
+    def model_checkpoint(self):
+        """Model in the layout every loader reads, plus checkpoint_metadata"""
+        return {'model': [self.model.kwargs, self.model.state_dict(), self.model.model_type],
+                **self.checkpoint_metadata}
 
-            output = self.model(inputs,target_input, tgt_mask)
-            output = output.permute(0,2,1)
+    def state_dict(self):
+        """
+        Returns:
+        model_checkpoint() with the training state needed to resume under 'trainer'
+        """
+        checkpoint = self.model_checkpoint()
+        checkpoint['trainer'] = {
+            'optimizer': self.optimizer.state_dict(),
+            'scheduler': self.scheduler.state_dict() if self.scheduler is not None else None,
+            'epoch': self.epoch,
+            'global_step': self.global_step,
+            'train_losses': self.train_losses,
+            'test_losses': self.test_losses,
+            'test_metrics': self.test_metrics,
+            'best_loss': self.best_loss,
+            'best_step': self.best_step,
+            'stale_validations': self.stale_validations,
+            'rng': rng_state(),
+        }
+        return checkpoint
 
-            loss = self.loss_fn(output, target_expected)
+    def load_state_dict(self, checkpoint):
+        kwargs, model_state, _ = checkpoint['model']
+        if kwargs != self.model.kwargs:
+            raise ValueError(f"checkpoint was trained with different model arguments: {kwargs}")
+        self.model.load_state_dict(model_state)
+
+        state = checkpoint['trainer']
+        self.optimizer.load_state_dict(state['optimizer'])
+        if self.scheduler is not None and state['scheduler'] is not None:
+            self.scheduler.load_state_dict(state['scheduler'])
+        self.epoch = state['epoch']
+        self.global_step = state['global_step']
+        # in place, callers may hold on to the lists they passed in
+        self.train_losses[:] = state['train_losses']
+        self.test_losses[:] = state['test_losses']
+        self.test_metrics[:] = state['test_metrics']
+        self.best_loss = state['best_loss']
+        self.best_step = state['best_step']
+        self.stale_validations = state['stale_validations']
+        set_rng_state(state['rng'])
 
+    def save_checkpoint(self):
+        if not self.distributed.is_main:
+            return None
+        path = self.checkpoints.save(self.state_dict(), self.epoch)
+        print("Saved checkpoint", path)
+        return path
 
-        print("Validation Loss:",loss.item())
-        self.test_losses.append(loss.item())
+    def resume(self, path=None):
+        """
+        Restores the training state of a checkpoint, by default the latest one in checkpoint_dir.
+
+        Returns:
+        path of the checkpoint resumed from, None if there is none
+        """
+        if path is None and self.checkpoints is not None:
+            path = self.checkpoints.latest()
+        if path is None:
+            self.print("No checkpoint to resume from, starting from scratch")
+            return None
+        self.load_state_dict(torch.load(path, map_location=self.device, weights_only=False))
+        self.print("Resumed from", path, "at epoch", self.epoch, "step", self.global_step)
+        return path
+
+    def restore_best(self):
+        """Loads the weights of best_model.pth into the model, if one was saved"""
+        if self.checkpoints is None or self.best_loss is None or not os.path.exists(self.checkpoints.best_path):
+            return False
+        best = torch.load(self.checkpoints.best_path, map_location=self.device, weights_only=False)
+        self.model.load_state_dict(best['model'][1])
+        print("Restored best model from step", self.best_step, "with validation loss", round(self.best_loss, 4))
+        return True
+
+    def submit_background_eval(self):
+        if self._eval_pool is None:
+            # spawn: forking a process that already runs torch thread pools can deadlock
+            context = multiprocessing.get_context("spawn")
+            self._eval_pool = context.Pool(1, initializer=_init_eval_worker,
+                                           initargs=(self.model.kwargs, list(self.test_dataloader.dataset),
+                                                     self.test_groups, self.eval_batch_size,
+                                                     self.model.precision))
+
+        snapshot = {name: value.detach().to("cpu", copy=True) for name, value in self.model.state_dict().items()}
+        step = self.global_step
+        self._eval_pool.apply_async(_run_eval, (snapshot,), callback=lambda metrics: self._record_background(step, metrics))
+
+    def _record_background(self, step, metrics):
+        metrics['step'] = step
+        print_metrics(metrics, prefix=f"Step {step} background validation")
+        self.run_log.write('validation', background=True, **metrics)
+        self.background_metrics.append(metrics)
+
+    def finish_background_eval(self):
+        """Waits for the pending background validations"""
+        if self._eval_pool is not None:
+            self._eval_pool.close()
+            self._eval_pool.join()
+            self._eval_pool = None
+        self.background_metrics.sort(key=lambda metrics: metrics['step'])
 
     def train(self,num_epochs):
-        for i in range(num_epochs):
-            print("Epoch",str(i)+":")
-            self.run_epoch()
-            if i % 5 == 0:
-                self.run_test_epoch()
+        """Trains until num_epochs epochs are done in total, a resumed trainer continues from its epoch"""
+        try:
+            while self.epoch < num_epochs:
+                i = self.epoch
+                self.print("Epoch",str(i)+":")
+                self.run_epoch()
+                if i % self.eval_every_epochs == 0 and self.distributed.is_main:
+                    self.run_test_epoch()
+                # rank 0 validates, every rank has to stop together
+                stop = self.distributed.any(self.should_stop())
+                if self.checkpoints is not None and (self.epoch % self.checkpoint_every == 0
+                                                     or self.epoch == num_epochs or stop):
+                    self.save_checkpoint()
+                if stop:
+                    self.print("Early stopping: no improvement in", self.stale_validations, "validations")
+                    break
+            self.finish_background_eval()
+        finally:
+            # stops the profiler and closes the log file, also when training fails
+            self.run_log.close()
+        # rank 0 may still be writing its last checkpoint
+        self.distributed.barrier()
@@ -0,0 +1,325 @@
+import contextlib
+import json
+import math
+import multiprocessing
+import os
+import time
+
+import torch
+
+from compiled_decoding import compiled_decoder
+from decoding import sample_next_token, sample_tokens, SAMPLE
+from inference_cache import encoder_cache
+import mapped_checkpoint
+from song_dataloader import REST_TOKEN, SOS_TOKEN, EOS_TOKEN, replace_unknown_chords
+
+# one chord per half bar = 8 sixteenth-note frames
+FRAMES_PER_SLOT = 8
+# encoded lengths are grouped into buckets of this many frames before batching
+BUCKET_WIDTH = 16
+
+
+def encode_frames(melody, note2in):
+    """
+    Transform [[midi note, duration in 16th notes], ...] into 16th note frames + EOS,
+    the same encoding as Song_Dataloader.encode_melody
+
+    Raises:
+    ValueError if melody is not a list of [midi note or "rest", duration] pairs
+    """
+    if not isinstance(melody, list):
+        raise ValueError("melody must be a list of [midi note, duration] pairs")
+    encoded = []
+    for position, noteDur in enumerate(melody):
+        if not isinstance(noteDur, (list, tuple)) or len(noteDur) != 2:
+            raise ValueError(f"note {position} is not a [midi note, duration] pair: {noteDur!r}")
+        note, duration = noteDur
+        if note != REST_TOKEN and (isinstance(note, bool) or not isinstance(note, int)):
+            raise ValueError(f"note {position} has no midi note number: {note!r}")
+        if isinstance(duration, bool) or not isinstance(duration, (int, float)) or not math.isfinite(duration):
+            raise ValueError(f"note {position} has no duration in 16th notes: {duration!r}")
+        noteName = REST_TOKEN if note == REST_TOKEN else note % 12
+        encoded += [note2in[noteName]] * int(duration)
+    encoded.append(note2in[EOS_TOKEN])
+    return encoded
+
+
+def encode_melodies(melodies, note2in):
+    """
+    encode_frames of every melody.
+
+    Raises:
+    ValueError naming the index of the first malformed melody
+    """
+    encoded = []
+    for index, melody in enumerate(melodies):
+        try:
+            encoded.append(encode_frames(melody, note2in))
+        except ValueError as error:
+            raise ValueError(f"melody {index}: {error}") from None
+    return encoded
+
+
+def bucket_batches(encoded, batch_size):
+    """
+    Groups phrases of similar length so padded batches waste little compute.
+
+    Parameters:
+    - encoded: list of encoded frame lists
+    - batch_size: (int) maximum phrases per batch
+
+    Returns:
+    list of batches, each a list of indices into encoded
+    """
+    buckets = {}
+    for i, frames in enumerate(encoded):
+        buckets.setdefault(len(frames) // BUCKET_WIDTH, []).append(i)
+
+    batches = []
+    for bucket in sorted(buckets):
+        indices = sorted(buckets[bucket], key=lambda i: len(encoded[i]))
+        for start in range(0, len(indices), batch_size):
+            batches.append(indices[start:start + batch_size])
+    return batches
+
+
+def harmonize_padded_batch(model, encoded, chord2in, in2chord, temperature=1.0, k=20, decode_mode=SAMPLE,
+                           generator=None, pad_token=0, compile_mode=None):
+    """
+    Harmonizes several encoded phrases at once with one padded, batched decoding loop.
+
+    Parameters:
+    - model: trained harmony model (eval mode)
+    - encoded: list of encoded frame lists (each ending with EOS)
+    - chord2in/in2chord: chord vocabulary
+    - temperature, k: sampling settings, shared by the batch or one value per phrase (list or tensor)
+    - decode_mode: 'sample' or 'greedy' for the whole batch
+    - generator: torch.Generator for reproducible sampling
+    - pad_token: input id written into padded frames (masked out, so any id works)
+    - compile_mode: torch.compile mode of the decoder (see compiled_decoding.py), None decodes eagerly
+
+    Returns:
+    list of chord lists, one chord per half-bar slot of each phrase
+    """
+    device = next(model.parameters()).device
+    max_frames = max(len(frames) for frames in encoded)
+
+    src = torch.full((len(encoded), max_frames), pad_token, dtype=torch.long, device=device)
+    padding_mask = torch.ones((len(encoded), max_frames), dtype=torch.bool, device=device)
+    for row, frames in enumerate(encoded):
+        src[row, :len(frames)] = torch.tensor(frames, dtype=torch.long, device=device)
+        padding_mask[row, :len(frames)] = False
+
+    # same number of chords as harmonize_melody: one per started half bar
+    slots = [math.ceil((len(frames) - 1) / FRAMES_PER_SLOT) for frames in encoded]
+
+    with torch.no_grad():
+        memory = encoder_cache.encode(model, src, src_key_padding_mask=padding_mask)
+
+        # shape-stable compiled decoder: fixed-size chord buffer and memory padded to its frames
+        compiled = compiled_decoder(model, compile_mode) if compile_mode else None
+        if compiled is not None and compiled.fits(max_frames, max(slots) + 1):
+            memory, padding_mask = compiled.pad_memory(memory, padding_mask)
+        else:
+            compiled = None
+
+        if isinstance(temperature, (list, tuple)):
+            temperature = torch.tensor(temperature, dtype=torch.float, device=device)
+        if isinstance(k, (list, tuple)):
+            k = torch.tensor(k, dtype=torch.long, device=device)
+
+        # [batch, SOS + chords] token buffer, every step writes one column in place
+        buffer_length = compiled.max_tokens if compiled is not None else max(slots) + 1
+        sequence = torch.zeros((len(encoded), buffer_length), dtype=torch.long, device=device)
+        sequence[:, 0] = chord2in[SOS_TOKEN]
+        for length in range(1, max(slots) + 1):
+            if compiled is not None:
+                output = compiled.decode_at(sequence, length, memory, padding_mask)
+            else:
+                tgt_mask = model.get_tgt_mask(length, device)
+                output = model.decode(sequence[:, :length], memory, tgt_mask,
+                                      memory_key_padding_mask=padding_mask)[:, -1]
+
+            if decode_mode == SAMPLE:
+                sample_tokens(output, temperature, k, generator, out=sequence[:, length:length + 1])
+            else:
+                sequence[:, length:length + 1] = sample_next_token(output, decode_mode=decode_mode)
+
+    # a row ends at its first <EOS>; the remaining slots hold the last chord, like special tokens within the row
+    eos = chord2in[EOS_TOKEN]
+    results = []
+    for row, n in zip(sequence[:, 1:].tolist(), slots):
+        row = row[:n]
+        if eos in row:
+            row = row[:row.index(eos)] + [eos] * (n - row.index(eos))
+        results.append(replace_unknown_chords([in2chord[chord] for chord in row]))
+    return results
+
+
+def load_model(model_path, device):
+    # memory-mapped when a converted checkpoint exists, so pool workers share the weights' pages
+    return mapped_checkpoint.load_model(model_path, device)
+
+
+# per-process state of pool workers, set by _init_worker
+_worker = {}
+
+
+def _init_worker(model_path, vocab, num_threads, precision, compile_mode, attention):
+    torch.set_num_threads(num_threads)
+    _worker['model'] = load_model(model_path, torch.device("cpu")).set_precision(precision).set_attention(attention)
+    _worker['vocab'] = vocab
+    _worker['compile_mode'] = compile_mode
+
+
+def _run_batch(job):
+    indices, encoded, temperature, k, decode_mode, seed = job
+    in2chord, chord2in = _worker['vocab']
+
+    generator = torch.Generator()
+    generator.manual_seed(seed)
+    chords = harmonize_padded_batch(_worker['model'], encoded, chord2in, in2chord, temperature, k, decode_mode,
+                                    generator, compile_mode=_worker['compile_mode'])
+    return list(zip(indices, chords))
+
+
+def create_pool(model_path, vocab, workers, precision='fp32', compile_mode=None, attention='default'):
+    """
+    Process pool for harmonize_many: every worker loads the model once and uses its share of
+    the CPU threads. Long-running callers (the server) create it once and pass it to every call.
+
+    Parameters:
+    - model_path: checkpoint loaded by the workers
+    - vocab: (in2chord, chord2in, note2in) vocabulary of the model
+    - workers: (int) number of worker processes
+    - precision, compile_mode, attention: settings of the workers' models
+    """
+    in2chord, chord2in, _ = vocab
+    num_threads = max(1, (os.cpu_count() or 1) // workers)
+    # spawn: forking a process that already runs torch thread pools can deadlock
+    context = multiprocessing.get_context("spawn")
+    return context.Pool(workers, initializer=_init_worker,
+                        initargs=(model_path, (in2chord, chord2in), num_threads, precision, compile_mode, attention))
+
+
+def harmonize_many(melodies, model_path, vocab, temperature=1.0, k=20, decode_mode=SAMPLE, seed=0,
+                   batch_size=64, workers=1, model=None, precision='fp32', compile_mode=None, attention='default',
+                   pool=None, slot=None):
+    """
+    Harmonizes many melodies, yielding results as soon as each batch is done.
+
+    Melodies are encoded right away, so a malformed one raises before anything is decoded (or
+    streamed), then bucketed by length and decoded in padded batches. With workers > 1 (or a
+    pool) the batches are spread over a process pool (see create_pool).
+
+    Parameters:
+    - melodies: list of melodies in [[midi note, duration in 16th notes], ...] form
+    - model_path: checkpoint loaded by pool workers
+    - vocab: (in2chord, chord2in, note2in) vocabulary of the model
+    - temperature, k, decode_mode: sampling settings
+    - seed: (int) base seed, every batch is seeded from it and its first phrase index
+    - batch_size: (int) phrases per padded batch
+    - workers: (int) number of worker processes, 1 decodes in this process
+    - model: already loaded model to use when workers == 1 (decodes in its own precision and attention)
+    - precision: 'fp32' or 'bf16' of models loaded here (see Transformer.set_precision)
+    - attention: 'default' or 'sdpa' of models loaded here (see Transformer.set_attention)
+    - compile_mode: torch.compile mode of the decoder, each worker compiles its own
+    - pool: pool from create_pool to run the batches on, instead of one created for this call
+    - slot: context manager held while each batch decodes in this process (e.g. the server's
+      inference semaphore), released before its results are yielded
+
+    Returns:
+    iterator of (index into melodies, list of chords per half-bar slot)
+
+    Raises:
+    ValueError naming the index of the first malformed melody (see encode_melodies)
+    """
+    encoded = encode_melodies(melodies, vocab[2])
+    return _harmonize_encoded(encoded, model_path, vocab, temperature, k, decode_mode, seed, batch_size, workers,
+                              model, precision, compile_mode, attention, pool, slot)
+
+
+def _harmonize_encoded(encoded, model_path, vocab, temperature, k, decode_mode, seed, batch_size, workers,
+                       model, precision, compile_mode, attention, pool, slot):
+    in2chord, chord2in, note2in = vocab
+    if not encoded:
+        return
+
+    jobs = []
+    for batch in bucket_batches(encoded, batch_size):
+        jobs.append((batch, [encoded[i] for i in batch], temperature, k, decode_mode, seed + batch[0]))
+
+    if pool is None and workers <= 1:
+        if model is None:
+            model = load_model(model_path, torch.device("cpu")).set_precision(precision).set_attention(attention)
+        for indices, batch_encoded, temperature, k, decode_mode, batch_seed in jobs:
+            with slot if slot is not None else contextlib.nullcontext():
+                generator = torch.Generator(device=next(model.parameters()).device)
+                generator.manual_seed(batch_seed)
+                chords = harmonize_padded_batch(model, batch_encoded, chord2in, in2chord, temperature, k,
+                                                decode_mode, generator, compile_mode=compile_mode)
+            yield from zip(indices, chords)
+        return
+
+    if pool is not None:
+        for results in pool.imap_unordered(_run_batch, jobs):
+            yield from results
+        return
+
+    with create_pool(model_path, vocab, workers, precision, compile_mode, attention) as pool:
+        for results in pool.imap_unordered(_run_batch, jobs):
+            yield from results
+
+
+def read_jsonl_melodies(path):
+    """
+    Reads one melody per line, either a bare [[midi note, duration], ...] list or
+    an object {"id": ..., "melody": [...]}.
+
+    Returns:
+    (ids, melodies)
+    """
+    ids, melodies = [], []
+    with open(path, "r") as input_file:
+        for line_number, line in enumerate(input_file):
+            line = line.strip()
+            if not line:
+                continue
+            record = json.loads(line)
+            if isinstance(record, dict):
+                ids.append(record.get("id", line_number))
+                melodies.append(record["melody"])
+            else:
+                ids.append(line_number)
+                melodies.append(record)
+    return ids, melodies
+
+
+def run_batch_file(input_path, output_path, model_path, vocab, temperature=1.0, k=20, decode_mode=SAMPLE, seed=0,
+                   batch_size=64, workers=1, model=None, precision='fp32', compile_mode=None, attention='default'):
+    """
+    Offline batch mode: harmonizes every melody of input_path and appends one JSON
+    line per phrase to output_path as results arrive, then reports throughput.
+
+    Returns:
+    summary dict with phrase count, elapsed seconds and phrases per second
+    """
+    ids, melodies = read_jsonl_melodies(input_path)
+    print(f"Harmonizing {len(melodies)} phrases with {workers} worker(s), batch size {batch_size}...")
+
+    start = time.perf_counter()
+    with open(output_path, "w") as output_file:
+        for index, chords in harmonize_many(melodies, model_path, vocab, temperature, k, decode_mode, seed,
+                                            batch_size, workers, model, precision, compile_mode, attention):
+            output_file.write(json.dumps({"id": ids[index], "chords": chords}) + "\n")
+            output_file.flush()
+    elapsed = time.perf_counter() - start
+
+    summary = {
+        "phrases": len(melodies),
+        "seconds": elapsed,
+        "phrases_per_second": len(melodies) / elapsed if elapsed > 0 else 0.0,
+    }
+    print(f"Harmonized {summary['phrases']} phrases in {elapsed:.2f}s "
+          f"({summary['phrases_per_second']:.1f} phrases/s). Output written to {output_path}")
+    return summary
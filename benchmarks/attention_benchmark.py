@@ -0,0 +1,107 @@
+"""
+Default attention (nn.Transformer layers, explicit float masks) against fused SDPA attention
+(Transformer.set_attention('sdpa')): largest logit difference and greedy chord agreement on the
+validation split, and latency of encoding + greedy decoding at several batch sizes, for full-length
+phrases and for padded batches of mixed lengths (key padding masks, nested tensors in the encoder).
+
+python3 benchmarks/attention_benchmark.py [--model path] [--batch-sizes 1 8 64] [--repeats N]
+"""
+import argparse
+import os
+import sys
+import time
+
+import torch
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from Model.Transformer import ATTENTION_MODES
+from mapped_checkpoint import checkpoint_model, load_checkpoint
+from song_dataloader import Song_Dataloader, SOS_TOKEN
+
+
+def greedy_decode(model, src, sos_token, length, padding_mask=None):
+    """Greedy chords [batch, length], the last step's logits"""
+    with torch.inference_mode():
+        memory = model.encode(src, src_key_padding_mask=padding_mask)
+        tokens = torch.full((src.size(0), length + 1), sos_token, dtype=torch.long, device=src.device)
+        for step in range(1, length + 1):
+            output = model.decode(tokens[:, :step], memory, model.get_tgt_mask(step, src.device),
+                                  memory_key_padding_mask=padding_mask)
+            tokens[:, step] = output[:, -1].argmax(dim=-1)
+    return tokens[:, 1:], output
+
+
+def padding_mask_of(batch, frames, device, seed=0):
+    """Key padding mask of a batch with 2 to 8 bar phrases (True marks padded frames), None for batch 1"""
+    if batch == 1:
+        return None
+    generator = torch.Generator().manual_seed(seed)
+    lengths = torch.randint(33, frames + 1, (batch,), generator=generator)
+    lengths[0] = frames
+    return (torch.arange(frames)[None, :] >= lengths[:, None]).to(device)
+
+
+def time_ms(function, repeats):
+    function()
+    timings = []
+    for _ in range(repeats):
+        start = time.perf_counter()
+        function()
+        timings.append((time.perf_counter() - start) * 1000)
+    timings.sort()
+    return timings[len(timings) // 2]
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Parity and latency of fused SDPA attention against the default")
+    parser.add_argument("--model", default="Saved_Models/pretrained_model.pth")
+    parser.add_argument("--batch-sizes", type=int, nargs="+", default=[1, 8, 64])
+    parser.add_argument("--repeats", type=int, default=10)
+    parser.add_argument("--device", default="cpu")
+    args = parser.parse_args()
+
+    device = torch.device(args.device)
+    checkpoint = load_checkpoint(args.model, device)
+    loader = Song_Dataloader.for_checkpoint(checkpoint)
+    _, test_dataloader, chord2in, _, _, _ = loader.load()
+    model = checkpoint_model(checkpoint, device)
+    sos_token = chord2in[SOS_TOKEN]
+    src = torch.tensor([inputs for inputs, _ in test_dataloader.dataset], device=device)
+    chords = len(test_dataloader.dataset[0][1]) - 2
+
+    print(f"model {args.model} ({type(model.transformer).__name__}), device {device}, "
+          f"{torch.get_num_threads()} threads")
+
+    # parity on the validation split, padded the way the batch decoder pads shorter phrases
+    decoded, logits = {}, {}
+    padding_mask = padding_mask_of(src.size(0), src.size(1), device)
+    for attention in ATTENTION_MODES:
+        model.set_attention(attention)
+        results = [greedy_decode(model, src[start:start + 512], sos_token, chords,
+                                 padding_mask[start:start + 512])
+                   for start in range(0, src.size(0), 512)]
+        decoded[attention] = torch.cat([tokens for tokens, _ in results])
+        logits[attention] = torch.cat([output for _, output in results])
+    agree = (decoded['default'] == decoded['sdpa']).float()
+    print(f"\nvalidation split ({src.size(0)} phrases): largest logit difference "
+          f"{(logits['default'] - logits['sdpa']).abs().max().item():.2e}, greedy chords identical "
+          f"{agree.mean().item():.2%}, phrases identical {agree.all(dim=1).float().mean().item():.2%}")
+
+    print(f"\n{'batch':>6}{'padded':>8}{'default (ms)':>14}{'sdpa (ms)':>11}{'speedup':>9}")
+    for batch in args.batch_sizes:
+        for padded in (False, True):
+            if padded and batch == 1:
+                continue
+            mask = padding_mask_of(batch, src.size(1), device) if padded else None
+            timings = {}
+            for attention in ATTENTION_MODES:
+                model.set_attention(attention)
+                timings[attention] = time_ms(lambda: greedy_decode(model, src[:batch], sos_token, chords, mask),
+                                             args.repeats)
+            print(f"{batch:>6}{'yes' if padded else 'no':>8}{timings['default']:>14.2f}{timings['sdpa']:>11.2f}"
+                  f"{timings['default'] / timings['sdpa']:>8.2f}x")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,132 @@
+"""
+Eager against torch.compile (compiled_decoding.CompiledDecoder, Trainer(compile_mode=...)):
+compile time, agreement of greedy chords, padded batch decoding latency at several batch sizes
+and training throughput of one epoch.
+
+python3 benchmarks/compile_benchmark.py [--model path] [--mode default] [--batch-sizes 1 64] [--train-batches N]
+"""
+import argparse
+import copy
+import os
+import random
+import sys
+import time
+
+import torch
+from torch.optim.lr_scheduler import LambdaLR
+from torch.utils.data import DataLoader
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import batch_harmonizer
+from compiled_decoding import compiled_decoder, COMPILE_MODES
+from decoding import GREEDY
+from mapped_checkpoint import checkpoint_model, load_checkpoint
+from song_dataloader import Song_Dataloader
+from Trainer.trainer import Trainer
+
+
+def random_melodies(count, seed=0):
+    """Melodies of 2 to 8 bars, as harmonize_many takes them"""
+    rng = random.Random(seed)
+    melodies = []
+    for _ in range(count):
+        frames = rng.randint(32, 128)
+        melody = []
+        while frames > 0:
+            duration = min(frames, rng.choice([1, 2, 4, 8]))
+            melody.append([rng.randint(55, 80), duration])
+            frames -= duration
+        melodies.append(melody)
+    return melodies
+
+
+def time_ms(function, repeats):
+    timings = []
+    for _ in range(repeats):
+        start = time.perf_counter()
+        function()
+        timings.append((time.perf_counter() - start) * 1000)
+    timings.sort()
+    return timings[len(timings) // 2]
+
+
+def training_throughput(model, examples, collate_fn, device, batch_size, compile_mode):
+    """Phrases per second of the second epoch (the first one compiles), and the first epoch's seconds"""
+    student = copy.deepcopy(model).train()
+    optimizer = torch.optim.Adam(student.parameters(), amsgrad=True, lr=1e-4)
+    trainer = Trainer(student, optimizer, torch.nn.CrossEntropyLoss(),
+                      DataLoader(examples, batch_size=batch_size, collate_fn=collate_fn), None, device,
+                      LambdaLR(optimizer, lambda epoch: 1.0), compile_mode=compile_mode)
+    start = time.perf_counter()
+    trainer.run_epoch()
+    first_epoch = time.perf_counter() - start
+    start = time.perf_counter()
+    trainer.run_epoch()
+    return len(examples) / (time.perf_counter() - start), first_epoch
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark torch.compile against eager decoding and training")
+    parser.add_argument("--model", default="Saved_Models/pretrained_model.pth")
+    parser.add_argument("--mode", default="default", choices=list(COMPILE_MODES))
+    parser.add_argument("--batch-sizes", type=int, nargs="+", default=[1, 64])
+    parser.add_argument("--phrases", type=int, default=256, help="melodies of the parity check")
+    parser.add_argument("--repeats", type=int, default=10)
+    parser.add_argument("--train-batches", type=int, default=10)
+    parser.add_argument("--train-batch-size", type=int, default=64)
+    parser.add_argument("--device", default="cpu")
+    args = parser.parse_args()
+
+    device = torch.device(args.device)
+    checkpoint = load_checkpoint(args.model, device)
+    loader = Song_Dataloader.for_checkpoint(checkpoint)
+    train_dataloader, _, chord2in, in2chord, note2in, _ = loader.load()
+    model = checkpoint_model(checkpoint, device)
+    melodies = random_melodies(args.phrases)
+    encoded = [batch_harmonizer.encode_frames(melody, note2in) for melody in melodies]
+
+    print(f"model {args.model}, device {device}, compile mode {args.mode}")
+
+    # compile time, then greedy parity over all batch sizes the benchmark uses
+    compiled = compiled_decoder(model, args.mode)
+    start = time.perf_counter()
+    compiled.warmup(args.batch_sizes)
+    print(f"compile + warmup: {time.perf_counter() - start:.1f}s")
+
+    agree = total = 0
+    for batch in batch_harmonizer.bucket_batches(encoded, max(args.batch_sizes)):
+        phrases = [encoded[i] for i in batch]
+        eager = batch_harmonizer.harmonize_padded_batch(model, phrases, chord2in, in2chord, decode_mode=GREEDY)
+        fast = batch_harmonizer.harmonize_padded_batch(model, phrases, chord2in, in2chord, decode_mode=GREEDY,
+                                                       compile_mode=args.mode)
+        agree += sum(a == b for eager_chords, fast_chords in zip(eager, fast) for a, b in zip(eager_chords, fast_chords))
+        total += sum(len(chords) for chords in eager)
+    print(f"greedy chords identical to eager: {agree / total:.2%} of {total}")
+
+    print(f"\n{'batch':>6}{'eager (ms)':>12}{'compiled (ms)':>15}{'speedup':>9}")
+    for batch_size in args.batch_sizes:
+        # longest phrases: 8 bars, every call decodes 16 chords
+        phrases = [encoded[i] for i in sorted(range(len(encoded)), key=lambda i: -len(encoded[i]))[:batch_size]]
+        phrases = (phrases * batch_size)[:batch_size]
+        timings = {}
+        for name, mode in (('eager', None), ('compiled', args.mode)):
+            # both runs use the encoder cache, so only decoding is compared
+            timings[name] = time_ms(lambda: batch_harmonizer.harmonize_padded_batch(
+                model, phrases, chord2in, in2chord, decode_mode=GREEDY, compile_mode=mode), args.repeats)
+        print(f"{batch_size:>6}{timings['eager']:>12.2f}{timings['compiled']:>15.2f}"
+              f"{timings['eager'] / timings['compiled']:>8.2f}x")
+
+    examples = [train_dataloader.dataset[i]
+                for i in range(min(len(train_dataloader.dataset), args.train_batches * args.train_batch_size))]
+    eager_rate, _ = training_throughput(model, examples, train_dataloader.collate_fn, device,
+                                        args.train_batch_size, None)
+    compiled_rate, compile_epoch = training_throughput(model, examples, train_dataloader.collate_fn, device,
+                                                       args.train_batch_size, args.mode)
+    print(f"\ntraining ({len(examples)} phrases, batch {args.train_batch_size}): eager {eager_rate:.1f} phrases/s, "
+          f"compiled {compiled_rate:.1f} phrases/s ({compiled_rate / eager_rate:.2f}x, first compiled epoch "
+          f"{compile_epoch:.1f}s)")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,124 @@
+"""
+Scaling of data-parallel training (Trainer/distributed.py, gloo) over 1/2/4/8 processes on this
+machine: training phrases per second, speedup and efficiency (speedup / processes) of one epoch
+over synthetic phrases shaped like the dataset (129 melody frames, SOS + 16 chords + EOS).
+
+Strong scaling (default) keeps the global batch, --weak keeps the batch per process and grows the
+epoch with the number of processes. Model sizes come from config.json.
+
+python3 benchmarks/distributed_scaling.py [--processes 1 2 4 8] [--examples 2048] [--batch-size 128] [--weak]
+"""
+import argparse
+import json
+import os
+import socket
+import sys
+import tempfile
+import time
+
+import torch
+from torch.optim.lr_scheduler import LambdaLR
+from torch.utils.data import DataLoader
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.append(ROOT)
+
+from Model.Transformer import Transformer
+from Trainer.distributed import init_distributed, launch
+from Trainer.trainer import Trainer, _collate
+
+INPUT_FRAMES = 129
+TARGET_TOKENS = 18
+
+
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+def synthetic_phrases(count, note_vocab, chord_vocab):
+    generator = torch.Generator().manual_seed(0)
+    inputs = torch.randint(0, note_vocab, (count, INPUT_FRAMES), generator=generator)
+    targets = torch.randint(3, chord_vocab, (count, TARGET_TOKENS), generator=generator)
+    return list(zip(inputs.tolist(), targets.tolist()))
+
+
+def worker(args):
+    distributed = init_distributed()
+    with open(os.path.join(ROOT, "config.json"), "r") as json_file:
+        config = json.load(json_file)
+
+    torch.manual_seed(0)
+    model = Transformer(inputVocab=args.note_vocab, outputVocab=args.chord_vocab,
+                        input_embedding_dim=config["input_embedding_dim"],
+                        output_embedding_dim=config["output_embedding_dim"], num_heads=config["num_heads"],
+                        num_encoder_layers=config["num_layers"], num_decoder_layers=config["num_layers"],
+                        dropout_p=config["dropout_p"], dim_feedforward=config["dim_feedforward"])
+    optimizer = torch.optim.Adam(model.parameters(), amsgrad=True, lr=config["lr"])
+
+    scale = distributed.world_size if args.weak else 1
+    examples = synthetic_phrases(args.examples * scale, args.note_vocab, args.chord_vocab)
+    train_dataloader = distributed.shard(DataLoader(examples, batch_size=args.batch_size * scale,
+                                                    collate_fn=_collate))
+    trainer = Trainer(model, optimizer, torch.nn.CrossEntropyLoss(), train_dataloader, None, torch.device("cpu"),
+                      LambdaLR(optimizer, lambda epoch: 1.0), distributed=distributed)
+
+    # first epoch warms up allocator, kernels and gloo buffers
+    trainer.run_epoch()
+    distributed.barrier()
+    start = time.perf_counter()
+    trainer.run_epoch()
+    distributed.barrier()
+    elapsed = time.perf_counter() - start
+
+    if distributed.is_main:
+        with open(args.out, "w") as out_file:
+            json.dump({'processes': distributed.world_size, 'phrases': len(examples), 'seconds': elapsed,
+                       'threads_per_process': torch.get_num_threads()}, out_file)
+    distributed.close()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Data-parallel training scaling benchmark")
+    parser.add_argument("--processes", type=int, nargs="+", default=[1, 2, 4, 8])
+    parser.add_argument("--examples", type=int, default=2048, help="phrases per epoch (per process with --weak)")
+    parser.add_argument("--batch-size", type=int, default=128, help="global batch (per process with --weak)")
+    parser.add_argument("--weak", action="store_true", help="weak scaling instead of strong scaling")
+    parser.add_argument("--note-vocab", type=int, default=15)
+    parser.add_argument("--chord-vocab", type=int, default=244)
+    parser.add_argument("--worker", action="store_true", help=argparse.SUPPRESS)
+    parser.add_argument("--out", help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.worker:
+        worker(args)
+        return
+
+    print(f"{os.cpu_count()} cores, {'weak' if args.weak else 'strong'} scaling, "
+          f"{args.examples} phrases, batch {args.batch_size}")
+    print(f"{'processes':>10}{'threads':>9}{'phrases/s':>11}{'speedup':>9}{'efficiency':>12}")
+    baseline = None
+    for processes in args.processes:
+        with tempfile.TemporaryDirectory() as directory:
+            out = os.path.join(directory, "result.json")
+            worker_args = [os.path.abspath(__file__), "--worker", "--out", out, "--examples", str(args.examples),
+                           "--batch-size", str(args.batch_size), "--note-vocab", str(args.note_vocab),
+                           "--chord-vocab", str(args.chord_vocab)] + (["--weak"] if args.weak else [])
+            if launch(worker_args, processes, master_port=free_port()) != 0:
+                print(f"{processes:>10}  failed")
+                continue
+            with open(out, "r") as result_file:
+                result = json.load(result_file)
+
+        rate = result['phrases'] / result['seconds']
+        if baseline is None:
+            # relative to one process (the first run, taken as linear if it used more)
+            baseline = rate / processes
+        speedup = rate / baseline
+        print(f"{processes:>10}{result['threads_per_process']:>9}{rate:>11.1f}{speedup:>9.2f}"
+              f"{speedup / processes:>12.0%}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,139 @@
+"""
+fp32 against bf16 autocast (Transformer.set_precision): parity of the validation split
+(loss, chord accuracy, agreement of the predicted chords) and throughput of greedy inference
+and of training steps. bf16 only pays off on CPUs with native bf16 matmuls (AVX-512-BF16 / AMX)
+and on models large enough for matmuls to dominate; elsewhere autocast adds cast overhead.
+
+python3 benchmarks/precision_benchmark.py [--model path] [--batch-sizes 1 64] [--train-batches N]
+"""
+import argparse
+import copy
+import os
+import sys
+import time
+
+import torch
+from torch.optim.lr_scheduler import LambdaLR
+from torch.utils.data import DataLoader
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from Model.Transformer import PRECISIONS
+from Trainer.trainer import Trainer, evaluate
+from mapped_checkpoint import checkpoint_model, load_checkpoint
+from song_dataloader import Song_Dataloader, SOS_TOKEN
+
+
+def native_bf16():
+    return torch.backends.mkldnn.is_available() and torch.ops.mkldnn._is_mkldnn_bf16_supported()
+
+
+def greedy_decode(model, src, sos_token, length):
+    """Greedy chords [batch, length] for teacher-free comparison of two precisions"""
+    with torch.inference_mode():
+        memory = model.encode(src)
+        tokens = torch.full((src.size(0), length + 1), sos_token, dtype=torch.long, device=src.device)
+        for step in range(1, length + 1):
+            output = model.decode(tokens[:, :step], memory, model.get_tgt_mask(step, src.device))
+            tokens[:, step] = output[:, -1].argmax(dim=-1)
+    return tokens[:, 1:]
+
+
+def teacher_forced_predictions(model, dataloader, device):
+    predictions = []
+    with torch.inference_mode():
+        for inputs, targets in dataloader:
+            inputs, targets = inputs.to(device), targets.to(device)
+            target_input = targets[:, :-1]
+            output = model(inputs, target_input, model.get_tgt_mask(target_input.size(1), device))
+            predictions.append(output.argmax(dim=-1))
+    return torch.cat(predictions)
+
+
+def time_ms(function, repeats):
+    function()
+    timings = []
+    for _ in range(repeats):
+        start = time.perf_counter()
+        function()
+        timings.append((time.perf_counter() - start) * 1000)
+    timings.sort()
+    return timings[len(timings) // 2]
+
+
+def training_throughput(model, examples, collate_fn, device, precision, batch_size):
+    """Phrases per second of one Trainer epoch over examples, on a copy of model"""
+    student = copy.deepcopy(model).set_precision(precision).train()
+    optimizer = torch.optim.Adam(student.parameters(), amsgrad=True, lr=1e-4)
+    trainer = Trainer(student, optimizer, torch.nn.CrossEntropyLoss(),
+                      DataLoader(examples, batch_size=batch_size, collate_fn=collate_fn), None, device,
+                      LambdaLR(optimizer, lambda epoch: 1.0), precision=precision)
+    # first epoch warms up allocator and kernels
+    trainer.run_epoch()
+    start = time.perf_counter()
+    trainer.run_epoch()
+    return len(examples) / (time.perf_counter() - start)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Parity and throughput of bf16 autocast against fp32")
+    parser.add_argument("--model", default="Saved_Models/pretrained_model.pth")
+    parser.add_argument("--batch-sizes", type=int, nargs="+", default=[1, 64])
+    parser.add_argument("--repeats", type=int, default=10)
+    parser.add_argument("--train-batches", type=int, default=20)
+    parser.add_argument("--train-batch-size", type=int, default=64)
+    parser.add_argument("--device", default="cpu")
+    args = parser.parse_args()
+
+    device = torch.device(args.device)
+    checkpoint = load_checkpoint(args.model, device)
+    loader = Song_Dataloader.for_checkpoint(checkpoint)
+    train_dataloader, test_dataloader, chord2in, _, _, _ = loader.load()
+    model = checkpoint_model(checkpoint, device)
+    groups = loader.split_dataset_names()[1]
+    eval_dataloader = DataLoader(test_dataloader.dataset, batch_size=512, collate_fn=test_dataloader.collate_fn)
+    sos_token = chord2in[SOS_TOKEN]
+
+    print(f"model {args.model}, device {device}, native bf16 matmul: {native_bf16()}")
+
+    # parity on the validation split
+    metrics, predictions, decoded = {}, {}, {}
+    src = torch.tensor([inputs for inputs, _ in test_dataloader.dataset], device=device)
+    chords = len(test_dataloader.dataset[0][1]) - 2
+    for precision in PRECISIONS:
+        model.set_precision(precision)
+        metrics[precision] = evaluate(model, eval_dataloader, device, groups)
+        predictions[precision] = teacher_forced_predictions(model, eval_dataloader, device)
+        decoded[precision] = torch.cat([greedy_decode(model, src[start:start + 512], sos_token, chords)
+                                        for start in range(0, src.size(0), 512)])
+
+    print(f"\nvalidation split ({metrics['fp32']['examples']} phrases)")
+    print(f"{'':<10}{'loss':>10}{'accuracy':>10}")
+    for precision, result in metrics.items():
+        print(f"{precision:<10}{result['loss']:>10.4f}{result['accuracy']:>10.4f}")
+    teacher_forced = (predictions['fp32'] == predictions['bf16']).float().mean().item()
+    greedy = (decoded['fp32'] == decoded['bf16']).float()
+    print(f"chord agreement bf16 vs fp32: teacher-forced {teacher_forced:.2%}, greedy decoding "
+          f"{greedy.mean().item():.2%} of chords, {greedy.all(dim=1).float().mean().item():.2%} of phrases identical")
+
+    # greedy inference throughput
+    print(f"\n{'batch':>6}{'fp32 (ms)':>11}{'bf16 (ms)':>11}{'speedup':>9}")
+    for batch in args.batch_sizes:
+        timings = {}
+        for precision in PRECISIONS:
+            model.set_precision(precision)
+            timings[precision] = time_ms(lambda: greedy_decode(model, src[:batch], sos_token, chords), args.repeats)
+        print(f"{batch:>6}{timings['fp32']:>11.2f}{timings['bf16']:>11.2f}{timings['fp32'] / timings['bf16']:>8.2f}x")
+
+    # training throughput
+    examples = [train_dataloader.dataset[i]
+                for i in range(min(len(train_dataloader.dataset), args.train_batches * args.train_batch_size))]
+    rates = {precision: training_throughput(model, examples, train_dataloader.collate_fn,
+                                            device, precision, args.train_batch_size)
+             for precision in PRECISIONS}
+    print(f"\ntraining ({len(examples)} phrases, batch {args.train_batch_size}): fp32 {rates['fp32']:.1f} phrases/s, "
+          f"bf16 {rates['bf16']:.1f} phrases/s ({rates['bf16'] / rates['fp32']:.2f}x)")
+
+
+if __name__ == "__main__":
+    main()
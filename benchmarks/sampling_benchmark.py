@@ -0,0 +1,77 @@
+"""
+Microbenchmark of one decoding step's sampling: the per-row path harmonize_melody used
+(evaluation_helpers.top_k_sampling, softmax, multinomial, .item(), torch.tensor, torch.cat)
+against decoding.sample_tokens writing a whole batch into a preallocated token buffer.
+
+python3 benchmarks/sampling_benchmark.py [--vocab V] [--k K] [--steps S] [--batch-sizes 1 8 64] [--device cpu]
+"""
+import argparse
+import os
+import sys
+import time
+
+import torch
+import torch.nn.functional as F
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import evaluation_helpers
+from decoding import sample_tokens
+
+
+def per_row_sampling(logits_per_step, temperature, k, device):
+    """The previous loop: one row at a time, host round trip and concatenation every step"""
+    batch = logits_per_step[0].size(0)
+    rows = [torch.zeros((1, 1), dtype=torch.long, device=device) for _ in range(batch)]
+    for logits in logits_per_step:
+        for row in range(batch):
+            output = logits[row:row + 1] / temperature
+            probabilities = F.softmax(evaluation_helpers.top_k_sampling(output, k, device), dim=-1)
+            next_item = torch.tensor([[torch.multinomial(probabilities, 1).item()]], device=device)
+            rows[row] = torch.cat((rows[row], next_item), dim=1)
+    return torch.cat(rows)
+
+
+def fused_sampling(logits_per_step, temperature, k, device):
+    batch = logits_per_step[0].size(0)
+    tokens = torch.zeros((batch, len(logits_per_step) + 1), dtype=torch.long, device=device)
+    for step, logits in enumerate(logits_per_step):
+        sample_tokens(logits, temperature, k, out=tokens[:, step + 1:step + 2])
+    return tokens
+
+
+def time_ms(function, *args, repeats=20):
+    function(*args)
+    timings = []
+    for _ in range(repeats):
+        start = time.perf_counter()
+        function(*args)
+        if args[-1].type == 'cuda':
+            torch.cuda.synchronize()
+        timings.append((time.perf_counter() - start) * 1000)
+    timings.sort()
+    return timings[len(timings) // 2]
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark batched fused sampling against per-row sampling")
+    parser.add_argument("--vocab", type=int, default=244)
+    parser.add_argument("--k", type=int, default=20)
+    parser.add_argument("--temperature", type=float, default=1.0)
+    parser.add_argument("--steps", type=int, default=16, help="chords per phrase")
+    parser.add_argument("--batch-sizes", type=int, nargs="+", default=[1, 8, 64])
+    parser.add_argument("--device", default="cuda" if torch.cuda.is_available() else "cpu")
+    args = parser.parse_args()
+
+    device = torch.device(args.device)
+    print(f"vocab {args.vocab}, k {args.k}, {args.steps} steps per phrase, device {device}")
+    print(f"{'batch':>6}{'per-row (ms)':>14}{'fused (ms)':>12}{'speedup':>9}")
+    for batch in args.batch_sizes:
+        logits_per_step = [torch.randn(batch, args.vocab, device=device) for _ in range(args.steps)]
+        per_row = time_ms(per_row_sampling, logits_per_step, args.temperature, args.k, device)
+        fused = time_ms(fused_sampling, logits_per_step, args.temperature, args.k, device)
+        print(f"{batch:>6}{per_row:>14.2f}{fused:>12.2f}{per_row / fused:>8.1f}x")
+
+
+if __name__ == "__main__":
+    main()
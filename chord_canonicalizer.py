@@ -0,0 +1,258 @@
+"""
+Chord-name parsing and repair shared by the training loader, the CLI/DAW output and the
+server. Patterns are compiled once and every function is memoized per chord string, so
+repeated chords of a phrase (and of every request) cost a dictionary lookup.
+"""
+import re
+from collections import namedtuple
+from functools import lru_cache
+
+DEFAULT_CHORD = 'C'
+SPECIAL_TOKENS = ('<EOS>', '<SOS>', '<PAD>', '<UNK>', '<MASK>', '<START>', '<END>')
+
+# root as the server spells it (# or b), and as music21 spells it (# or -)
+ROOT = re.compile(r'^([A-G][#b]?)')
+# quality runs up to a space or a '/<bass>' ('C6/9' keeps its '/9')
+CHORD = re.compile(r'^(?P<root>[A-G](?:[#-]+|b)?)(?P<quality>(?:[^\s/]|/(?![A-G]))*)'
+                   r'(?:/(?P<bass>[A-G](?:[#-]+|b)?))?(?P<rest>.*)$')
+# words after the quality/bass, an extension keeping its degree ('add b9', 'alter #5')
+EXTENSION = re.compile(r'(?:add|alter|subtract|omit)\s*[#b]?\d+|\S+')
+
+ChordRecord = namedtuple('ChordRecord', ['root', 'quality', 'extensions', 'bass'])
+ChordRecord.__doc__ = """
+Parsed chord name, e.g. 'Dm7/C alter b5' -> ChordRecord('D', 'm7', ('alter b5',), 'C')
+
+- root/bass: note spelling as written, bass is None for root position chords
+- quality: symbol between root and bass/extensions as written ('', 'm', 'maj7', 'o7', '+', '6/9', ...)
+- extensions: words after the quality/bass in order of appearance ('add b9', 'alter #5', 'subtract 3', 'pedal', ...)
+"""
+
+# evaluation_helpers.fixChordName: music21-style names -> names music21.harmony.ChordSymbol accepts
+SPELLING_FIXES = [(re.compile(pattern), replacement) for pattern, replacement in [
+    (r'sus add 7', r'7 sus4'),
+    (r'add 4 subtract 3', r'sus4'),
+    (r'\balter\b', ''),
+    (r'\badd\s*b9', r'b9'),
+    (r'\badd\s*b13', r'b13'),
+    (r'\badd\s*#9', r'#9'),
+    (r'\badd\s*#11', r'#11'),
+    # 'sus ' -> 'sus4 '
+    (r'sus\s', r'sus4 '),
+    (r'sus/\s', r'sus4/'),
+    (r'sus47\s', r'sus4 '),
+    (r'add\s*7', r'7'),
+    (r'pedal', r' '),
+    (r'subtract', r'omit'),
+]]
+
+# server standardize_chord_name: common typos of hand-written or generated names
+STANDARD_FIXES = [(re.compile(pattern), replacement) for pattern, replacement in [
+    # Amm7 -> Am7, Dmm -> Dm7
+    (r'([A-G][#b]?)mm(\d*)', lambda m: f"{m.group(1)}m{m.group(2) if m.group(2) else '7'}"),
+    # C##7 -> C#7, Bbb -> Bb
+    (r'([A-G])##', r'\1#'),
+    (r'([A-G])bb', r'\1b'),
+    # CM -> Cmaj, C_maj -> Cmaj
+    (r'([A-G][#b]?)M(\d*)', r'\1maj\2'),
+    (r'([A-G][#b]?)_maj', r'\1maj'),
+    # Cmin -> Cm, C_min -> Cm
+    (r'([A-G][#b]?)min(\d*)', r'\1m\2'),
+    (r'([A-G][#b]?)_min', r'\1m'),
+    # C7m -> Cm7
+    (r'([A-G][#b]?)(\d+)m', r'\1m\2'),
+    # Caug -> C+, Cdim -> C°
+    (r'([A-G][#b]?)aug', r'\1+'),
+    (r'([A-G][#b]?)dim', r'\1°'),
+    (r'[^\w#b+°]', ''),
+]]
+
+VALID_SUFFIXES = frozenset([
+    '', 'maj', 'm', 'min',
+    '7', 'maj7', 'm7', 'min7',
+    'dim', 'dim7', '°', '°7',
+    'aug', '+', '+7',
+    '9', 'maj9', 'm9',
+    '11', '13',
+    'sus2', 'sus4',
+    '6', 'm6', 'maj6',
+    'add9', 'add11',
+])
+
+# qualities of triads without sevenths or extensions: C, Cm, CM, Cmaj, Cmin, Cdim, Caug (and #/b roots)
+SIMPLE_QUALITIES = frozenset(['', 'm', 'M', 'maj', 'min', 'dim', 'aug'])
+
+# pitch classes of the roots the fallback suggestions know about
+ROOT_PITCH_CLASS = {'C': 0, 'C#': 1, 'D': 2, 'D#': 3, 'E': 4, 'F': 5,
+                    'F#': 6, 'G': 7, 'G#': 8, 'A': 9, 'A#': 10, 'B': 11}
+
+
+def is_special_token(chord):
+    return chord in SPECIAL_TOKENS or (chord.startswith('<') and chord.endswith('>'))
+
+
+@lru_cache(maxsize=None)
+def parse(chord):
+    """
+    Returns:
+    ChordRecord of a chord name as written (callers strip it), None for special tokens and
+    names without a root
+    """
+    if is_special_token(chord):
+        return None
+    match = CHORD.match(chord)
+    if not match:
+        return None
+    extensions = tuple(EXTENSION.findall(match.group('rest')))
+    return ChordRecord(match.group('root'), match.group('quality'), extensions, match.group('bass'))
+
+
+def format_record(record):
+    """Inverse of parse for names in music21 spelling (single spaces, extensions after the bass)"""
+    name = record.root + record.quality
+    if record.bass:
+        name += '/' + record.bass
+    return ' '.join([name, *record.extensions])
+
+
+def vocabulary_records(in2chord):
+    """Parses a whole chord vocabulary once: chord id -> ChordRecord (None for special tokens)"""
+    return {chord_id: parse(chord) for chord_id, chord in in2chord.items()}
+
+
+def _parse_exact(chord):
+    """ChordRecord of chord if format_record gives chord back unchanged, else None"""
+    record = parse(chord)
+    return record if record is not None and format_record(record) == chord else None
+
+
+def _server_root(record):
+    """Root of a record as the server spells it ('B-' -> 'B', 'C##' -> 'C#')"""
+    return ROOT.match(record.root).group(1)
+
+
+def _repair_text(text):
+    for pattern, replacement in SPELLING_FIXES:
+        text = pattern.sub(replacement, text)
+    return text
+
+
+@lru_cache(maxsize=None)
+def repair_spelling(chord):
+    """
+    Spelling repairs that let music21 parse every chord of the vocabulary. The repairs rewrite
+    the words after the root, the result is parsed again and formatted with single spaces
+    ('Dm7/C alter b5' -> 'Dm7/C b5'); names parse cannot give back unchanged are repaired as text.
+    """
+    record = _parse_exact(chord)
+    if record is None:
+        return _repair_text(chord)
+    repaired = parse(record.root + _repair_text(chord[len(record.root):]).rstrip())
+    return format_record(repaired)
+
+
+def clean_format(chord_name):
+    """Only fixes obvious format errors (Dmm7 -> Dm7), the chord itself is unchanged"""
+    if not chord_name or not isinstance(chord_name, str):
+        return DEFAULT_CHORD
+    return _clean_format(chord_name)
+
+
+@lru_cache(maxsize=None)
+def _clean_format(chord_name):
+    chord = chord_name.strip()
+
+    # leave dim chords alone
+    if 'mm' in chord and 'dim' not in chord:
+        chord = chord.replace('mm', 'm')
+
+    if parse(chord) is None:
+        return DEFAULT_CHORD
+    return chord
+
+
+def standardize(chord_name):
+    """
+    Repairs common naming errors ('Amm7' -> 'Am7', 'CM7' -> 'Cmaj7', 'C7m' -> 'Cm7', ...).
+
+    Returns:
+    the repaired name, DEFAULT_CHORD for empty input and special tokens, or None if
+    the repaired name does not start with a chord root
+    """
+    if not chord_name or not isinstance(chord_name, str):
+        return DEFAULT_CHORD
+    return _standardize(chord_name)
+
+
+@lru_cache(maxsize=None)
+def _standardize(chord_name):
+    chord = chord_name.strip()
+    if is_special_token(chord):
+        return DEFAULT_CHORD
+
+    for pattern, replacement in STANDARD_FIXES:
+        chord = pattern.sub(replacement, chord)
+
+    record = parse(chord)
+    return format_record(record) if record is not None else None
+
+
+@lru_cache(maxsize=None)
+def chord_root(chord):
+    """Root of a chord name, DEFAULT_CHORD if there is none"""
+    record = parse(chord)
+    return _server_root(record) if record is not None else DEFAULT_CHORD
+
+
+@lru_cache(maxsize=None)
+def chord_quality(chord):
+    """
+    'major', 'minor', 'diminished' or 'augmented'. Any 'm' after the root counts as minor, so
+    'Cmaj' and 'Cdim' are minor here, the seventh suggestions have always relied on this.
+    """
+    record = parse(chord)
+    if record is None:
+        description = chord.lower()
+    else:
+        description = ' '.join([record.quality, *record.extensions]).lower()
+    if 'm' in description:
+        return 'minor'
+    if 'dim' in description:
+        return 'diminished'
+    if 'aug' in description:
+        return 'augmented'
+    return 'major'
+
+
+def _is_plain(record):
+    """Root in server spelling, no bass and no extensions"""
+    return (record is not None and record.bass is None and not record.extensions
+            and _server_root(record) == record.root)
+
+
+@lru_cache(maxsize=None)
+def is_simple_triad(chord):
+    """Whether a chord is a plain triad that can be extended to a seventh chord"""
+    record = _parse_exact(chord.strip())
+    return _is_plain(record) and record.quality in SIMPLE_QUALITIES
+
+
+@lru_cache(maxsize=None)
+def is_valid_quality(chord):
+    """Whether a chord is a root followed by one of VALID_SUFFIXES"""
+    record = _parse_exact(chord)
+    return _is_plain(record) and record.quality in VALID_SUFFIXES
+
+
+@lru_cache(maxsize=None)
+def suggest_alternative(invalid_chord):
+    """Seventh chord on the same root: maj7 on C/F/G, m7 on D/E/A, dominant 7 elsewhere"""
+    record = parse(invalid_chord)
+    root = _server_root(record) if record is not None else None
+    if root in ROOT_PITCH_CLASS:
+        pitch_class = ROOT_PITCH_CLASS[root]
+        if pitch_class in (0, 5, 7):
+            return f"{root}maj7"
+        if pitch_class in (2, 4, 9):
+            return f"{root}m7"
+        return f"{root}7"
+    return 'Cmaj7'
@@ -0,0 +1,253 @@
+"""
+Rule-based chord post-processing (triad -> seventh enhancement, repeated-chord
+progressions) as lookup tables over chord ids. Every chord name is analysed once when it
+is first seen; afterwards whole sequences or batches are rewritten with NumPy indexing,
+so the cost per request does not grow with the number of chords or candidates.
+"""
+import threading
+from collections import namedtuple
+
+import numpy as np
+
+import chord_canonicalizer
+
+NOTE_CIRCLE = ['C', 'C#', 'D', 'D#', 'E', 'F', 'F#', 'G', 'G#', 'A', 'A#', 'B']
+ENHARMONIC = {'Db': 'C#', 'Eb': 'D#'}
+# key index used when the key (or a root) is not on NOTE_CIRCLE: every interval counts as 0
+UNKNOWN_KEY = len(NOTE_CIRCLE)
+
+QUALITIES = ('major', 'minor', 'diminished', 'augmented')
+SEVENTH_TYPES = ('maj7', '7', 'm7')
+MAJ7, DOMINANT7, MINOR7 = range(len(SEVENTH_TYPES))
+# major chords without a functional rule become dominant sevenths 30% of the time
+DOMINANT_PROBABILITY = 0.3
+
+# position classes: any chord but the last, the last chord
+MIDDLE, LAST = 0, 1
+
+# I-vi-IV-V progressions that replace a phrase repeating a single chord
+PROGRESSIONS = {
+    'C': ['Cmaj7', 'Am7', 'Fmaj7', 'G7'],
+    'G': ['Gmaj7', 'Em7', 'Cmaj7', 'D7'],
+    'D': ['Dmaj7', 'Bm7', 'Gmaj7', 'A7'],
+    'A': ['Amaj7', 'F#m7', 'Dmaj7', 'E7'],
+    'E': ['Emaj7', 'C#m7', 'Amaj7', 'B7'],
+    'F': ['Fmaj7', 'Dm7', 'Bbmaj7', 'C7'],
+}
+PROGRESSION_ROOTS = list(PROGRESSIONS)
+PROGRESSION_LENGTH = 4
+
+
+def _seventh_type_tables():
+    """
+    [quality, interval from key, position class] tables of the seventh type, the
+    alternative type and the probability of picking the alternative
+    """
+    primary = np.zeros((len(QUALITIES), 12, 2), dtype=np.int64)
+    alternative = np.zeros_like(primary)
+    probability = np.zeros(primary.shape, dtype=np.float64)
+    for quality in range(len(QUALITIES)):
+        minor = QUALITIES[quality] == 'minor'
+        for interval in range(12):
+            for position in (MIDDLE, LAST):
+                if interval == 7:
+                    seventh = DOMINANT7
+                elif interval in (0, 5) or minor:
+                    seventh = MINOR7 if minor else MAJ7
+                elif position == LAST:
+                    seventh = MAJ7
+                else:
+                    alternative[quality, interval, position] = DOMINANT7
+                    probability[quality, interval, position] = DOMINANT_PROBABILITY
+                    seventh = MAJ7
+                primary[quality, interval, position] = seventh
+                if not probability[quality, interval, position]:
+                    alternative[quality, interval, position] = seventh
+    return primary, alternative, probability
+
+
+SEVENTH_PRIMARY, SEVENTH_ALTERNATIVE, ALTERNATIVE_PROBABILITY = _seventh_type_tables()
+
+
+def key_index(key):
+    """Key name (only its first letter is used as key center) -> row of the key tables"""
+    key_center = key[0] if key else 'C'
+    return NOTE_CIRCLE.index(key_center) if key_center in NOTE_CIRCLE else UNKNOWN_KEY
+
+
+def root_pitch_class(root):
+    """Pitch class of a root on NOTE_CIRCLE, -1 if it is spelled otherwise"""
+    root = ENHARMONIC.get(root, root)
+    return NOTE_CIRCLE.index(root) if root in NOTE_CIRCLE else -1
+
+
+def interval_from_key(root, key):
+    key = key_index(key)
+    pitch_class = root_pitch_class(root)
+    if key == UNKNOWN_KEY or pitch_class < 0:
+        return 0
+    return (pitch_class - key) % 12
+
+
+def seventh_type(quality, interval, position_class, rng=None):
+    """Seventh type name for a chord quality at an interval from the key"""
+    quality = QUALITIES.index(quality) if quality in QUALITIES else 0
+    seventh = SEVENTH_PRIMARY[quality, interval, position_class]
+    probability = ALTERNATIVE_PROBABILITY[quality, interval, position_class]
+    if probability:
+        rng = np.random.default_rng() if rng is None else rng
+        if rng.random() < probability:
+            seventh = SEVENTH_ALTERNATIVE[quality, interval, position_class]
+    return SEVENTH_TYPES[seventh]
+
+
+def seventh_name(root, quality, seventh):
+    """Seventh chord on root: minor, diminished and augmented chords keep their own seventh"""
+    if quality == 'minor':
+        return f"{root}m7"
+    if quality == 'diminished':
+        return f"{root}dim7"
+    if quality == 'augmented':
+        return f"{root}aug7"
+    return f"{root}{seventh}"
+
+
+_Tables = namedtuple('_Tables', ['simple', 'primary', 'alternative', 'probability', 'progression'])
+
+
+class ChordTables:
+    """
+    Chord name <-> id mapping with the post-processing rules precomputed per id.
+
+    Parameters:
+    - chords: names to analyse up front (e.g. the cleaned model vocabulary), names seen
+        later are added on first use
+    """
+
+    def __init__(self, chords=()):
+        self._lock = threading.Lock()
+        self.chords = []
+        self.index = {}
+        # per chord id: simple triad, quality, root pitch class, seventh names, progression row
+        self._rows = {name: [] for name in ('simple', 'quality', 'root_pitch_class', 'sevenths', 'progression')}
+        self._tables = None
+        progression_chords = [chord for progression in PROGRESSIONS.values() for chord in progression]
+        self.progression_ids = self.encode(progression_chords).reshape(len(PROGRESSIONS), PROGRESSION_LENGTH)
+        self.encode(chords)
+
+    def encode(self, names):
+        """list of chord names -> int64 array of ids"""
+        names = list(names)
+        index = self.index
+        if any(name not in index for name in names):
+            with self._lock:
+                self._add([name for name in dict.fromkeys(names) if name not in self.index])
+            index = self.index
+        return np.fromiter((index[name] for name in names), dtype=np.int64, count=len(names))
+
+    def decode(self, ids):
+        return [self.chords[i] for i in ids]
+
+    def _add(self, names):
+        # copy on write: readers keep using the old index and tables until the new ones are complete
+        index = dict(self.index)
+        chords = list(self.chords)
+        rows = dict((name, list(values)) for name, values in self._rows.items())
+
+        # the seventh of a chord is itself a chord of the table, and can name new chords
+        pending = list(names)
+        while pending:
+            name = pending.pop()
+            if name in index:
+                continue
+            root = chord_canonicalizer.chord_root(name)
+            quality = chord_canonicalizer.chord_quality(name)
+            sevenths = [seventh_name(root, quality, seventh) for seventh in SEVENTH_TYPES]
+
+            index[name] = len(chords)
+            chords.append(name)
+            rows['simple'].append(chord_canonicalizer.is_simple_triad(name))
+            rows['quality'].append(QUALITIES.index(quality))
+            rows['root_pitch_class'].append(root_pitch_class(root))
+            rows['sevenths'].append(sevenths)
+            rows['progression'].append(PROGRESSION_ROOTS.index(root) if root in PROGRESSIONS else -1)
+            pending += [seventh for seventh in sevenths if seventh not in index]
+
+        self._tables = self._build(index, rows)
+        self._rows = rows
+        self.chords = chords
+        self.index = index
+
+    @staticmethod
+    def _build(index, rows):
+        quality = np.array(rows['quality'], dtype=np.int64)
+        pitch_class = np.array(rows['root_pitch_class'], dtype=np.int64)
+        sevenths = np.array([[index[name] for name in row] for row in rows['sevenths']], dtype=np.int64)
+
+        # interval [key, chord], the unknown key row and unknown roots count as interval 0
+        keys = np.arange(UNKNOWN_KEY + 1)[:, None]
+        interval = np.where((keys < UNKNOWN_KEY) & (pitch_class >= 0), (pitch_class - keys) % 12, 0)
+
+        # [key, position class, chord] -> id of the seventh chord
+        interval = interval[:, None, :]
+        positions = np.array([MIDDLE, LAST])[None, :, None]
+        chords = np.arange(len(quality))
+        primary = sevenths[chords, SEVENTH_PRIMARY[quality, interval, positions]]
+        alternative = sevenths[chords, SEVENTH_ALTERNATIVE[quality, interval, positions]]
+        probability = ALTERNATIVE_PROBABILITY[quality, interval, positions]
+
+        return _Tables(np.array(rows['simple'], dtype=bool), primary, alternative, probability,
+                       np.array(rows['progression'], dtype=np.int64))
+
+    def enhance_sevenths(self, ids, keys, lengths=None, probability=0.7, rng=None):
+        """
+        Turns simple triads into seventh chords chosen by their function in the key.
+
+        Parameters:
+        - ids: int array [batch, length] of chord ids
+        - keys: [batch] key indices (see key_index)
+        - lengths: [batch] number of valid chords per row, default the full length
+        - probability: (float) chance that a simple triad is enhanced
+        - rng: numpy Generator, seeded for reproducible output
+
+        Returns:
+        int array [batch, length] of chord ids
+        """
+        tables = self._tables
+        rng = np.random.default_rng() if rng is None else rng
+        ids = np.asarray(ids, dtype=np.int64)
+        batch, length = ids.shape
+        lengths = np.full(batch, length) if lengths is None else np.asarray(lengths)
+
+        keys = np.asarray(keys, dtype=np.int64)[:, None]
+        position = (np.arange(length)[None, :] == (lengths - 1)[:, None]).astype(np.int64)
+        uniform = rng.random((2, batch, length))
+
+        sevenths = np.where(uniform[1] < tables.probability[keys, position, ids],
+                            tables.alternative[keys, position, ids], tables.primary[keys, position, ids])
+        return np.where(tables.simple[ids] & (uniform[0] < probability), sevenths, ids)
+
+    def vary_repeated(self, ids, lengths=None):
+        """
+        Replaces phrases that repeat one chord (on a root of PROGRESSIONS) with the
+        I-vi-IV-V progression of that root, cut to at most PROGRESSION_LENGTH chords.
+
+        Returns:
+        (int array [batch, length] of chord ids, [batch] new lengths)
+        """
+        tables = self._tables
+        ids = np.asarray(ids, dtype=np.int64)
+        batch, length = ids.shape
+        lengths = np.full(batch, length) if lengths is None else np.asarray(lengths)
+        if length == 0:
+            return ids, lengths
+
+        valid = np.arange(length)[None, :] < lengths[:, None]
+        repeated = np.all((ids == ids[:, :1]) | ~valid, axis=1) & (lengths > 1)
+        progression = tables.progression[ids[:, 0]]
+        replace = repeated & (progression >= 0)
+
+        ids = ids.copy()
+        columns = min(length, PROGRESSION_LENGTH)
+        ids[replace, :columns] = self.progression_ids[progression[replace], :columns]
+        return ids, np.where(replace, np.minimum(lengths, PROGRESSION_LENGTH), lengths)
@@ -0,0 +1,143 @@
+import json
+import queue
+import threading
+import time
+
+
+def format_sse(event, payload):
+    """Formats one Server-Sent Events message"""
+    return f"event: {event}\ndata: {json.dumps(payload)}\n\n"
+
+
+class StreamChannel:
+    """
+    One Server-Sent Events connection of a client. Several harmonization streams
+    (identified by stream_id) are multiplexed over it; every event carries its stream_id.
+    """
+
+    def __init__(self, client_id):
+        self.client_id = client_id
+        self.events = queue.Queue()
+        self.cancel_events = {}  # stream_id -> threading.Event
+        self.lock = threading.Lock()
+        self.closed = False
+
+    def publish(self, event, payload):
+        if not self.closed:
+            self.events.put(format_sse(event, payload))
+
+    def start_stream(self, stream_id):
+        with self.lock:
+            previous = self.cancel_events.get(stream_id)
+            if previous is not None:
+                # reusing a stream id replaces the stream still running under it
+                previous.set()
+            cancel_event = threading.Event()
+            self.cancel_events[stream_id] = cancel_event
+            return cancel_event
+
+    def finish_stream(self, stream_id, cancel_event):
+        with self.lock:
+            if self.cancel_events.get(stream_id) is cancel_event:
+                del self.cancel_events[stream_id]
+
+    def cancel(self, stream_id=None):
+        """Cancels one stream, or every stream of the channel if stream_id is None"""
+        with self.lock:
+            if stream_id is None:
+                targets = list(self.cancel_events.values())
+            else:
+                targets = [self.cancel_events[stream_id]] if stream_id in self.cancel_events else []
+        for cancel_event in targets:
+            cancel_event.set()
+        return len(targets)
+
+    def close(self):
+        self.closed = True
+        self.cancel()
+
+    def iter_events(self, heartbeat_seconds=15.0):
+        """Yields SSE messages until the channel is closed, with comment heartbeats while idle"""
+        yield format_sse('open', {'client_id': self.client_id})
+        try:
+            while not self.closed:
+                try:
+                    yield self.events.get(timeout=heartbeat_seconds)
+                except queue.Empty:
+                    yield ": heartbeat\n\n"
+        finally:
+            self.close()
+
+
+class StreamHub:
+    """
+    Registry of open stream channels per client plus time-to-first-chord statistics.
+    """
+
+    def __init__(self):
+        self._channels = {}
+        self._lock = threading.Lock()
+
+        self.streams_started = 0
+        self.streams_completed = 0
+        self.streams_cancelled = 0
+        self.streams_failed = 0
+        self._first_chord_ms = []
+        self._total_ms = []
+
+    def open(self, client_id):
+        with self._lock:
+            previous = self._channels.get(client_id)
+            if previous is not None:
+                previous.close()
+            channel = StreamChannel(client_id)
+            self._channels[client_id] = channel
+            return channel
+
+    def get(self, client_id, create=True):
+        with self._lock:
+            channel = self._channels.get(client_id)
+            if channel is None or channel.closed:
+                if not create:
+                    return None
+                channel = StreamChannel(client_id)
+                self._channels[client_id] = channel
+            return channel
+
+    def remove(self, channel):
+        with self._lock:
+            if self._channels.get(channel.client_id) is channel:
+                del self._channels[channel.client_id]
+
+    def begin(self):
+        with self._lock:
+            self.streams_started += 1
+        return time.monotonic()
+
+    def record(self, outcome, started_at, first_chord_at=None):
+        with self._lock:
+            if outcome == 'completed':
+                self.streams_completed += 1
+                self._total_ms.append((time.monotonic() - started_at) * 1000)
+            elif outcome == 'cancelled':
+                self.streams_cancelled += 1
+            else:
+                self.streams_failed += 1
+            if first_chord_at is not None:
+                self._first_chord_ms.append((first_chord_at - started_at) * 1000)
+
+            # keep a bounded window of recent latencies
+            del self._first_chord_ms[:-1000]
+            del self._total_ms[:-1000]
+
+    def stats(self):
+        with self._lock:
+            return {
+                'channels': len(self._channels),
+                'streams_started': self.streams_started,
+                'streams_completed': self.streams_completed,
+                'streams_cancelled': self.streams_cancelled,
+                'streams_failed': self.streams_failed,
+                'avg_time_to_first_chord_ms': sum(self._first_chord_ms) / len(self._first_chord_ms) if self._first_chord_ms else None,
+                'avg_total_ms': sum(self._total_ms) / len(self._total_ms) if self._total_ms else None,
+            }
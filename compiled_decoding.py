@@ -0,0 +1,114 @@
+"""
+Opt-in torch.compile'd decoding with shape-stable inputs. The eager loops decode a growing
+prefix (1, 2, ... chords) against memory as long as the melody, so every new shape would
+compile again. Here the chord prefix is padded to MAX_TOKENS (the causal mask keeps padding
+out of the positions that are read) and the encoder memory to MAX_FRAMES (masked with a key
+padding mask), so the decoder graph compiles once per batch size and is reused for every
+step and melody. Phrases longer than MAX_FRAMES fall back to eager decoding.
+"""
+import os
+import threading
+import time
+import weakref
+
+import torch
+
+# 8 bars of 16th-note frames + EOS, and one chord per half bar + SOS (the training shapes)
+MAX_FRAMES = 129
+MAX_TOKENS = 17
+
+COMPILE_MODES = ('default', 'reduce-overhead', 'max-autotune')
+
+
+class CompiledDecoder:
+    """
+    Parameters:
+    - model: harmony model in eval mode, its decode() is compiled
+    - mode: torch.compile mode, one of COMPILE_MODES
+    - max_frames/max_tokens: padded memory and chord buffer lengths
+    """
+
+    def __init__(self, model, mode='default', max_frames=MAX_FRAMES, max_tokens=MAX_TOKENS):
+        if mode not in COMPILE_MODES:
+            raise ValueError(f"unknown compile mode {mode!r}, expected one of {list(COMPILE_MODES)}")
+        self.model = model
+        self.mode = mode
+        self.max_frames = max_frames
+        self.max_tokens = max_tokens
+        self.device = next(model.parameters()).device
+        self.tgt_mask = model.get_tgt_mask(max_tokens, self.device)
+        self._decode = torch.compile(self._decode_padded, mode=mode, dynamic=False)
+        self.warm_batch_sizes = set()
+
+    def _decode_padded(self, tokens, memory, memory_key_padding_mask):
+        return self.model.decode(tokens, memory, self.tgt_mask, memory_key_padding_mask, tgt_is_causal=True)
+
+    def fits(self, frames, tokens):
+        """Whether a phrase of frames input frames and tokens chord tokens (with SOS) fits the buffers"""
+        return frames <= self.max_frames and tokens <= self.max_tokens
+
+    def pad_memory(self, memory, memory_key_padding_mask=None):
+        """
+        Returns:
+        (memory padded to [batch, max_frames, dim], key padding mask [batch, max_frames])
+        """
+        batch, frames, dim = memory.shape
+        padded = memory.new_zeros((batch, self.max_frames, dim))
+        padded[:, :frames] = memory
+        mask = torch.ones((batch, self.max_frames), dtype=torch.bool, device=memory.device)
+        mask[:, :frames] = False if memory_key_padding_mask is None else memory_key_padding_mask
+        return padded, mask
+
+    def decode_at(self, tokens, length, memory, memory_key_padding_mask):
+        """
+        Logits for the next chord after tokens[:, :length].
+
+        Parameters:
+        - tokens: [batch, >= length] chord ids, a [batch, max_tokens] buffer is used without copying
+        - memory/memory_key_padding_mask: from pad_memory
+
+        Returns:
+        [batch, vocab] logits
+        """
+        if tokens.size(1) != self.max_tokens:
+            padded = tokens.new_zeros((tokens.size(0), self.max_tokens))
+            padded[:, :length] = tokens[:, :length]
+            tokens = padded
+        return self._decode(tokens, memory, memory_key_padding_mask)[:, length - 1]
+
+    def warmup(self, batch_sizes=(1,)):
+        """Compiles the decoder graph for these batch sizes now instead of on the first request"""
+        for batch_size in batch_sizes:
+            if batch_size in self.warm_batch_sizes:
+                continue
+            start = time.perf_counter()
+            memory = torch.zeros((batch_size, self.max_frames, self.model.input_embedding_dim), device=self.device)
+            mask = torch.zeros((batch_size, self.max_frames), dtype=torch.bool, device=self.device)
+            tokens = torch.zeros((batch_size, self.max_tokens), dtype=torch.long, device=self.device)
+            with torch.no_grad():
+                self.decode_at(tokens, 1, memory, mask)
+            self.warm_batch_sizes.add(batch_size)
+            print(f"Compiled decoder ({self.mode}) for batch size {batch_size} in "
+                  f"{time.perf_counter() - start:.1f}s")
+        return self
+
+
+_decoders = weakref.WeakKeyDictionary()
+_decoders_lock = threading.Lock()
+
+
+def compiled_decoder(model, mode='default', cache_dir=None):
+    """
+    CompiledDecoder of model, built once per model and mode and shared by every caller.
+
+    Parameters:
+    - cache_dir: optional directory for inductor's on-disk cache of compiled kernels, so a
+        restarted process skips most of the compilation
+    """
+    if cache_dir:
+        os.environ.setdefault("TORCHINDUCTOR_CACHE_DIR", os.path.abspath(cache_dir))
+    with _decoders_lock:
+        decoders = _decoders.setdefault(model, {})
+        if mode not in decoders:
+            decoders[mode] = CompiledDecoder(model, mode)
+        return decoders[mode]
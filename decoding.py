@@ -0,0 +1,249 @@
+import threading
+
+import torch
+
+SAMPLE = 'sample'
+GREEDY = 'greedy'
+
+
+def sample_next_token(logits, temperature=1.0, top_k=20, decode_mode=SAMPLE, generator=None):
+    """
+    Picks the next chord token from the logits of the last decoder position.
+
+    Parameters:
+    - logits: (tensor) [batch_size, vocab] logits for the next token
+    - temperature: (float) lower = more conservative, higher = more creative
+    - top_k: (int) only the k most probable chords are sampled from, 0 disables the cut
+    - decode_mode: 'sample' (temperature + top-k sampling) or 'greedy' (argmax)
+    - generator: torch.Generator used for reproducible sampling
+
+    Returns:
+    tensor of shape [batch_size, 1] with sampled token ids
+    """
+    if decode_mode == GREEDY:
+        return torch.argmax(logits, dim=-1, keepdim=True)
+
+    return sample_tokens(logits, temperature, top_k, generator)
+
+
+def sample_tokens(logits, temperature=1.0, top_k=20, generator=None, out=None):
+    """
+    Temperature + top-k sampling of a whole batch in one pass on the logits' device.
+
+    Only the top max(k) logits of every row are kept ([batch, k] instead of a full [batch, vocab]
+    -inf copy), scaled, cut to each row's own k, and sampled from; the chosen column is
+    mapped back to a chord id with a gather. Nothing is copied to the host, so callers can
+    keep the tokens on the device until decoding is done.
+
+    Parameters:
+    - logits: (tensor) [batch_size, vocab] logits for the next token
+    - temperature: (float or tensor [batch_size]) per-row temperature
+    - top_k: (int or tensor [batch_size]) per-row k, 0 disables the cut for that row
+    - generator: torch.Generator used for reproducible sampling
+    - out: optional long tensor [batch_size, 1] (e.g. a column of a preallocated token buffer)
+        the tokens are written into
+
+    Returns:
+    tensor of shape [batch_size, 1] with sampled token ids (out if given)
+    """
+    vocab = logits.size(-1)
+    per_row_k = torch.is_tensor(top_k)
+    if per_row_k:
+        top_k = top_k.to(logits.device)
+        row_k = torch.where(top_k > 0, top_k.clamp(max=vocab), torch.full_like(top_k, vocab))
+        max_k = int(row_k.max()) if row_k.numel() else vocab
+    else:
+        max_k = min(top_k, vocab) if top_k > 0 else vocab
+
+    values, indices = torch.topk(logits, max_k, dim=-1)
+
+    if torch.is_tensor(temperature):
+        values = values / temperature.to(values.device, values.dtype).unsqueeze(-1)
+    else:
+        values = values / temperature
+
+    if per_row_k:
+        # columns past a row's own k get zero probability
+        columns = torch.arange(max_k, device=logits.device)
+        values = values.masked_fill(columns >= row_k.unsqueeze(-1), float('-inf'))
+
+    choice = torch.multinomial(torch.softmax(values, dim=-1), num_samples=1, generator=generator)
+    return torch.gather(indices, -1, choice, out=out)
+
+
+def token_probabilities(logits, temperature=1.0, top_k=20):
+    """The distribution sample_next_token draws from: softmax of temperature-scaled, top-k filtered logits"""
+    logits = logits / temperature
+
+    if top_k > 0:
+        top_k_logits, top_k_indices = torch.topk(logits, min(top_k, logits.size(-1)))
+
+        # keep only the top-k values, everything else gets zero probability
+        filtered_logits = torch.full_like(logits, float('-inf'))
+        filtered_logits.scatter_(-1, top_k_indices, top_k_logits)
+        logits = filtered_logits
+
+    return torch.softmax(logits, dim=-1)
+
+
+def repeat_last_draft(tokens, n):
+    """Draft model for speculative decoding: the current chord simply continues"""
+    return [tokens[-1]] * n
+
+
+class TransitionDraft:
+    """
+    Draft model for speculative decoding that follows the most likely chord transitions
+    of an n-gram table (see ngram_engine.ChordHMM.most_likely_transitions).
+
+    Parameters:
+    - next_chord: sequence mapping chord id -> most likely next chord id
+    - first_chord: chord id proposed right after the start token
+    - start_token: id of the start token
+    """
+
+    def __init__(self, next_chord, first_chord, start_token):
+        self.next_chord = list(next_chord)
+        self.first_chord = first_chord
+        self.start_token = start_token
+
+    def __call__(self, tokens, n):
+        draft = []
+        last = tokens[-1]
+        for _ in range(n):
+            last = self.first_chord if last == self.start_token else self.next_chord[last]
+            draft.append(last)
+        return draft
+
+
+def speculative_step(model, sequence, memory, draft_tokens, temperature=1.0, top_k=20, decode_mode=SAMPLE,
+                     generator=None, memory_key_padding_mask=None):
+    """
+    Verifies drafted chord tokens with one decoder pass over sequence + draft.
+
+    A drafted token is accepted with probability p(token) under the distribution
+    sample_next_token would use (argmax match in greedy mode). At the first rejection
+    the replacement is sampled from p with the drafted token removed, which keeps the
+    output distribution exactly that of token-by-token decoding. If every drafted
+    token is accepted, one more token is sampled from the last position for free.
+
+    Parameters:
+    - model: trained harmony model with decode()
+    - sequence: (tensor) [1, length] chord tokens so far, starting with SOS
+    - memory: encoder output for the melody
+    - draft_tokens: list of proposed chord ids
+    - temperature, top_k, decode_mode, generator: as in sample_next_token
+
+    Returns:
+    (tensor [1, n] of new tokens with 1 <= n <= len(draft_tokens) + 1, number of drafted tokens accepted)
+    """
+    device = sequence.device
+    length = sequence.size(1)
+    draft = torch.tensor([draft_tokens], dtype=torch.long, device=device)
+    candidate = torch.cat((sequence, draft), dim=1)
+
+    tgt_mask = model.get_tgt_mask(candidate.size(1), device)
+    logits = model.decode(candidate, memory, tgt_mask, memory_key_padding_mask=memory_key_padding_mask)
+    # logits[length - 1 + i] predicts the token at position length + i
+    logits = logits[0, length - 1:]
+
+    accepted = []
+    for i, token in enumerate(draft_tokens):
+        if decode_mode == GREEDY:
+            best = int(torch.argmax(logits[i]))
+            if best == token:
+                accepted.append(token)
+                continue
+            accepted.append(best)
+            return torch.tensor([accepted], device=device), i
+
+        probs = token_probabilities(logits[i], temperature, top_k)
+        uniform = torch.rand(1, generator=generator, device=generator.device if generator is not None else device)
+        if uniform.item() < probs[token].item():
+            accepted.append(token)
+            continue
+
+        residual = probs.clone()
+        residual[token] = 0.0
+        if residual.sum() <= 0:
+            residual = probs
+        replacement = torch.multinomial(residual / residual.sum(), num_samples=1, generator=generator)
+        accepted.append(int(replacement))
+        return torch.tensor([accepted], device=device), i
+
+    bonus = sample_next_token(logits[-1:], temperature, top_k, decode_mode, generator)
+    accepted.append(int(bonus))
+    return torch.tensor([accepted], device=device), len(draft_tokens)
+
+
+def speculative_decode(model, sequence, memory, max_new_tokens, draft, draft_len=4, temperature=1.0, top_k=20,
+                       decode_mode=SAMPLE, generator=None, stats=None):
+    """
+    Generates max_new_tokens chord tokens with speculative decoding, yielding each
+    accepted token as a [1, 1] tensor. Between decoder passes control returns to the
+    caller, which can stop the generator (e.g. when a request is superseded).
+
+    Parameters:
+    - draft: callable(tokens so far as list, n) -> list of n proposed chord ids
+    - draft_len: (int) tokens proposed per decoder pass
+    - stats: SpeculativeStats collecting acceptance counters
+    """
+    tokens = sequence[0].tolist()
+    generated = 0
+    while generated < max_new_tokens:
+        # never propose past the requested length: a full acceptance adds draft + 1 tokens
+        proposal = draft(tokens, min(draft_len, max_new_tokens - generated - 1))
+        if proposal:
+            new_tokens, accepted = speculative_step(model, sequence, memory, proposal, temperature, top_k,
+                                                    decode_mode, generator)
+        else:
+            tgt_mask = model.get_tgt_mask(sequence.size(1), sequence.device)
+            logits = model.decode(sequence, memory, tgt_mask)
+            new_tokens, accepted = sample_next_token(logits[:, -1], temperature, top_k, decode_mode, generator), 0
+
+        if stats is not None:
+            stats.record_pass(len(proposal), accepted, new_tokens.size(1))
+
+        sequence = torch.cat((sequence, new_tokens), dim=1)
+        tokens += new_tokens[0].tolist()
+        generated += new_tokens.size(1)
+        # counted before the last tokens are handed out, callers rarely resume a finished generator
+        if stats is not None and generated >= max_new_tokens:
+            stats.record_sequence()
+        for i in range(new_tokens.size(1)):
+            yield new_tokens[:, i:i + 1]
+
+
+class SpeculativeStats:
+    """Thread-safe acceptance counters of speculative decoding"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.sequences = 0
+        self.forward_passes = 0
+        self.tokens = 0
+        self.drafted = 0
+        self.accepted = 0
+
+    def record_pass(self, drafted, accepted, tokens):
+        with self._lock:
+            self.forward_passes += 1
+            self.drafted += drafted
+            self.accepted += accepted
+            self.tokens += tokens
+
+    def record_sequence(self):
+        with self._lock:
+            self.sequences += 1
+
+    def stats(self):
+        with self._lock:
+            return {
+                'sequences': self.sequences,
+                'forward_passes': self.forward_passes,
+                'tokens': self.tokens,
+                'drafted': self.drafted,
+                'accepted': self.accepted,
+                'acceptance_rate': self.accepted / self.drafted if self.drafted else 0.0,
+                'tokens_per_pass': self.tokens / self.forward_passes if self.forward_passes else 0.0,
+            }
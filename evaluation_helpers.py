@@ -10,6 +10,8 @@ import re
 
 import json
 
+import chord_canonicalizer
+
 def outputDAWPhrase(output):
   """
   Formats phrase to be sent to DAW in form expected by API 
@@ -142,27 +144,7 @@ def fixChordName(chord):
 
     This is all pretty unimportant music theory conventions/merely ensuring names match up. 
   """
-   # filter out word alter to fit with music21 expected input format
-  chord = re.sub(r'sus add 7', r'7 sus4', chord)
-  chord = re.sub(r'add 4 subtract 3', r'sus4', chord)
-  chord = re.sub(r'\balter\b', '', chord)
-  chord = re.sub(r'\badd\s*b9', r'b9', chord)
-  chord = re.sub(r'\badd\s*b13', r'b13', chord)
-  chord = re.sub(r'\badd\s*#9', r'#9', chord)
-  chord = re.sub(r'\badd\s*#11', r'#11', chord)
-
-  # fix sus chord spelling by replacing 'sus ' with 'sus4 '
-  chord = re.sub(r'sus\s', r'sus4 ', chord)
-  chord = re.sub(r'sus/\s', r'sus4/', chord)
-  chord = re.sub(r'sus47\s', r'sus4 ', chord)
-  # Replace 'add 7 ' with '7 '
-  chord = re.sub(r'add\s*7', r'7', chord)
-  # remove 'pedal' 
-  chord = re.sub(r'pedal', r' ', chord)
-  # replace word 'subtract' with 'omit' 
-  chord = re.sub(r'subtract', r'omit', chord)
-
-  return chord
+  return chord_canonicalizer.repair_spelling(chord)
 
 
 def fixFormatting(decoded_chords):
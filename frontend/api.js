@@ -1,6 +1,12 @@
 class MusicAPI {
     constructor(baseUrl = 'http://localhost:5001') {
         this.baseUrl = baseUrl;
+        // Shared across MusicAPI instances so the server can drop requests superseded
+        // by a newer one from this page (latest wins).
+        if (!MusicAPI.clientId) {
+            MusicAPI.clientId = Math.random().toString(36).slice(2) + Date.now().toString(36);
+            MusicAPI.requestSeq = 0;
+        }
         console.log('MusicAPI initialized with baseUrl:', baseUrl);
     }
 
@@ -32,6 +38,7 @@ class MusicAPI {
             await this.checkStatus();
 
             console.log('Sending harmonization request...');
+            const seq = ++MusicAPI.requestSeq;
             const response = await fetch(`${this.baseUrl}/api/harmonize`, {
                 method: 'POST',
                 headers: {
@@ -41,10 +48,18 @@ class MusicAPI {
                     melody: melody,
                     temperature: temperature,
                     k: k,
-                    mode: 'notes'
+                    mode: 'notes',
+                    client_id: MusicAPI.clientId,
+                    seq: seq
                 })
             });
 
+            if (response.status === 409) {
+                const error = new Error('Request superseded by a newer request');
+                error.superseded = true;
+                throw error;
+            }
+
             if (!response.ok) {
                 const errorText = await response.text();
                 console.error('API error response:', errorText);
@@ -60,6 +75,82 @@ class MusicAPI {
         }
     }
 
+    // Live harmonization sessions: the server keeps the melody played so far and only
+    // decodes the half-bar slots completed by newly appended notes.
+    async createSession(temperature = 1.0, k = 20, seed = null) {
+        const body = { temperature: temperature, k: k };
+        if (seed !== null) {
+            body.seed = seed;
+        }
+        return this._postJson('/api/session', body);
+    }
+
+    async appendSessionNotes(sessionId, notes) {
+        return this._postJson(`/api/session/${sessionId}/notes`, { notes: notes });
+    }
+
+    async getSessionChords(sessionId) {
+        const response = await fetch(`${this.baseUrl}/api/session/${sessionId}/chords`);
+        if (!response.ok) {
+            throw new Error(`HTTP error! status: ${response.status}`);
+        }
+        return response.json();
+    }
+
+    async closeSession(sessionId) {
+        const response = await fetch(`${this.baseUrl}/api/session/${sessionId}`, { method: 'DELETE' });
+        return response.ok;
+    }
+
+    // Streaming: one EventSource per page carries the chords of every stream, each event
+    // tagged with its stream_id, so playback can start with the first decoded chord.
+    openChordStream(onEvent) {
+        if (this.eventSource) {
+            this.eventSource.close();
+        }
+        this.eventSource = new EventSource(`${this.baseUrl}/api/stream?client_id=${MusicAPI.clientId}`);
+        ['chord', 'done', 'cancelled', 'error'].forEach(type => {
+            this.eventSource.addEventListener(type, event => {
+                if (event.data) {
+                    onEvent(type, JSON.parse(event.data));
+                }
+            });
+        });
+        return this.eventSource;
+    }
+
+    async streamHarmonization(streamId, melody, temperature = 1.0, k = 20) {
+        return this._postJson('/api/stream/harmonize', {
+            client_id: MusicAPI.clientId,
+            stream_id: streamId,
+            melody: melody,
+            temperature: temperature,
+            k: k
+        });
+    }
+
+    async cancelStream(streamId = null) {
+        return this._postJson('/api/stream/cancel', { client_id: MusicAPI.clientId, stream_id: streamId });
+    }
+
+    async _postJson(path, body) {
+        const response = await fetch(`${this.baseUrl}${path}`, {
+            method: 'POST',
+            headers: {
+                'Content-Type': 'application/json',
+            },
+            body: JSON.stringify(body)
+        });
+
+        if (!response.ok) {
+            const errorText = await response.text();
+            console.error('API error response:', errorText);
+            throw new Error(`HTTP error! status: ${response.status}`);
+        }
+
+        return response.json();
+    }
+
     parseNotesToMelody(noteString) {
         console.log('Parsing note string:', noteString);
 
@@ -426,6 +426,11 @@ async function generateContentWithAPI() {
                 }
 
             } catch (error) {
+                if (error.superseded) {
+                    // a newer request is already on its way and will render its result
+                    console.log('Harmonization request superseded by a newer one');
+                    return null;
+                }
                 console.warn('Real backend call failed, falling back to simulation:', error.message);
                 generatedResult = await simulateBackendResponse(inputValue, currentMode);
 
@@ -0,0 +1,186 @@
+import threading
+import time
+import uuid
+
+import torch
+
+from decoding import sample_next_token, SAMPLE
+from inference_cache import encoder_cache
+
+# one chord is predicted for every half bar = 8 sixteenth-note frames
+FRAMES_PER_SLOT = 8
+# model was trained on 8 bar phrases (128 frames + EOS)
+MAX_FRAMES = 128
+
+
+class SessionError(Exception):
+    """Raised for invalid session requests (melody too long, bad notes)"""
+
+
+class SessionNotFound(SessionError):
+    """Raised when a session id is unknown or the session was evicted"""
+
+
+class HarmonizationSession:
+    """
+    Incremental harmonization state for one live input stream.
+
+    Keeps the 16th-note frame buffer of everything played so far, the encoder memory
+    for that buffer and the chord tokens already committed. Appending notes only decodes
+    the half-bar slots completed by the new notes; earlier chords are never resampled.
+    """
+
+    def __init__(self, session_id, temperature=1.0, k=20, decode_mode=SAMPLE, seed=None, device='cpu'):
+        self.session_id = session_id
+        self.temperature = temperature
+        self.k = k
+        self.decode_mode = decode_mode
+
+        self.frames = []
+        self.tokens = None  # committed chord ids, starting with SOS
+        self.memory = None
+        self.memory_frames = 0
+
+        self.generator = torch.Generator(device=device)
+        if seed is not None:
+            self.generator.manual_seed(seed)
+        else:
+            self.generator.seed()
+        self.seed = self.generator.initial_seed()
+
+        self.created_at = time.monotonic()
+        self.last_used = self.created_at
+        self.lock = threading.Lock()
+
+    def completed_slots(self):
+        return len(self.frames) // FRAMES_PER_SLOT
+
+    def committed_slots(self):
+        return 0 if self.tokens is None else self.tokens.size(1) - 1
+
+    def append_notes(self, notes, note2in):
+        """
+        Adds [midi note, duration in 16th notes] pairs to the frame buffer.
+        Midi note may be "rest".
+        """
+        frames = []
+        for note_dur in notes:
+            if not isinstance(note_dur, (list, tuple)) or len(note_dur) != 2:
+                raise SessionError(f"Invalid note {note_dur}: expected [midi note, duration]")
+            pitch, duration = note_dur
+            try:
+                note_name = "rest" if pitch == "rest" else int(pitch) % 12
+                frames += [note2in[note_name]] * int(duration)
+            except (TypeError, ValueError, KeyError):
+                raise SessionError(f"Invalid note {note_dur}: expected [midi note, duration]")
+
+        if len(self.frames) + len(frames) > MAX_FRAMES:
+            raise SessionError(f"Session melody must be 8 bars ({MAX_FRAMES} 16th notes) or less")
+
+        self.frames += frames
+
+    def decode_new_slots(self, model, chord2in, note2in, sos_token, eos_token, temperature=None, k=None):
+        """
+        Decodes the chords for all completed but not yet committed half-bar slots.
+
+        The encoder is bidirectional, so the memory is recomputed once whenever the frame
+        buffer has grown; the committed chord prefix is reused as decoder input.
+
+        Returns:
+        list of (slot index, chord id) for the newly committed slots
+        """
+        temperature = self.temperature if temperature is None else temperature
+        k = self.k if k is None else k
+        device = next(model.parameters()).device
+
+        if self.tokens is None:
+            self.tokens = torch.tensor([[chord2in[sos_token]]], dtype=torch.long, device=device)
+
+        new_slots = []
+        if self.committed_slots() >= self.completed_slots():
+            return new_slots
+
+        with torch.no_grad():
+            if self.memory is None or self.memory_frames != len(self.frames):
+                src = torch.tensor([self.frames + [note2in[eos_token]]], dtype=torch.long, device=device)
+                self.memory = encoder_cache.encode(model, src)
+                self.memory_frames = len(self.frames)
+
+            while self.committed_slots() < self.completed_slots():
+                tgt_mask = model.get_tgt_mask(self.tokens.size(1), device)
+                outputs = model.decode(self.tokens, self.memory, tgt_mask=tgt_mask)
+
+                next_token = sample_next_token(outputs[:, -1, :], temperature, k, self.decode_mode, self.generator)
+                self.tokens = torch.cat([self.tokens, next_token.to(device)], dim=1)
+                new_slots.append((self.committed_slots() - 1, int(next_token)))
+
+        return new_slots
+
+    def chord_ids(self):
+        if self.tokens is None:
+            return []
+        return self.tokens[0, 1:].tolist()
+
+
+class SessionStore:
+    """
+    Thread-safe registry of live harmonization sessions. Sessions idle for longer
+    than idle_timeout seconds are evicted, as are the least recently used ones once
+    max_sessions is reached.
+    """
+
+    def __init__(self, idle_timeout=300.0, max_sessions=256):
+        self.idle_timeout = idle_timeout
+        self.max_sessions = max_sessions
+
+        self._sessions = {}
+        self._lock = threading.Lock()
+
+        self.created = 0
+        self.evicted = 0
+
+    def _evict_idle(self, now):
+        for session_id, session in list(self._sessions.items()):
+            if now - session.last_used > self.idle_timeout:
+                del self._sessions[session_id]
+                self.evicted += 1
+
+    def create(self, **session_kwargs):
+        with self._lock:
+            now = time.monotonic()
+            self._evict_idle(now)
+
+            while len(self._sessions) >= self.max_sessions:
+                oldest = min(self._sessions.values(), key=lambda s: s.last_used)
+                del self._sessions[oldest.session_id]
+                self.evicted += 1
+
+            session = HarmonizationSession(uuid.uuid4().hex, **session_kwargs)
+            self._sessions[session.session_id] = session
+            self.created += 1
+            return session
+
+    def get(self, session_id):
+        with self._lock:
+            now = time.monotonic()
+            self._evict_idle(now)
+
+            session = self._sessions.get(session_id)
+            if session is None:
+                raise SessionNotFound(f"Unknown or expired session: {session_id}")
+            session.last_used = now
+            return session
+
+    def delete(self, session_id):
+        with self._lock:
+            return self._sessions.pop(session_id, None) is not None
+
+    def stats(self):
+        with self._lock:
+            return {
+                'active': len(self._sessions),
+                'created': self.created,
+                'evicted': self.evicted,
+                'idle_timeout': self.idle_timeout,
+                'max_sessions': self.max_sessions,
+            }
@@ -0,0 +1,257 @@
+import itertools
+import os
+import threading
+import time
+import weakref
+from collections import OrderedDict
+
+import torch
+
+
+class _Flight:
+    """
+    A computation currently running for one cache key. Callers that ask for the
+    same key while it runs wait on the event instead of starting their own.
+    """
+
+    def __init__(self):
+        self.event = threading.Event()
+        self.value = None
+        self.error = None
+
+
+class ResultCache:
+    """
+    Thread-safe LRU cache of harmonization results with a time-to-live per entry
+    and single-flight coalescing of identical concurrent requests.
+
+    Parameters:
+    - max_entries: (int) maximum number of cached results, least recently used are evicted first
+    - ttl_seconds: (float) how long a result stays valid after it was computed. None disables expiry
+    """
+
+    def __init__(self, max_entries=512, ttl_seconds=300.0):
+        self.max_entries = max_entries
+        self.ttl_seconds = ttl_seconds
+
+        self._entries = OrderedDict()  # key -> (expires_at, value)
+        self._inflight = {}
+        self._lock = threading.Lock()
+
+        self.hits = 0
+        self.misses = 0
+        self.coalesced = 0
+        self.evictions = 0
+        self.expirations = 0
+        self.uncached = 0
+
+    def _lookup(self, key, now):
+        entry = self._entries.get(key)
+        if entry is None:
+            return False, None
+
+        expires_at, value = entry
+        if expires_at is not None and expires_at <= now:
+            del self._entries[key]
+            self.expirations += 1
+            return False, None
+
+        self._entries.move_to_end(key)
+        return True, value
+
+    def _store(self, key, value, now):
+        expires_at = now + self.ttl_seconds if self.ttl_seconds is not None else None
+        self._entries[key] = (expires_at, value)
+        self._entries.move_to_end(key)
+
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+            self.evictions += 1
+
+    def get_or_compute(self, key, compute, cacheable=None):
+        """
+        Returns cached value for key, or runs compute() once for all concurrent callers
+        asking for the same key.
+
+        Parameters:
+        - key: hashable cache key
+        - compute: zero-argument callable producing the value
+        - cacheable: callable telling whether a computed value may be stored (e.g. not a fallback),
+          rejected values still answer the concurrent callers but are computed again next time
+
+        Returns:
+        (value, status) where status is 'hit', 'miss' (this caller computed it)
+        or 'coalesced' (waited on another caller's computation)
+        """
+        with self._lock:
+            found, value = self._lookup(key, time.monotonic())
+            if found:
+                self.hits += 1
+                return value, 'hit'
+
+            flight = self._inflight.get(key)
+            if flight is not None:
+                self.coalesced += 1
+                leader = False
+            else:
+                self.misses += 1
+                flight = _Flight()
+                self._inflight[key] = flight
+                leader = True
+
+        if not leader:
+            flight.event.wait()
+            if flight.error is not None:
+                raise flight.error
+            return flight.value, 'coalesced'
+
+        try:
+            flight.value = compute()
+        except BaseException as e:
+            # errors are shared with waiting callers but never cached
+            flight.error = e
+            raise
+        else:
+            if cacheable is None or cacheable(flight.value):
+                with self._lock:
+                    self._store(key, flight.value, time.monotonic())
+            else:
+                with self._lock:
+                    self.uncached += 1
+        finally:
+            with self._lock:
+                del self._inflight[key]
+            flight.event.set()
+
+        return flight.value, 'miss'
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def stats(self):
+        with self._lock:
+            lookups = self.hits + self.misses + self.coalesced
+            return {
+                'entries': len(self._entries),
+                'max_entries': self.max_entries,
+                'ttl_seconds': self.ttl_seconds,
+                'inflight': len(self._inflight),
+                'hits': self.hits,
+                'misses': self.misses,
+                'coalesced': self.coalesced,
+                'evictions': self.evictions,
+                'expirations': self.expirations,
+                'uncached': self.uncached,
+                'hit_rate': (self.hits + self.coalesced) / lookups if lookups else 0.0,
+            }
+
+
+class EncoderCache:
+    """
+    Thread-safe LRU cache of encoder outputs (memory tensors) keyed by the encoded
+    source sequence, bounded by the total byte size of the cached tensors.
+
+    Changing temperature or k only changes decoding, so resubmitting the same melody
+    reuses the memory and skips the encoder pass entirely.
+
+    Parameters:
+    - max_bytes: (int) upper bound on the summed size of cached memory tensors
+    """
+
+    def __init__(self, max_bytes=64 * 1024 * 1024):
+        self.max_bytes = max_bytes
+
+        self._entries = OrderedDict()  # key -> memory tensor
+        self._bytes = 0
+        self._lock = threading.Lock()
+        # model -> token unique for the process lifetime (an id() can be reused after garbage collection)
+        self._model_tokens = weakref.WeakKeyDictionary()
+        self._next_token = itertools.count()
+
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def _model_state(self, model):
+        """
+        (token, version) of a model's current encoder: the token keeps models apart, the version
+        changes with Transformer.cache_version (load_state_dict, set_precision, set_attention) and
+        with in-place updates of any parameter (optimizer steps)
+        """
+        with self._lock:
+            token = self._model_tokens.get(model)
+            if token is None:
+                token = self._model_tokens[model] = next(self._next_token)
+        parameter_versions = sum(parameter._version for parameter in model.parameters())
+        return token, getattr(model, 'cache_version', 0), parameter_versions
+
+    def _key(self, model, src, src_key_padding_mask):
+        mask = None if src_key_padding_mask is None else tuple(src_key_padding_mask.flatten().tolist())
+        return (self._model_state(model), str(src.device), tuple(src.shape), tuple(src.flatten().tolist()), mask)
+
+    def encode(self, model, src, src_key_padding_mask=None):
+        """
+        Returns model.encode(src), computing it only if this source has not been seen.
+        Models in training mode (dropout active) bypass the cache.
+
+        Parameters:
+        - model: Transformer exposing encode()
+        - src: (LongTensor) encoded melody frames [batch_size, src_len]
+        - src_key_padding_mask: (BoolTensor) [batch_size, src_len], True marks padding
+
+        Returns:
+        encoder memory [batch_size, src_len, embedding_dim]
+        """
+        if model.training:
+            return model.encode(src, src_key_padding_mask=src_key_padding_mask)
+
+        key = self._key(model, src, src_key_padding_mask)
+        with self._lock:
+            memory = self._entries.get(key)
+            if memory is not None:
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return memory
+            self.misses += 1
+
+        with torch.no_grad():
+            memory = model.encode(src, src_key_padding_mask=src_key_padding_mask).detach()
+        size = memory.element_size() * memory.nelement()
+
+        if size > self.max_bytes:
+            return memory
+
+        with self._lock:
+            if key not in self._entries:
+                self._entries[key] = memory
+                self._bytes += size
+
+                while self._bytes > self.max_bytes:
+                    _, evicted = self._entries.popitem(last=False)
+                    self._bytes -= evicted.element_size() * evicted.nelement()
+                    self.evictions += 1
+
+        return memory
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._bytes = 0
+
+    def stats(self):
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                'entries': len(self._entries),
+                'bytes': self._bytes,
+                'max_bytes': self.max_bytes,
+                'hits': self.hits,
+                'misses': self.misses,
+                'evictions': self.evictions,
+                'hit_rate': self.hits / lookups if lookups else 0.0,
+            }
+
+
+# shared by every generation path in this process
+encoder_cache = EncoderCache(max_bytes=int(os.environ.get('HARMONY_ENCODER_CACHE_BYTES', 64 * 1024 * 1024)))
@@ -0,0 +1,275 @@
+"""
+Memory-mapped model checkpoints in the safetensors layout: 8 bytes of little-endian header
+length, a JSON header (every tensor's dtype, shape and byte range, plus "__metadata__" with the
+model kwargs, model type, vocabulary options, the chord and note vocabularies and format version)
+and the raw tensor bytes.
+Nothing is unpickled. Loading maps the file copy-on-write and the model's parameters are views
+into the mapping, so processes loading the same file share its physical pages (a page is only
+copied if that process writes to it, e.g. when fine-tuning) and load time hardly depends on the
+model size.
+
+Convert existing checkpoints (writes pretrained_model.safetensors next to the .pth):
+python3 mapped_checkpoint.py Saved_Models/pretrained_model.pth [out.safetensors]
+
+Loaders take either format; given a .pth path they use a converted .safetensors sibling when it
+is at least as new as the .pth. A checkpoint holding its vocabularies (every mapped one, .pth
+files saved since) is used without reading the datasets (Song_Dataloader.for_checkpoint).
+"""
+import json
+import os
+import struct
+import sys
+import tempfile
+
+import numpy as np
+import torch
+from torch.overrides import TorchFunctionMode
+
+from Model.Transformer import Transformer
+
+FORMAT_VERSION = 1
+EXTENSION = ".safetensors"
+
+DTYPES = {
+    torch.float64: "F64", torch.float32: "F32", torch.float16: "F16", torch.bfloat16: "BF16",
+    torch.int64: "I64", torch.int32: "I32", torch.int16: "I16", torch.int8: "I8", torch.uint8: "U8",
+    torch.bool: "BOOL",
+}
+TORCH_DTYPES = {name: dtype for dtype, name in DTYPES.items()}
+
+
+def mapped_path(path):
+    """The .safetensors path a .pth checkpoint converts to"""
+    return os.path.splitext(path)[0] + EXTENSION
+
+
+def is_mapped(path):
+    """Whether path holds a mapped checkpoint (a JSON header after 8 length bytes)"""
+    with open(path, "rb") as checkpoint_file:
+        start = checkpoint_file.read(9)
+    return len(start) == 9 and start[8:9] == b"{"
+
+
+def resolve(path):
+    """path, or its converted sibling if that exists and is not older than path"""
+    if is_mapped(path):
+        return path
+    converted = mapped_path(path)
+    if converted != path and os.path.exists(converted) and os.path.getmtime(converted) >= os.path.getmtime(path):
+        return converted
+    return path
+
+
+def vocab_lists(vocab):
+    """(chord2in, in2chord, note2in, in2note) -> {"chords": [...], "notes": [...]} in id order, for JSON"""
+    _, in2chord, _, in2note = vocab
+    return {"chords": [in2chord[i] for i in range(len(in2chord))],
+            "notes": [in2note[i] for i in range(len(in2note))]}
+
+
+def vocab_maps(lists):
+    """Inverse of vocab_lists: (chord2in, in2chord, note2in, in2note)"""
+    in2chord = dict(enumerate(lists["chords"]))
+    in2note = dict(enumerate(lists["notes"]))
+    return ({chord: i for i, chord in in2chord.items()}, in2chord,
+            {note: i for i, note in in2note.items()}, in2note)
+
+
+def save_mapped(path, model_kwargs, state_dict, model_type, vocab_options=None, vocab=None):
+    """
+    Writes a mapped checkpoint atomically (temporary file, fsync, rename).
+
+    Parameters:
+    - model_kwargs: Transformer constructor arguments (model.kwargs)
+    - state_dict: model.state_dict()
+    - vocab_options: Song_Dataloader options the chord vocabulary was built with
+    - vocab: (chord2in, in2chord, note2in, in2note) of the model, so loading needs no datasets
+    """
+    # widest dtypes first, with the header padded to 8 bytes every tensor starts aligned
+    names = sorted(state_dict, key=lambda name: (-state_dict[name].element_size(), name))
+    header, offset = {}, 0
+    for name in names:
+        tensor = state_dict[name]
+        size = tensor.numel() * tensor.element_size()
+        header[name] = {"dtype": DTYPES[tensor.dtype], "shape": list(tensor.shape),
+                        "data_offsets": [offset, offset + size]}
+        offset += size
+    # safetensors metadata values are strings
+    header["__metadata__"] = {"format_version": str(FORMAT_VERSION), "model_type": model_type,
+                              "kwargs": json.dumps(model_kwargs), "vocab_options": json.dumps(vocab_options or {})}
+    if vocab is not None:
+        header["__metadata__"]["vocab"] = json.dumps(vocab_lists(vocab))
+    header_bytes = json.dumps(header, separators=(",", ":")).encode("utf-8")
+    header_bytes += b" " * (-len(header_bytes) % 8)
+
+    directory = os.path.dirname(os.path.abspath(path))
+    os.makedirs(directory, exist_ok=True)
+    handle, tmp_path = tempfile.mkstemp(dir=directory, prefix=".tmp_", suffix=EXTENSION)
+    try:
+        with os.fdopen(handle, "wb") as tmp_file:
+            tmp_file.write(struct.pack("<Q", len(header_bytes)))
+            tmp_file.write(header_bytes)
+            for name in names:
+                tensor = state_dict[name].detach().to("cpu").contiguous()
+                # raw bytes in native (little-endian) order, via uint8 so bf16 needs no numpy dtype
+                tmp_file.write(tensor.view(-1).view(torch.uint8).numpy().tobytes())
+            tmp_file.flush()
+            os.fsync(tmp_file.fileno())
+        os.replace(tmp_path, path)
+    except BaseException:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
+
+
+def read_header(path):
+    """
+    Returns:
+    (tensor entries {name: {dtype, shape, data_offsets}}, metadata dict, offset of the tensor bytes)
+    """
+    with open(path, "rb") as checkpoint_file:
+        header_length = struct.unpack("<Q", checkpoint_file.read(8))[0]
+        header = json.loads(checkpoint_file.read(header_length))
+    raw = header.pop("__metadata__", {})
+    if int(raw.get("format_version", FORMAT_VERSION)) > FORMAT_VERSION:
+        raise ValueError(f"{path} has checkpoint format {raw['format_version']}, "
+                         f"this version reads up to {FORMAT_VERSION}")
+    metadata = {"format_version": int(raw.get("format_version", FORMAT_VERSION)),
+                "model_type": raw.get("model_type", "Transformer"),
+                "kwargs": json.loads(raw.get("kwargs", "{}")),
+                "vocab_options": json.loads(raw.get("vocab_options", "{}")),
+                "vocab": vocab_maps(json.loads(raw["vocab"])) if "vocab" in raw else None}
+    return header, metadata, 8 + header_length
+
+
+def read_metadata(path):
+    """
+    Metadata of a checkpoint: a mapped one's header alone, a .pth is loaded whole (when the
+    model is needed as well, take both from one load_checkpoint instead)
+    """
+    path = resolve(path)
+    if is_mapped(path):
+        return read_header(path)[1]
+    checkpoint = torch.load(path, map_location="cpu", weights_only=False)
+    model_kwargs, _, model_type = checkpoint['model']
+    return {"format_version": None, "model_type": model_type, "kwargs": model_kwargs,
+            "vocab_options": checkpoint.get('vocab_options', {}), "vocab": checkpoint.get('vocab')}
+
+
+def load_state(path):
+    """
+    Returns:
+    (state dict of tensors viewing a copy-on-write mapping of path, metadata dict)
+    """
+    header, metadata, data_offset = read_header(path)
+    mapping = np.memmap(path, dtype=np.uint8, mode="c")
+    state = {}
+    for name, entry in header.items():
+        begin, end = entry["data_offsets"]
+        dtype = TORCH_DTYPES[entry["dtype"]]
+        if begin == end:
+            state[name] = torch.empty(entry["shape"], dtype=dtype)
+            continue
+        state[name] = torch.frombuffer(mapping, dtype=dtype, count=(end - begin) // dtype.itemsize,
+                                       offset=data_offset + begin).view(entry["shape"])
+    return state, metadata
+
+
+def load_checkpoint(path, map_location=None):
+    """
+    Checkpoint in the layout every loader reads, {'model': [kwargs, state_dict, model_type],
+    'vocab_options': ..., 'vocab': (chord2in, in2chord, note2in, in2note) or None}, from a mapped
+    file or a .pth (see resolve). Mapped tensors stay mapped when map_location is None or the CPU.
+    """
+    path = resolve(path)
+    if not is_mapped(path):
+        checkpoint = torch.load(path, map_location=map_location)
+        checkpoint.setdefault('vocab', None)
+        return checkpoint
+    state, metadata = load_state(path)
+    if map_location is not None and torch.device(map_location).type != "cpu":
+        state = {name: tensor.to(map_location) for name, tensor in state.items()}
+    return {'model': [metadata["kwargs"], state, metadata["model_type"]], 'vocab_options': metadata["vocab_options"],
+            'vocab': metadata["vocab"]}
+
+
+class _SkipInit(TorchFunctionMode):
+    """
+    Turns the in-place initializers of reset_parameters() into no-ops, so a model whose every
+    parameter is replaced right away neither computes nor touches its initial weights (the meta
+    device would do the same, but its first use imports torch._dynamo, seconds per process)
+    """
+
+    INITIALIZERS = {"normal_", "uniform_", "fill_", "zero_"}
+
+    def __torch_function__(self, func, types, args=(), kwargs=None):
+        kwargs = kwargs or {}
+        if getattr(func, "__name__", None) in self.INITIALIZERS:
+            # Tensor methods get the tensor positionally, torch.nn.init functions by keyword
+            return args[0] if args else kwargs["tensor"]
+        return func(*args, **kwargs)
+
+
+def build_model(model_kwargs, model_state, device=None):
+    """
+    Transformer holding model_state's tensors themselves: built without initialization and
+    filled with load_state_dict(assign=True), so mapped weights are neither copied nor paged in
+    """
+    with _SkipInit():
+        model = Transformer(**model_kwargs)
+    model.load_state_dict(model_state, assign=True)
+    return model.to(device) if device is not None else model
+
+
+def checkpoint_model(checkpoint, device=None):
+    """Model of a checkpoint returned by load_checkpoint, in eval mode"""
+    model_kwargs, model_state, _ = checkpoint['model']
+    return build_model(model_kwargs, model_state, device).eval()
+
+
+def load_model(path, device=None):
+    """Model of a checkpoint (mapped or .pth) in eval mode"""
+    return checkpoint_model(load_checkpoint(path, device), device)
+
+
+def convert(path, out_path=None):
+    """
+    Writes the model of a .pth checkpoint as a mapped checkpoint (training state, e.g. the
+    optimizer of periodic checkpoints, is not carried over). Checkpoints saved without their
+    vocabularies get them rebuilt from the datasets once, here.
+
+    Returns:
+    path of the mapped checkpoint
+    """
+    # song_dataloader reads checkpoint metadata through this module
+    from song_dataloader import Song_Dataloader
+
+    out_path = out_path or mapped_path(path)
+    checkpoint = torch.load(path, map_location="cpu", weights_only=False)
+    model_kwargs, model_state, model_type = checkpoint['model']
+    # the model's own state dict drops what loading ignores (e.g. old positional encoding buffers)
+    model_state = build_model(model_kwargs, model_state).state_dict()
+    vocab = Song_Dataloader.for_checkpoint(checkpoint).load_vocab()
+    save_mapped(out_path, model_kwargs, model_state, model_type, checkpoint.get('vocab_options'), vocab)
+    return out_path
+
+
+def main():
+    if len(sys.argv) < 2:
+        print("usage: python3 mapped_checkpoint.py checkpoint.pth [out.safetensors]")
+        sys.exit(1)
+    path = sys.argv[1]
+    out_path = convert(path, sys.argv[2] if len(sys.argv) > 2 else None)
+
+    # the converted model has to produce exactly the weights of the original
+    model_kwargs, model_state, _ = torch.load(path, map_location="cpu", weights_only=False)['model']
+    original = build_model(model_kwargs, model_state).state_dict()
+    converted, _ = load_state(out_path)
+    mismatched = [name for name in original if not torch.equal(original[name].cpu(), converted[name])]
+    if mismatched or set(original) != set(converted):
+        raise ValueError(f"converted weights differ from {path}: {mismatched}")
+    print(f"Converted {path} ({os.path.getsize(path):,} bytes) to {out_path} ({os.path.getsize(out_path):,} bytes)")
+
+
+if __name__ == "__main__":
+    main()
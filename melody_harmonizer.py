@@ -15,13 +15,25 @@ import os
 import music21
 import math
 import sys
+import argparse
 
 import evaluation_helpers
 import Model.Transformer
 import Trainer.trainer
-from Model.Transformer import Transformer
+from Model.Transformer import Transformer, PRECISIONS, ATTENTION_MODES
 from Trainer.trainer import Trainer
-from song_dataloader import Song_Dataloader
+from Trainer.checkpoints import atomic_save
+from Trainer.distributed import init_distributed
+from Trainer.distillation import DistillationTrainer, load_teacher_logits, latency_accuracy_table
+from song_dataloader import Song_Dataloader, replace_unknown_chords
+from inference_cache import encoder_cache
+from compiled_decoding import compiled_decoder, COMPILE_MODES
+from decoding import sample_tokens, speculative_decode, repeat_last_draft, TransitionDraft, SpeculativeStats
+import batch_harmonizer
+import mapped_checkpoint
+import ngram_engine
+
+NGRAM_ENGINE_PATH = "Saved_Models/ngram_engine.npz"
 
 # Uncomment to ensure same results for reproducibility each time the program is run
 # torch.manual_seed(42)
@@ -60,7 +72,7 @@ def eval(dataloader,model,loader,device, printText=False):
     target_input = targets[:,:-1]
     target_expected = targets[:,1:]
 
-    tgt_mask = model.get_tgt_mask(target_input.size(1)).to(device)
+    tgt_mask = model.get_tgt_mask(target_input.size(1),device)
 
 
     output = model(inputs,target_input, tgt_mask)
@@ -90,7 +102,7 @@ def eval(dataloader,model,loader,device, printText=False):
     # evaluation_helpers.viewPhrase(decoded_melody,decoded_actual_chords,songName)
 
 
-def harmonize_melody(model,melody,device,loader,temp=1,k=20):
+def harmonize_melody(model,melody,device,loader,temp=1,k=20,speculative=0,draft=None,stats=None,compile_mode=None):
   """
     Runs input melody through model and outputs input melody with generated harmonies. Opens notation
     software for viewing hearing output
@@ -103,6 +115,10 @@ def harmonize_melody(model,melody,device,loader,temp=1,k=20):
     - temp: (int) temperature value - lower = more conservtive,but more accurate, higher = more creative 
         but more chaotic and dissonant
     - k: (int) used in top k sampling to cut long tail of low probability chords
+    - speculative: (int) if > 0, chords proposed by the draft per decoder pass (speculative decoding)
+    - draft: draft model draft(tokens, n) -> n chord ids, defaults to repeating the last chord
+    - stats: SpeculativeStats collecting acceptance counters
+    - compile_mode: torch.compile mode of the decoder (see compiled_decoding.py), None decodes eagerly
 
     Returns:
     list of output chords
@@ -119,31 +135,141 @@ def harmonize_melody(model,melody,device,loader,temp=1,k=20):
   sequence = torch.tensor([chord2in[SOS_TOKEN]],device=device)
   sequence = sequence.unsqueeze(0)
 
-  while sequence.size(dim=1) <= MAX_LENGTH:
+  with torch.no_grad():
+    # encoder output only depends on the melody, so compute (or fetch) it once
+    memory = encoder_cache.encode(model,inputs)
 
-    tgt_mask = model.get_tgt_mask(sequence.size(1)).to(device)
+    if speculative > 0:
+      # same output distribution, fewer decoder passes when the draft guesses right
+      new_tokens = speculative_decode(model,sequence,memory,MAX_LENGTH,draft or repeat_last_draft,speculative,
+        temp,k,stats=stats)
+      sequence = torch.cat([sequence] + list(new_tokens), dim=1)
 
-    output = model(inputs,sequence,tgt_mask)
+    # shape-stable compiled decoder: fixed-size chord buffer and padded memory
+    compiled = compiled_decoder(model,compile_mode) if compile_mode else None
+    if compiled is not None and not compiled.fits(inputs.size(1),MAX_LENGTH + 1):
+      compiled = None
+    if compiled is not None:
+      memory,memory_mask = compiled.pad_memory(memory)
 
-    # temperature scaling
-    output = output/temp
+    # chord ids go into a preallocated buffer and stay on the device until decoding is done
+    buffer_length = compiled.max_tokens if compiled is not None else MAX_LENGTH + 1
+    tokens = torch.zeros((1, buffer_length), dtype=torch.long, device=device)
+    tokens[:, :sequence.size(1)] = sequence
 
-    # top k sampling
-    probabilities = evaluation_helpers.top_k_sampling(output[:,-1],k,device)
+    for length in range(sequence.size(1), MAX_LENGTH + 1):
 
-    probabilities = F.softmax(probabilities, dim=-1)
+      if compiled is not None:
+        output = compiled.decode_at(tokens,length,memory,memory_mask)
+      else:
+        tgt_mask = model.get_tgt_mask(length,device)
+        output = model.decode(tokens[:, :length],memory,tgt_mask)[:,-1]
 
-    sampled_chord = torch.multinomial(probabilities, 1)
+      # temperature scaling + top k sampling, next chord written straight into the buffer
+      sample_tokens(output,temp,k,out=tokens[:, length:length + 1])
 
-    next_item = sampled_chord
+    sequence = tokens[:, :MAX_LENGTH + 1]
 
-    next_item = torch.tensor([[next_item.item()]], device=device)
+  return [in2chord[chord] for chord in sequence.squeeze().tolist()]
 
-    # Concatenate previous input with next chord
-    sequence = torch.cat((sequence, next_item), dim=1)
 
- 
-  return [in2chord[chord] for chord in sequence.squeeze().tolist()]
+def run_batch_mode(argv):
+    """
+    Offline batch harmonization:
+    melody_harmonizer.py --batch input.jsonl --out output.jsonl [--workers N] [--batch-size B]
+        [--temperature T] [--k K] [--seed S] [--model path] [--precision fp32|bf16] [--compile mode]
+        [--attention default|sdpa]
+
+    Each input line is a melody ([[midi note, duration in 16th notes], ...] or
+    {"id": ..., "melody": [...]}); each output line holds the chords of one phrase.
+    """
+    parser = argparse.ArgumentParser(description="Batch melody harmonization")
+    parser.add_argument("--batch", required=True, help="input JSONL file, one melody per line")
+    parser.add_argument("--out", required=True, help="output JSONL file")
+    parser.add_argument("--workers", type=int, default=1, help="number of worker processes")
+    parser.add_argument("--batch-size", type=int, default=64, help="phrases per padded batch")
+    parser.add_argument("--temperature", type=float, default=2.0)
+    parser.add_argument("--k", type=int, default=20)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--model", default="Saved_Models/pretrained_model.pth")
+    parser.add_argument("--precision", default="fp32", choices=list(PRECISIONS))
+    parser.add_argument("--compile", default=None, choices=list(COMPILE_MODES), help="torch.compile mode of the decoder")
+    parser.add_argument("--attention", default="default", choices=list(ATTENTION_MODES))
+    args = parser.parse_args(argv)
+
+    # vocabularies from the checkpoint itself, which a single process also decodes with (workers load their own)
+    checkpoint = mapped_checkpoint.load_checkpoint(args.model, torch.device("cpu"))
+    chord2in, in2chord, note2in, _ = Song_Dataloader.for_checkpoint(checkpoint).load_vocab()
+    model = None
+    if args.workers <= 1:
+        model = mapped_checkpoint.checkpoint_model(checkpoint, torch.device("cpu"))
+        model.set_precision(args.precision).set_attention(args.attention)
+
+    batch_harmonizer.run_batch_file(args.batch, args.out, args.model, (in2chord, chord2in, note2in),
+                                    temperature=args.temperature, k=args.k, seed=args.seed,
+                                    batch_size=args.batch_size, workers=args.workers, model=model,
+                                    precision=args.precision, compile_mode=args.compile, attention=args.attention)
+
+
+def run_distillation():
+    """
+    Distills the teacher checkpoint into the smaller student described in the "distillation"
+    section of config.json, saves it and prints a latency/accuracy table for both models.
+    Teacher logits over the training split are cached on disk and only computed once.
+    """
+    with open("config.json", "r") as json_file:
+        config = json.load(json_file)["distillation"]
+
+    # the student is trained on the teacher's chord vocabulary
+    device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
+    teacher_checkpoint = mapped_checkpoint.load_checkpoint(config["teacher"], device)
+    loader = Song_Dataloader.for_checkpoint(teacher_checkpoint)
+    train_dataloader, test_dataloader, chord2in, in2chord, note2in, in2note = loader.load()
+
+    teacher = mapped_checkpoint.checkpoint_model(teacher_checkpoint, device)
+
+    teacher_logits = load_teacher_logits(config["teacher_logits_cache"], teacher, config["teacher"],
+                                         train_dataloader.dataset, device)
+
+    student = Transformer(
+        inputVocab=len(note2in), outputVocab=len(chord2in), input_embedding_dim=config["embedding_dim"],
+        output_embedding_dim=config["embedding_dim"], num_heads=config["num_heads"],
+        num_encoder_layers=config["num_encoder_layers"], num_decoder_layers=config["num_decoder_layers"],
+        dropout_p=config["dropout_p"], dim_feedforward=config["dim_feedforward"]).to(device)
+
+    optimizer = torch.optim.Adam(student.parameters(), amsgrad=True, lr=config["lr"])
+    trainer = DistillationTrainer(student, optimizer, train_dataloader, test_dataloader, device, scheduler=None,
+                                  teacher_logits=teacher_logits, temperature=config["temperature"],
+                                  alpha=config["alpha"])
+
+    print("Distilling student model...")
+    trainer.train(config["num_epochs"])
+
+    torch.save({'model': [student.kwargs, student.state_dict(), student.model_type],
+                'vocab_options': loader.vocab_options, 'vocab': (chord2in, in2chord, note2in, in2note)},
+               config["student"])
+    print("Saved student model to", config["student"])
+
+    latency_accuracy_table({"teacher": teacher, "student": student}, test_dataloader, device,
+                           chord2in[loader.get_special_chars()[0]])
+
+
+def pop_option(argv, name, default):
+    """Removes '--name value' from argv (if present) and returns value"""
+    if name not in argv:
+        return default
+    index = argv.index(name)
+    value = argv[index + 1] if index + 1 < len(argv) else default
+    del argv[index:index + 2]
+    return value
+
+
+def pop_flag(argv, name):
+    """Removes '--name' from argv and returns whether it was present"""
+    if name not in argv:
+        return False
+    argv.remove(name)
+    return True
 
 
 def main():
@@ -159,9 +285,60 @@ def main():
     if neither --train nor --eval is set, model expects command line argument of input melody in form of list
     of tuples of form [midi note, duration in 16th notes]. If none is provided, model runs
     inference on default twinkle, twinkle little star melody
+
+    --engine ngram: uses the chord HMM (ngram_engine.py) instead of the transformer. Its tables are
+    estimated from the training split on first use (or with --train) and saved to ngram_engine.npz.
+    --decode viterbi|sample picks its decoding, --eval reports its accuracy on the validation split.
+
+    --distill: trains the small student model of config.json on the pretrained model's soft targets.
+    --model path: checkpoint used for inference instead of pretrained_model.pth (e.g. the student).
+
+    --speculative N: transformer decoding verifies N chords proposed by a draft model per decoder pass
+    (--draft ngram follows the HMM's most likely transitions, --draft repeat repeats the last chord).
+
+    --run-log path: with --train, writes per-step/per-epoch throughput, timings and validation to a JSONL
+    file (summarize with python3 -m Trainer.run_log path). --profile-steps A:B records steps A..B with
+    torch.profiler, the chrome trace is written next to the log.
+
+    --precision fp32|bf16: bf16 runs the model under bfloat16 autocast (fp32 weights). For --train it
+    overrides "precision" of config.json, otherwise it applies to inference (also with --batch).
+
+    Data-parallel training over N processes (gloo, also across machines, see Trainer/distributed.py):
+    python3 -m Trainer.distributed --nproc-per-node N melody_harmonizer.py --train
+
+    --compile default|reduce-overhead|max-autotune: torch.compile'd training steps with --train (overrides
+    "compile_mode" of config.json), otherwise a compiled decoder with padded fixed-size buffers (also --batch).
+
+    --attention default|sdpa: sdpa runs inference attention through fused scaled_dot_product_attention
+    kernels (causal flag, no attention weights); training is unaffected. Also with --batch.
+
+    --resume: with --train, continues from the latest checkpoint in the "checkpointing" directory of
+    config.json (model, optimizer, scheduler, epoch and RNG state) instead of starting from scratch.
     
     """
     script_name = sys.argv[0]
+    if "--batch" in sys.argv:
+        run_batch_mode(sys.argv[1:])
+        return
+    if "--distill" in sys.argv:
+        run_distillation()
+        return
+
+    # engine options may appear anywhere, the remaining arguments keep their positions
+    engine = pop_option(sys.argv, "--engine", "transformer")
+    ngram_decode = pop_option(sys.argv, "--decode", ngram_engine.VITERBI)
+    speculative = int(pop_option(sys.argv, "--speculative", 0))
+    draft_model = pop_option(sys.argv, "--draft", "ngram")
+    model_path = pop_option(sys.argv, "--model", "Saved_Models/pretrained_model.pth")
+    run_log = pop_option(sys.argv, "--run-log", None)
+    profile_steps = pop_option(sys.argv, "--profile-steps", None)
+    if profile_steps:
+        profile_steps = tuple(int(step) for step in profile_steps.split(":"))
+    resume = pop_flag(sys.argv, "--resume")
+    precision = pop_option(sys.argv, "--precision", None)
+    compile_mode = pop_option(sys.argv, "--compile", None)
+    attention = pop_option(sys.argv, "--attention", None)
+
     train_flag = sys.argv[1] if len(sys.argv) > 1 and sys.argv[1] == '--train' else None  
     # for deploying model in daw, run with --daw flag set and input melody provided
     daw_flag = sys.argv[1] if len(sys.argv) > 1 and sys.argv[1] == '--daw' else None  
@@ -192,10 +369,6 @@ def main():
         loaded_hyperparameters = json.load(json_file)
 
 
-    # read songs, create dataloaders and vocab
-    loader = Song_Dataloader()
-    train_dataloader, test_dataloader,chord2in,in2chord,note2in, in2note = loader.load()
- 
     # Using just CPU for current state of model:
     if torch.cuda.is_available():
         device = torch.device("cuda")
@@ -206,7 +379,36 @@ def main():
 
     device = torch.device("cpu")
 
+    # read songs, create dataloaders and vocab. Training uses the "vocabulary" options of config.json,
+    # inference uses the vocabulary the checkpoint was trained with: the checkpoint is loaded once, for
+    # the vocabulary and the model (a converted .safetensors checkpoint is memory-mapped instead of unpickled)
+    checkpoint = None
     if train_flag:
+        loader = Song_Dataloader(**loaded_hyperparameters.get("vocabulary", {}))
+    elif os.path.exists(model_path):
+        checkpoint = mapped_checkpoint.load_checkpoint(model_path,map_location=device)
+        loader = Song_Dataloader.for_checkpoint(checkpoint)
+    else:
+        loader = Song_Dataloader()
+    # harmonizing a melody needs only the vocabularies, saved in the checkpoint if it is recent enough
+    if train_flag or eval_flag:
+        train_dataloader, test_dataloader,chord2in,in2chord,note2in, in2note = loader.load()
+    else:
+        train_dataloader = test_dataloader = None
+        chord2in,in2chord,note2in,in2note = loader.load_vocab()
+
+    def training_split():
+        """training split for fitting the chord HMM, the songs are only read if it has to be fitted"""
+        return train_dataloader.dataset if train_dataloader is not None else loader.load()[0].dataset
+
+    chord_hmm = None
+    if engine == "ngram":
+        if train_flag and os.path.exists(NGRAM_ENGINE_PATH):
+            os.remove(NGRAM_ENGINE_PATH)
+        chord_hmm = ngram_engine.load_or_fit(NGRAM_ENGINE_PATH, training_split, in2chord, in2note)
+        if print_text:
+            print("Chord HMM loaded")
+    elif train_flag:
         
         print("Training model...")
                          
@@ -222,6 +424,13 @@ def main():
         output_embedding_dim = loaded_hyperparameters["output_embedding_dim"]
         num_epochs =  loaded_hyperparameters["num_epochs"]
 
+        loader.print_vocab_report(output_embedding_dim)
+
+        # data-parallel when started by Trainer.distributed (or torchrun): each process trains on
+        # its shard of the training split, a single process otherwise
+        distributed = init_distributed()
+        train_dataloader = distributed.shard(train_dataloader)
+
         # instatiate base model for training according to json hyperparameters 
         model = Transformer(
         inputVocab=len(note2in),outputVocab=len(chord2in), input_embedding_dim=input_embedding_dim,output_embedding_dim=output_embedding_dim
@@ -238,34 +447,63 @@ def main():
         loss_fn = nn.CrossEntropyLoss()
         optimizer = torch.optim.Adam(model.parameters(),amsgrad=True,lr=lr)
 
-        trainer = Trainer(model,loss_fn=loss_fn,optimizer=optimizer,train_dataloader=train_dataloader,test_dataloader=test_dataloader,device=device,scheduler=None)
+        # validation over the whole split, optionally every N steps in a background process
+        checkpointing = loaded_hyperparameters.get("checkpointing",{})
+        trainer = Trainer(model,loss_fn=loss_fn,optimizer=optimizer,train_dataloader=train_dataloader,test_dataloader=test_dataloader,device=device,scheduler=None,
+          eval_batch_size=loaded_hyperparameters.get("eval_batch_size",512),test_groups=loader.split_dataset_names()[1],
+          eval_every_steps=loaded_hyperparameters.get("eval_every_steps",0),background_eval=loaded_hyperparameters.get("background_eval",False),
+          run_log=run_log,profile_steps=profile_steps,eval_every_epochs=loaded_hyperparameters.get("eval_every_epochs",5),
+          checkpoint_dir=checkpointing.get("directory"),checkpoint_every=checkpointing.get("every_epochs",1),
+          keep_checkpoints=checkpointing.get("keep",3),early_stopping_patience=checkpointing.get("early_stopping_patience",0),
+          checkpoint_metadata={'vocab_options':loader.vocab_options,'vocab':(chord2in,in2chord,note2in,in2note)},
+          precision=precision or loaded_hyperparameters.get("precision","fp32"),distributed=distributed,
+          compile_mode=compile_mode or loaded_hyperparameters.get("compile_mode"))
         # scheduler linearly increses LR for first warmup_epochs epochs
         scheduler = LambdaLR(trainer.optimizer, lr_lambda=lambda epoch: (epoch + 1) / warmup_epochs if epoch < warmup_epochs else 1.0)
         trainer.scheduler = scheduler
 
+        # optimizer, scheduler, epoch and RNG state of the last checkpoint
+        if resume:
+            trainer.resume()
+
         trainer.train(num_epochs)
 
+        # the other ranks hold the same weights, rank 0 saves them
+        distributed.close()
+        if not distributed.is_main:
+            return
+
+        # keep the weights with the lowest validation loss rather than the last ones
+        if checkpointing.get("restore_best",True):
+            trainer.restore_best()
+
         # save newly trained model
-        trained_model = {'model':[model.kwargs,model.state_dict(),model.model_type]}
+        trained_model = trainer.model_checkpoint()
         
-        torch.save(trained_model,'Saved_Models/trained_model.pth')
+        atomic_save(trained_model,'Saved_Models/trained_model.pth')
         print("Saved model")
     else:
         if print_text:
             print("Loading pretrained model...")
 
-        # change path to use different model (defaults to pretrained)
-
-        main_model = torch.load('Saved_Models/pretrained_model.pth',map_location =device)
-        
-        model_kwargs,model_state,model_type = main_model['model']
+        # --model selects a different checkpoint (defaults to pretrained)
+        if checkpoint is None:
+            checkpoint = mapped_checkpoint.load_checkpoint(model_path,map_location=device)
 
-        model = Transformer(**model_kwargs)  
-        model.load_state_dict(model_state)
+        model = mapped_checkpoint.checkpoint_model(checkpoint,device)
         if print_text:
             print("Model loaded")
 
-    if eval_flag:
+    # inference precision (a model trained in this run keeps its training precision otherwise)
+    if precision and engine != "ngram":
+        model.set_precision(precision)
+    if attention and engine != "ngram":
+        model.set_attention(attention)
+
+    if eval_flag and chord_hmm is not None:
+        print("Evaluating chord HMM on validation set..")
+        print(chord_hmm.score(test_dataloader.dataset, in2note))
+    elif eval_flag:
         print("Evaluating model..")
         eval(train_dataloader,model,loader,device,printText=False)
         print("Successfully outputed example from test set")
@@ -327,7 +565,24 @@ def main():
             # default value on error
             temperature = 2.0
 
-        sequence = harmonize_melody(model,input_melody,device,loader,temp=temperature,k=k)
+        if chord_hmm is not None:
+            SOS_TOKEN, _ = loader.get_special_chars()
+            sequence = [SOS_TOKEN] + chord_hmm.harmonize(input_melody, mode=ngram_decode, temperature=temperature)
+        elif speculative > 0:
+            draft = repeat_last_draft
+            if draft_model == "ngram":
+                chord_hmm = ngram_engine.load_or_fit(NGRAM_ENGINE_PATH, training_split, in2chord, in2note)
+                next_chord, first_chord = chord_hmm.most_likely_transitions()
+                draft = TransitionDraft(next_chord, first_chord, chord2in[loader.get_special_chars()[0]])
+            stats = SpeculativeStats()
+            sequence = harmonize_melody(model,input_melody,device,loader,temp=temperature,k=k,
+                                        speculative=speculative,draft=draft,stats=stats)
+            if print_text:
+                print("Speculative decoding:", stats.stats())
+        else:
+            sequence = harmonize_melody(model,input_melody,device,loader,temp=temperature,k=k,
+                                        compile_mode=compile_mode)
+        sequence = replace_unknown_chords(sequence)
         if print_text:
             print("Output Chord Sequence: ")
             print(sequence)
@@ -338,5 +593,5 @@ def main():
             evaluation_helpers.outputDAWPhrase(evaluation_helpers.decode_stream(sequence[1:]))
        
 
-main()
-
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,276 @@
+"""
+Structured pruning of Model.Transformer: measures how much each attention head and each
+encoder/decoder layer matters on the validation split, removes the unimportant ones into
+a physically smaller checkpoint (per-layer head counts in kwargs['layer_heads']) and can
+fine-tune the result with Trainer.
+
+python3 model_pruning.py [--model path] [--out path] [--head-threshold D] [--layer-threshold D]
+    [--finetune-epochs N]
+"""
+import argparse
+import contextlib
+
+import torch
+import torch.nn as nn
+from torch.optim.lr_scheduler import LambdaLR
+
+from Model.Transformer import Transformer
+from mapped_checkpoint import checkpoint_model, load_checkpoint
+from Trainer.trainer import Trainer
+from Trainer.distillation import chord_accuracy, decode_latency_ms
+from song_dataloader import Song_Dataloader, SOS_TOKEN
+
+
+def attention_blocks(model):
+    """
+    Returns:
+    list of ((stack, layer index, kind), attention module) for every attention block,
+    kind is 'encoder', 'decoder_self' or 'decoder_cross' (the layer_heads keys)
+    """
+    blocks = []
+    for i, layer in enumerate(model.transformer.encoder.layers):
+        blocks.append((('encoder', i, 'encoder'), layer.self_attn))
+    for i, layer in enumerate(model.transformer.decoder.layers):
+        blocks.append((('decoder', i, 'decoder_self'), layer.self_attn))
+        blocks.append((('decoder', i, 'decoder_cross'), layer.multihead_attn))
+    return blocks
+
+
+def head_parameters(attention):
+    """
+    Per-projection weights of nn.MultiheadAttention or HeadAttention.
+
+    Returns:
+    (num_heads, head_dim, [(q weight, q bias), (k ...), (v ...)], (out weight, out bias))
+    """
+    if isinstance(attention, nn.MultiheadAttention):
+        q_w, k_w, v_w = attention.in_proj_weight.chunk(3)
+        q_b, k_b, v_b = attention.in_proj_bias.chunk(3)
+        return (attention.num_heads, attention.head_dim, [(q_w, q_b), (k_w, k_b), (v_w, v_b)],
+                (attention.out_proj.weight, attention.out_proj.bias))
+    return (attention.num_heads, attention.head_dim,
+            [(proj.weight, proj.bias) for proj in (attention.q_proj, attention.k_proj, attention.v_proj)],
+            (attention.out_proj.weight, attention.out_proj.bias))
+
+
+def validation_loss(model, dataloader, device):
+    """Token-weighted cross entropy over the whole dataloader"""
+    model.eval()
+    loss_fn = nn.CrossEntropyLoss(reduction='sum')
+    total_loss = tokens = 0
+    with torch.no_grad():
+        for inputs, targets in dataloader:
+            inputs = inputs.to(device)
+            targets = targets.to(device)
+
+            target_input = targets[:, :-1]
+            tgt_mask = model.get_tgt_mask(target_input.size(1), device)
+            output = model(inputs, target_input, tgt_mask)
+
+            total_loss += loss_fn(output.permute(0, 2, 1), targets[:, 1:]).item()
+            tokens += targets[:, 1:].numel()
+    return total_loss / tokens
+
+
+@contextlib.contextmanager
+def masked_head(attention, head):
+    """Zeroes the output projection columns of one head, i.e. removes its contribution"""
+    _, head_dim, _, (out_weight, _) = head_parameters(attention)
+    columns = slice(head * head_dim, (head + 1) * head_dim)
+    saved = out_weight.data[:, columns].clone()
+    out_weight.data[:, columns] = 0
+    try:
+        yield
+    finally:
+        out_weight.data[:, columns] = saved
+
+
+@contextlib.contextmanager
+def skipped_layer(model, stack, index):
+    """Runs the encoder or decoder stack without one of its layers"""
+    module = getattr(model.transformer, stack)
+    layers = module.layers
+    module.layers = nn.ModuleList([layer for i, layer in enumerate(layers) if i != index])
+    try:
+        yield
+    finally:
+        module.layers = layers
+
+
+def head_importance(model, dataloader, device, base_loss=None):
+    """
+    Returns:
+    dict of (stack, layer, kind) -> list of validation loss increases, one per head
+    """
+    base_loss = validation_loss(model, dataloader, device) if base_loss is None else base_loss
+    importance = {}
+    for block, attention in attention_blocks(model):
+        deltas = []
+        for head in range(head_parameters(attention)[0]):
+            with masked_head(attention, head):
+                deltas.append(validation_loss(model, dataloader, device) - base_loss)
+        importance[block] = deltas
+    return importance
+
+
+def layer_importance(model, dataloader, device, base_loss=None):
+    """
+    Returns:
+    dict of (stack, layer) -> validation loss increase when the layer is skipped
+    """
+    base_loss = validation_loss(model, dataloader, device) if base_loss is None else base_loss
+    importance = {}
+    for stack in ('encoder', 'decoder'):
+        for index in range(len(getattr(model.transformer, stack).layers)):
+            with skipped_layer(model, stack, index):
+                importance[(stack, index)] = validation_loss(model, dataloader, device) - base_loss
+    return importance
+
+
+def select_structure(heads, layers, head_threshold, layer_threshold):
+    """
+    Keeps every head and layer whose removal costs more than its threshold in validation
+    loss, and always at least the most important head of every block and layer of every stack.
+
+    Returns:
+    (dict of (stack, layer, kind) -> kept head indices, dict of stack -> kept layer indices)
+    """
+    kept_layers = {}
+    for stack in ('encoder', 'decoder'):
+        indices = [index for (s, index) in layers if s == stack]
+        kept = [index for index in indices if layers[(stack, index)] > layer_threshold]
+        kept_layers[stack] = kept or [max(indices, key=lambda index: layers[(stack, index)])]
+
+    kept_heads = {}
+    for block, deltas in heads.items():
+        kept = [head for head, delta in enumerate(deltas) if delta > head_threshold]
+        kept_heads[block] = kept or [max(range(len(deltas)), key=lambda head: deltas[head])]
+    return kept_heads, kept_layers
+
+
+def _copy_attention(source, target, heads):
+    _, head_dim, source_proj, (source_out_w, source_out_b) = head_parameters(source)
+    rows = torch.cat([torch.arange(head * head_dim, (head + 1) * head_dim) for head in heads])
+
+    for (weight, bias), proj in zip(source_proj, (target.q_proj, target.k_proj, target.v_proj)):
+        proj.weight.data.copy_(weight.data[rows])
+        proj.bias.data.copy_(bias.data[rows])
+    target.out_proj.weight.data.copy_(source_out_w.data[:, rows])
+    target.out_proj.bias.data.copy_(source_out_b.data)
+
+
+def prune_model(model, kept_heads, kept_layers):
+    """
+    Builds a physically smaller model holding only the kept heads and layers.
+
+    Returns:
+    Transformer whose kwargs carry the per-layer 'layer_heads' schema
+    """
+    layer_heads = {
+        'encoder': [len(kept_heads[('encoder', i, 'encoder')]) for i in kept_layers['encoder']],
+        'decoder_self': [len(kept_heads[('decoder', i, 'decoder_self')]) for i in kept_layers['decoder']],
+        'decoder_cross': [len(kept_heads[('decoder', i, 'decoder_cross')]) for i in kept_layers['decoder']],
+    }
+    kwargs = dict(model.kwargs, num_encoder_layers=len(kept_layers['encoder']),
+                  num_decoder_layers=len(kept_layers['decoder']), layer_heads=layer_heads)
+    pruned = Transformer(**kwargs)
+
+    # embeddings, positional tables and output projection are unchanged
+    source_state = model.state_dict()
+    shared = {name: value for name, value in source_state.items() if not name.startswith('transformer.')}
+    shared.update({name: value for name, value in source_state.items()
+                   if name.startswith(('transformer.encoder.norm.', 'transformer.decoder.norm.'))})
+    pruned.load_state_dict(shared, strict=False)
+
+    for stack in ('encoder', 'decoder'):
+        source_layers = getattr(model.transformer, stack).layers
+        target_layers = getattr(pruned.transformer, stack).layers
+        for target_layer, index in zip(target_layers, kept_layers[stack]):
+            source_layer = source_layers[index]
+            for name in ('linear1', 'linear2', 'norm1', 'norm2', 'norm3'):
+                if hasattr(target_layer, name):
+                    getattr(target_layer, name).load_state_dict(getattr(source_layer, name).state_dict())
+
+            if stack == 'encoder':
+                _copy_attention(source_layer.self_attn, target_layer.self_attn,
+                                kept_heads[('encoder', index, 'encoder')])
+            else:
+                _copy_attention(source_layer.self_attn, target_layer.self_attn,
+                                kept_heads[('decoder', index, 'decoder_self')])
+                _copy_attention(source_layer.multihead_attn, target_layer.multihead_attn,
+                                kept_heads[('decoder', index, 'decoder_cross')])
+
+    return pruned.to(next(model.parameters()).device)
+
+
+def print_report(heads, layers, kept_heads, kept_layers):
+    print("Layer importance (validation loss increase when skipped):")
+    for (stack, index), delta in layers.items():
+        status = "kept" if index in kept_layers[stack] else "removed"
+        print(f"   {stack} layer {index}: {delta:+.4f} ({status})")
+
+    print("Head importance (validation loss increase when masked):")
+    for (stack, index, kind), deltas in heads.items():
+        if index not in kept_layers[stack]:
+            continue
+        marks = ["{:+.4f}{}".format(delta, "" if head in kept_heads[(stack, index, kind)] else "x")
+                 for head, delta in enumerate(deltas)]
+        print(f"   {kind} layer {index}: {' '.join(marks)}")
+    print("   (x = removed)")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Prune attention heads and layers of a harmony model")
+    parser.add_argument("--model", default="Saved_Models/pretrained_model.pth")
+    parser.add_argument("--out", default="Saved_Models/pruned_model.pth")
+    parser.add_argument("--head-threshold", type=float, default=0.005,
+                        help="heads whose masking raises validation loss by at most this are removed")
+    parser.add_argument("--layer-threshold", type=float, default=0.005,
+                        help="layers whose removal raises validation loss by at most this are removed")
+    parser.add_argument("--finetune-epochs", type=int, default=0)
+    parser.add_argument("--lr", type=float, default=0.0001)
+    args = parser.parse_args()
+
+    device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
+    checkpoint = load_checkpoint(args.model, device)
+    loader = Song_Dataloader.for_checkpoint(checkpoint)
+    train_dataloader, test_dataloader, chord2in, in2chord, note2in, in2note = loader.load()
+
+    model = checkpoint_model(checkpoint, device)
+
+    print("Measuring head and layer importance...")
+    base_loss = validation_loss(model, test_dataloader, device)
+    heads = head_importance(model, test_dataloader, device, base_loss)
+    layers = layer_importance(model, test_dataloader, device, base_loss)
+    kept_heads, kept_layers = select_structure(heads, layers, args.head_threshold, args.layer_threshold)
+    print_report(heads, layers, kept_heads, kept_layers)
+
+    pruned = prune_model(model, kept_heads, kept_layers)
+    print("Pruned validation loss:", validation_loss(pruned, test_dataloader, device))
+
+    if args.finetune_epochs > 0:
+        print("Fine-tuning pruned model...")
+        optimizer = torch.optim.Adam(pruned.parameters(), amsgrad=True, lr=args.lr)
+        trainer = Trainer(pruned, optimizer=optimizer, loss_fn=nn.CrossEntropyLoss(),
+                          train_dataloader=train_dataloader, test_dataloader=test_dataloader, device=device,
+                          scheduler=LambdaLR(optimizer, lr_lambda=lambda epoch: 1.0),
+                          train_losses=[], test_losses=[])
+        pruned.train()
+        trainer.train(args.finetune_epochs)
+        pruned.eval()
+
+    torch.save({'model': [pruned.kwargs, pruned.state_dict(), pruned.model_type],
+                'vocab_options': loader.vocab_options, 'vocab': (chord2in, in2chord, note2in, in2note)}, args.out)
+    print("Saved pruned model to", args.out, "with layer_heads", pruned.kwargs['layer_heads'])
+
+    start_token = chord2in[SOS_TOKEN]
+    print(f"{'model':<10}{'parameters':>12}{'val loss':>10}{'accuracy':>10}{'latency (ms)':>14}")
+    for name, candidate in (("original", model), ("pruned", pruned)):
+        print(f"{name:<10}{sum(p.numel() for p in candidate.parameters()):>12,}"
+              f"{validation_loss(candidate, test_dataloader, device):>10.4f}"
+              f"{chord_accuracy(candidate, test_dataloader, device):>10.3f}"
+              f"{decode_latency_ms(candidate, test_dataloader.dataset, device, start_token):>14.2f}")
+
+
+if __name__ == "__main__":
+    main()
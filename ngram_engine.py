@@ -0,0 +1,272 @@
+"""
+Statistical chord engine: a first-order chord HMM estimated from the same corpus as
+the transformer. Chord-to-chord transitions form the hidden chain and every half-bar
+slot emits the pitch classes of its 8 melody frames. Only NumPy is needed to decode.
+"""
+import math
+import os
+import time
+
+import numpy as np
+
+# one chord per half bar = 8 sixteenth-note frames
+FRAMES_PER_SLOT = 8
+# melody frame classes: pitch classes 0-11 and rest
+NUM_NOTE_CLASSES = 13
+REST_CLASS = 12
+
+VITERBI = 'viterbi'
+SAMPLE = 'sample'
+
+
+def melody_to_classes(melody):
+    """[[midi note, duration in 16th notes], ...] -> array of frame classes (0-11, 12 = rest)"""
+    frames = []
+    for pitch, duration in melody:
+        note_class = REST_CLASS if pitch == "rest" else int(pitch) % 12
+        frames += [note_class] * int(duration)
+    return np.asarray(frames, dtype=np.int64)
+
+
+def slot_histograms(frame_classes, num_slots=None):
+    """
+    Counts the note classes of every half-bar slot.
+
+    Returns:
+    float array [num_slots, NUM_NOTE_CLASSES]
+    """
+    if num_slots is None:
+        num_slots = max(1, math.ceil(len(frame_classes) / FRAMES_PER_SLOT))
+    histograms = np.zeros((num_slots, NUM_NOTE_CLASSES), dtype=np.float32)
+    slots = np.minimum(np.arange(len(frame_classes)) // FRAMES_PER_SLOT, num_slots - 1)
+    np.add.at(histograms, (slots, frame_classes), 1.0)
+    return histograms
+
+
+class ChordHMM:
+    """
+    Parameters:
+    - chords: list of chord names, index = state id
+    - log_start: [num_chords] log P(first chord)
+    - log_transition: [num_chords, num_chords] log P(next chord | chord)
+    - log_emission: [num_chords, NUM_NOTE_CLASSES] log P(melody frame class | chord)
+    - emission_weight: (float) weight of each melody frame's log-likelihood
+    """
+
+    def __init__(self, chords, log_start, log_transition, log_emission, emission_weight=1.0):
+        self.chords = list(chords)
+        self.log_start = log_start
+        self.log_transition = log_transition
+        self.log_emission = log_emission
+        self.emission_weight = float(emission_weight)
+        # decoding works on float32 tables laid out so every reduction runs over contiguous rows:
+        # emission as [class, chord], transition as [to chord, from chord]
+        self._weighted_emission_t = np.ascontiguousarray(self.log_emission.T * self.emission_weight, dtype=np.float32)
+        self._transition_t = np.ascontiguousarray(self.log_transition.T, dtype=np.float32)
+        self._log_start = self.log_start.astype(np.float32)
+
+    @staticmethod
+    def note_classes(in2note):
+        """note id -> frame class lookup array, -1 for ids that are not melody frames (EOS)"""
+        note_class = np.full(len(in2note), -1, dtype=np.int64)
+        for note_id, note in in2note.items():
+            if note == "rest":
+                note_class[note_id] = REST_CLASS
+            elif isinstance(note, int):
+                note_class[note_id] = note
+        return note_class
+
+    @classmethod
+    def fit(cls, encoded_data, in2chord, in2note, alpha=1.0, prior_strength=32.0, emission_weight=0.25,
+            special_tokens=("<SOS>", "<EOS>", "<UNK>")):
+        """
+        Estimates the HMM from encoded [input frames, output chords] pairs as produced by
+        Song_Dataloader.load (input frames are note ids, outputs are SOS, one chord per slot, EOS).
+
+        Parameters:
+        - encoded_data: iterable of (input ids, output ids)
+        - in2chord/in2note: vocabularies used to encode the data
+        - alpha: (float) additive smoothing of the start and transition counts
+        - prior_strength: (float) frames of the corpus-wide pitch-class distribution mixed into
+            every chord's emission counts, so chords seen a handful of times don't overfit
+        - emission_weight: (float) weight of each frame's log-likelihood. Frames of a held note
+            repeat the same pitch class, so 8 frames are worth far fewer than 8 observations
+        - special_tokens: chord tokens that are never emitted as chords
+        """
+        num_chords = len(in2chord)
+        chords = [in2chord[i] for i in range(num_chords)]
+
+        note_class = cls.note_classes(in2note)
+
+        start_counts = np.zeros(num_chords)
+        transition_counts = np.zeros((num_chords, num_chords))
+        emission_counts = np.zeros((num_chords, NUM_NOTE_CLASSES))
+
+        for inputs, outputs in encoded_data:
+            classes = note_class[np.asarray(inputs)]
+            slot_chords = np.asarray(outputs[1:-1])
+
+            frames = len(slot_chords) * FRAMES_PER_SLOT
+            frame_chords = np.repeat(slot_chords, FRAMES_PER_SLOT)[:len(classes)]
+            classes = classes[:frames]
+            valid = classes >= 0
+            np.add.at(emission_counts, (frame_chords[valid], classes[valid]), 1.0)
+
+            start_counts[slot_chords[0]] += 1
+            np.add.at(transition_counts, (slot_chords[:-1], slot_chords[1:]), 1.0)
+
+        special = np.array([chord in special_tokens for chord in chords])
+
+        def normalize(counts):
+            counts = counts + alpha
+            return np.log(counts / counts.sum(axis=-1, keepdims=True))
+
+        log_start = normalize(start_counts)
+        log_transition = normalize(transition_counts)
+
+        corpus_distribution = emission_counts.sum(axis=0) / max(emission_counts.sum(), 1.0)
+        emission_counts = emission_counts + prior_strength * corpus_distribution + 1e-3
+        log_emission = np.log(emission_counts / emission_counts.sum(axis=-1, keepdims=True))
+
+        log_start[special] = -np.inf
+        log_transition[:, special] = -np.inf
+
+        return cls(chords, log_start, log_transition, log_emission, emission_weight)
+
+    def save(self, path):
+        np.savez(path, chords=np.asarray(self.chords), log_start=self.log_start,
+                 log_transition=self.log_transition, log_emission=self.log_emission,
+                 emission_weight=np.asarray(self.emission_weight))
+
+    @classmethod
+    def load(cls, path):
+        arrays = np.load(path, allow_pickle=False)
+        return cls(arrays["chords"].tolist(), arrays["log_start"], arrays["log_transition"], arrays["log_emission"],
+                   float(arrays["emission_weight"]))
+
+    def slot_log_likelihoods(self, frame_classes, num_slots=None):
+        """log P(melody of each slot | chord) as [num_slots, num_chords]"""
+        frame_classes = frame_classes[frame_classes >= 0]
+        return slot_histograms(frame_classes, num_slots) @ self._weighted_emission_t
+
+    def viterbi(self, emissions):
+        """Most likely chord sequence for [num_slots, num_chords] emission log-likelihoods"""
+        num_slots = emissions.shape[0]
+        states = np.arange(len(self.chords))
+        backpointers = np.zeros((num_slots, len(self.chords)), dtype=np.int64)
+
+        delta = self._log_start + emissions[0]
+        for t in range(1, num_slots):
+            # scores[to, from]
+            scores = self._transition_t + delta
+            backpointers[t] = np.argmax(scores, axis=1)
+            delta = scores[states, backpointers[t]] + emissions[t]
+
+        path = np.zeros(num_slots, dtype=np.int64)
+        path[-1] = np.argmax(delta)
+        for t in range(num_slots - 1, 0, -1):
+            path[t - 1] = backpointers[t, path[t]]
+        return path
+
+    def sample(self, emissions, temperature=1.0, rng=None):
+        """
+        Draws a chord sequence from the posterior (forward filtering, backward sampling)
+        with all log-probabilities divided by temperature.
+        """
+        rng = np.random.default_rng() if rng is None else rng
+        transition_t = self._transition_t / temperature
+        emissions = emissions / temperature
+
+        num_slots = emissions.shape[0]
+        forward = np.zeros_like(emissions)
+        forward[0] = self._log_start / temperature + emissions[0]
+        for t in range(1, num_slots):
+            forward[t] = _logsumexp(transition_t + forward[t - 1], axis=1) + emissions[t]
+
+        uniforms = rng.random(num_slots)
+        path = np.zeros(num_slots, dtype=np.int64)
+        path[-1] = _sample_log(forward[-1], uniforms[-1])
+        for t in range(num_slots - 2, -1, -1):
+            path[t] = _sample_log(forward[t] + transition_t[path[t + 1]], uniforms[t])
+        return path
+
+    def harmonize(self, melody, mode=VITERBI, temperature=1.0, rng=None):
+        """
+        Harmonizes a melody of [[midi note, duration in 16th notes], ...].
+
+        Returns:
+        list of chord names, one per half-bar slot
+        """
+        frame_classes = melody_to_classes(melody)
+        emissions = self.slot_log_likelihoods(frame_classes)
+        if mode == VITERBI:
+            path = self.viterbi(emissions)
+        else:
+            path = self.sample(emissions, temperature, rng)
+        return [self.chords[i] for i in path]
+
+    def most_likely_transitions(self):
+        """
+        Returns:
+        (most likely next chord id for every chord id, most likely first chord id)
+        """
+        return np.argmax(self.log_transition, axis=1), int(np.argmax(self.log_start))
+
+    def score(self, encoded_data, in2note):
+        """
+        Viterbi accuracy on encoded [input frames, output chords] pairs, for comparing the
+        engine against the transformer on the same validation split.
+
+        Returns:
+        dict with phrases, slot accuracy and mean decode time per phrase in microseconds
+        """
+        note_class = self.note_classes(in2note)
+        correct = total = 0
+        elapsed = 0.0
+        for inputs, outputs in encoded_data:
+            expected = np.asarray(outputs[1:-1])
+            start = time.perf_counter()
+            path = self.viterbi(self.slot_log_likelihoods(note_class[np.asarray(inputs)], len(expected)))
+            elapsed += time.perf_counter() - start
+            correct += int(np.sum(path == expected))
+            total += len(expected)
+
+        phrases = len(encoded_data)
+        return {
+            "phrases": phrases,
+            "slot_accuracy": correct / total if total else 0.0,
+            "decode_us": elapsed / phrases * 1e6 if phrases else 0.0,
+        }
+
+
+def load_or_fit(path, encoded_data, in2chord, in2note):
+    """
+    Loads the engine tables from path, or estimates them from encoded_data (the training
+    split, or a function returning it, called only when fitting) and saves them there so later
+    runs only need NumPy. Tables fitted on a different chord vocabulary (other canonicalization
+    or UNK options, a new dataset) are refitted, since their chord ids would not match in2chord.
+    """
+    if os.path.exists(path):
+        hmm = ChordHMM.load(path)
+        if hmm.chords == [in2chord[i] for i in range(len(in2chord))]:
+            return hmm
+        print(f"{path} was fitted on a different chord vocabulary, refitting")
+    if callable(encoded_data):
+        encoded_data = encoded_data()
+    hmm = ChordHMM.fit(encoded_data, in2chord, in2note)
+    hmm.save(path)
+    return hmm
+
+
+def _logsumexp(values, axis):
+    peak = np.max(values, axis=axis, keepdims=True)
+    peak = np.where(np.isfinite(peak), peak, 0.0)
+    # chords that can never occur (special tokens) sum to 0 -> log 0 = -inf, which is intended
+    with np.errstate(divide="ignore"):
+        return np.squeeze(peak, axis=axis) + np.log(np.sum(np.exp(values - peak), axis=axis))
+
+
+def _sample_log(log_weights, uniform):
+    """Inverse-CDF draw of an index from unnormalized log weights"""
+    cumulative = np.cumsum(np.exp(log_weights - np.max(log_weights)))
+    return min(int(np.searchsorted(cumulative, uniform * cumulative[-1], side="right")), len(cumulative) - 1)
@@ -0,0 +1,179 @@
+import threading
+from concurrent.futures import ThreadPoolExecutor, TimeoutError as FutureTimeoutError
+
+
+class DecodeCancelled(Exception):
+    """Raised when a harmonization request was superseded before or during decoding"""
+
+    def __init__(self, message="Request superseded by a newer request", queued=False):
+        super().__init__(message)
+        self.queued = queued
+
+
+class LatestWinsRegistry:
+    """
+    Tracks the newest sequence number seen per client so that stale requests can be
+    dropped while queued and aborted between decoding steps.
+
+    A request is superseded as soon as the same client_id has sent a request with a
+    higher sequence number. Requests without a client_id are never superseded.
+    """
+
+    def __init__(self):
+        self._latest = {}
+        self._lock = threading.Lock()
+
+        self.registered = 0
+        self.stale_on_arrival = 0
+        self.dropped_queued = 0
+        self.aborted_inflight = 0
+
+    def register(self, client_id, seq):
+        """
+        Records a new request. Returns False if a newer request from the same client
+        was already seen (the request is stale on arrival).
+        """
+        if client_id is None or seq is None:
+            return True
+
+        with self._lock:
+            self.registered += 1
+            latest = self._latest.get(client_id)
+            if latest is not None and seq < latest:
+                self.stale_on_arrival += 1
+                return False
+            self._latest[client_id] = seq
+            return True
+
+    def is_superseded(self, client_id, seq):
+        if client_id is None or seq is None:
+            return False
+        with self._lock:
+            return self._latest.get(client_id, seq) > seq
+
+    def abort_check(self, client_id, seq):
+        """Returns a zero-argument callable telling a decoder whether to stop"""
+        return lambda: self.is_superseded(client_id, seq)
+
+    def record_cancelled(self, error):
+        with self._lock:
+            if error.queued:
+                self.dropped_queued += 1
+            else:
+                self.aborted_inflight += 1
+
+    def stats(self):
+        with self._lock:
+            return {
+                'clients': len(self._latest),
+                'registered': self.registered,
+                'stale_on_arrival': self.stale_on_arrival,
+                'dropped_queued': self.dropped_queued,
+                'aborted_inflight': self.aborted_inflight,
+                'superseded_total': self.stale_on_arrival + self.dropped_queued + self.aborted_inflight,
+            }
+
+
+# what happens to the model decode when a request's latency budget expires
+FINISH = 'finish'  # keep decoding in the background, the result still fills the result cache
+CANCEL = 'cancel'  # abort the decode at the next step
+BUDGET_POLICIES = (FINISH, CANCEL)
+
+
+class LatencyBudget:
+    """
+    Runs model work on a thread pool under a per-request deadline. If the deadline
+    passes first, the fast path result is returned instead and the model work is
+    finished or cancelled in the background depending on the policy.
+
+    At most max_pending model runs are queued or running at a time, counting runs whose
+    budget expired but that still finish in the background; once that many are pending,
+    requests are answered by the fast path right away instead of queueing more work.
+
+    Parameters:
+    - max_workers: (int) threads available for model work running under a budget
+    - max_pending: (int) model runs queued or running at most, 2 * max_workers by default
+    """
+
+    def __init__(self, max_workers=4, max_pending=None):
+        self.executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix='harmonize-budget')
+        self._lock = threading.Lock()
+        self._pending = threading.BoundedSemaphore(max_pending or 2 * max_workers)
+
+        self.requests = 0
+        self.met = 0
+        self.missed = 0
+        self.overloaded = 0
+        self.model_failed = 0
+        self.background_finished = 0
+        self.background_cancelled = 0
+        self.background_failed = 0
+
+    def _record_background(self, future):
+        with self._lock:
+            error = future.exception()
+            if error is None:
+                self.background_finished += 1
+            elif isinstance(error, DecodeCancelled):
+                self.background_cancelled += 1
+            else:
+                self.background_failed += 1
+
+    def run(self, compute, fast_path, budget_seconds, policy=FINISH, cancel_event=None, answered_by_model=None):
+        """
+        Parameters:
+        - compute: zero-argument callable doing the model work
+        - fast_path: zero-argument callable returning the quick fallback result
+        - budget_seconds: (float) how long to wait for compute
+        - policy: 'finish' or 'cancel', applied to compute when the budget expires
+        - cancel_event: threading.Event that compute's decoder checks between steps
+        - answered_by_model: callable telling whether compute's value came from the model,
+          values it rejects (e.g. a fallback after a decoding error) count as model failures
+
+        Returns:
+        compute's value, or fast_path's when the budget expired or too many runs are pending
+        """
+        with self._lock:
+            self.requests += 1
+
+        if not self._pending.acquire(blocking=False):
+            with self._lock:
+                self.overloaded += 1
+            return fast_path()
+        try:
+            future = self.executor.submit(compute)
+        except BaseException:
+            self._pending.release()
+            raise
+        future.add_done_callback(lambda _: self._pending.release())
+
+        try:
+            value = future.result(timeout=budget_seconds)
+        except FutureTimeoutError:
+            with self._lock:
+                self.missed += 1
+            if policy == CANCEL and cancel_event is not None:
+                cancel_event.set()
+            future.add_done_callback(self._record_background)
+            return fast_path()
+
+        with self._lock:
+            if answered_by_model is not None and not answered_by_model(value):
+                self.model_failed += 1
+            else:
+                self.met += 1
+        return value
+
+    def stats(self):
+        with self._lock:
+            return {
+                'requests': self.requests,
+                'met': self.met,
+                'missed': self.missed,
+                'miss_rate': self.missed / self.requests if self.requests else 0.0,
+                'overloaded': self.overloaded,
+                'model_failed': self.model_failed,
+                'background_finished': self.background_finished,
+                'background_cancelled': self.background_cancelled,
+                'background_failed': self.background_failed,
+            }
@@ -1,22 +1,38 @@
 # backend/server.py
 
-from flask import Flask, request, jsonify
+from flask import Flask, request, jsonify, Response, stream_with_context
 from flask_cors import CORS
 import os
 import sys
 import json
 import argparse
+import contextlib
 import torch
 import numpy as np
 import math
+import random
+import threading
+import time
 
 # 添加当前目录到Python路径
 sys.path.append(os.path.dirname(os.path.abspath(__file__)))
 
 # 导入项目的核心模型文件
 try:
-    from Model.Transformer import Transformer
+    import mapped_checkpoint
     from song_dataloader import Song_Dataloader
+    from inference_cache import ResultCache, encoder_cache
+    from compiled_decoding import compiled_decoder
+    from decoding import (sample_next_token, SAMPLE, GREEDY, speculative_decode, repeat_last_draft,
+                          TransitionDraft, SpeculativeStats)
+    from harmonization_sessions import SessionStore, SessionError, SessionNotFound, FRAMES_PER_SLOT
+    from request_scheduler import LatestWinsRegistry, DecodeCancelled, LatencyBudget, BUDGET_POLICIES
+    from chord_streaming import StreamHub
+    import batch_harmonizer
+    import ngram_engine
+    import chord_canonicalizer
+    import chord_postprocessing
+    from chord_postprocessing import ChordTables
 
     print("✅ 成功导入模型相关模块")
 except ImportError as e:
@@ -50,6 +66,67 @@ chord2in = None
 in2chord = None
 note2in = None
 in2note = None
+model_path = None
+
+# n-gram/HMM 和弦引擎：纯 NumPy 解码，作为低延迟档位和 Transformer 的对照基线
+NGRAM_ENGINE_PATH = os.environ.get('HARMONY_NGRAM_ENGINE_PATH', 'Saved_Models/ngram_engine.npz')
+ENGINES = ('transformer', 'ngram')
+chord_hmm = None
+
+# 结果缓存：重复的相同请求直接返回缓存结果，并发的相同请求只计算一次
+RESULT_CACHE_MAX_ENTRIES = int(os.environ.get('HARMONY_RESULT_CACHE_SIZE', 512))
+RESULT_CACHE_TTL_SECONDS = float(os.environ.get('HARMONY_RESULT_CACHE_TTL', 300))
+result_cache = ResultCache(max_entries=RESULT_CACHE_MAX_ENTRIES, ttl_seconds=RESULT_CACHE_TTL_SECONDS)
+
+DECODE_MODES = (SAMPLE, GREEDY)
+
+# 推测解码：草稿模型每次提出的和弦数量（0 = 关闭），以及可选的草稿模型
+SPECULATIVE_DRAFT_LEN = int(os.environ.get('HARMONY_SPECULATIVE_DRAFT', 0))
+DRAFT_MODELS = ('repeat', 'ngram')
+speculative_stats = SpeculativeStats()
+
+# 同时运行的模型推理数量，其余请求排队；同一客户端更新的请求会让排队中或运行中的旧请求作废
+INFERENCE_WORKERS = int(os.environ.get('HARMONY_INFERENCE_WORKERS', 1))
+inference_slots = threading.BoundedSemaphore(INFERENCE_WORKERS)
+latest_wins = LatestWinsRegistry()
+
+# 推理精度：'bf16' 时模型在 bfloat16 autocast 下运行（权重保持 fp32），支持 AVX-512-BF16/AMX 的 CPU 上更快
+INFERENCE_PRECISION = os.environ.get('HARMONY_PRECISION', 'fp32')
+
+# 注意力实现：'sdpa' 时推理走融合的 scaled_dot_product_attention（因果标志、不生成注意力权重），数值与默认实现一致
+INFERENCE_ATTENTION = os.environ.get('HARMONY_ATTENTION', 'default')
+
+# torch.compile 模式（default / reduce-overhead / max-autotune），解码缓冲区填充到固定长度，图只编译一次；
+# 启动时预热，编译产物缓存在 HARMONY_COMPILE_CACHE 目录，重启后大部分无需重新编译
+COMPILE_MODE = os.environ.get('HARMONY_COMPILE')
+COMPILE_CACHE_DIR = os.environ.get('HARMONY_COMPILE_CACHE', 'Saved_Models/compile_cache')
+
+# 延迟预算：超过预算时先返回规则和弦（快速路径），模型解码按策略在后台完成或取消；
+# 排队和运行中的解码最多 HARMONY_BUDGET_PENDING 个，超出时直接走快速路径，后台任务不会无限堆积
+DEFAULT_BUDGET_MS = os.environ.get('HARMONY_DEFAULT_BUDGET_MS')
+DEFAULT_BUDGET_MS = float(DEFAULT_BUDGET_MS) if DEFAULT_BUDGET_MS else None
+DEFAULT_BUDGET_POLICY = os.environ.get('HARMONY_BUDGET_POLICY', 'finish')
+latency_budget = LatencyBudget(max_workers=int(os.environ.get('HARMONY_BUDGET_WORKERS', 4)),
+                               max_pending=int(os.environ.get('HARMONY_BUDGET_PENDING', 8)))
+
+# 流式输出：每个客户端一个 SSE 连接，多个和声流在同一连接上复用
+stream_hub = StreamHub()
+
+# 批量和声：进程池的工作进程数量与每批的乐句数量
+BATCH_WORKERS = int(os.environ.get('HARMONY_BATCH_WORKERS', 1))
+BATCH_SIZE = int(os.environ.get('HARMONY_BATCH_SIZE', 64))
+MAX_BATCH_MELODIES = int(os.environ.get('HARMONY_MAX_BATCH_MELODIES', 10000))
+# 多进程时所有批量请求共用一个进程池（首次使用时创建），工作进程只加载一次模型
+batch_pool = None
+batch_pool_lock = threading.Lock()
+
+# 实时键盘输入的增量和声会话，空闲超时后自动回收
+SESSION_IDLE_TIMEOUT = float(os.environ.get('HARMONY_SESSION_IDLE_TIMEOUT', 300))
+SESSION_MAX_ACTIVE = int(os.environ.get('HARMONY_SESSION_MAX_ACTIVE', 256))
+session_store = SessionStore(idle_timeout=SESSION_IDLE_TIMEOUT, max_sessions=SESSION_MAX_ACTIVE)
+
+# 和弦后处理（七和弦增强、重复和弦进行）的查找表，按和弦id预先计算
+chord_tables = ChordTables()
 
 def inspect_vocabulary():
     """Inspect vocabulary structure"""
@@ -80,7 +157,7 @@ def inspect_vocabulary():
 
 def load_model():
     """Load pre-trained Transformer model"""
-    global harmony_model, loader, device, chord2in, in2chord, note2in, in2note
+    global harmony_model, loader, device, chord2in, in2chord, note2in, in2note, model_path, chord_hmm
 
     print("🚀 Starting to load full Transformer model...")
 
@@ -89,10 +166,25 @@ def load_model():
     print(f"🖥️  Using device: {device}")
 
     try:
-        # 1. Load dataset and vocabulary
-        print("📊 Loading dataset and vocabulary...")
-        loader = Song_Dataloader()
-        train_dataloader, test_dataloader, chord2in, in2chord, note2in, in2note = loader.load()
+        # HARMONY_MODEL_PATH 可指定其他模型（例如蒸馏得到的 student_model.pth）
+        model_path = os.environ.get('HARMONY_MODEL_PATH', 'Saved_Models/pretrained_model.pth')
+        if not os.path.exists(model_path):
+            print(f"❌ Model file not found: {model_path}")
+            # Try fallback path
+            model_path = 'Saved_Models/trained_model.pth'
+
+        # 1. Load vocabulary (the chord vocabulary the checkpoint was trained with)
+        # 检查点只加载一次，词表和模型都从中读取；保存了词表的检查点不需要读取数据集
+        print("📊 Loading vocabulary...")
+        checkpoint = None
+        if os.path.exists(model_path):
+            print(f"📥 Loading model: {model_path}")
+            # 转换过的 .safetensors 检查点直接内存映射，多个 worker 共享同一份物理内存
+            checkpoint = mapped_checkpoint.load_checkpoint(model_path, map_location=device)
+            loader = Song_Dataloader.for_checkpoint(checkpoint)
+        else:
+            loader = Song_Dataloader()
+        chord2in, in2chord, note2in, in2note = loader.load_vocab()
 
         print(f"   Note vocabulary size: {len(note2in)}")
         print(f"   Chord vocabulary size: {len(chord2in)}")
@@ -100,29 +192,37 @@ def load_model():
         # Check vocabulary structure
         inspect_vocabulary()
 
-        # 2. Load pre-trained model
-        model_path = 'Saved_Models/pretrained_model.pth'
-        if not os.path.exists(model_path):
-            print(f"❌ Model file not found: {model_path}")
-            # Try fallback path
-            model_path = 'Saved_Models/trained_model.pth'
-            if not os.path.exists(model_path):
-                raise FileNotFoundError("Model file not found, please ensure the model has been trained and saved")
+        # 预先计算词表中所有和弦的后处理查找表
+        chord_tables.encode(clean_chord_format(chord) for chord in in2chord.values())
 
-        print(f"📥 Loading model: {model_path}")
-        main_model = torch.load(model_path, map_location=device)
+        # Load (or estimate from the training split) the chord HMM
+        try:
+            # 只有需要重新估计 HMM 时才读取训练集
+            chord_hmm = ngram_engine.load_or_fit(NGRAM_ENGINE_PATH, lambda: loader.load()[0].dataset,
+                                                 in2chord, in2note)
+            print(f"🎲 Chord HMM ready: {len(chord_hmm.chords)} chords ({NGRAM_ENGINE_PATH})")
+        except Exception as e:
+            print(f"⚠️  Chord HMM unavailable: {e}")
+
+        # 2. Pre-trained model
+        if checkpoint is None:
+            raise FileNotFoundError("Model file not found, please ensure the model has been trained and saved")
 
         # 3. Parse model information
-        model_kwargs, model_state, model_type = main_model['model']
+        model_kwargs, model_state, model_type = checkpoint['model']
 
         # 4. Instantiate model
         print("🔧 Instantiating Transformer model...")
         print(f"📋 Model parameters: {model_kwargs}")
 
-        harmony_model = Transformer(**model_kwargs)
-        harmony_model.load_state_dict(model_state)
-        harmony_model = harmony_model.to(device)
+        harmony_model = mapped_checkpoint.build_model(model_kwargs, model_state, device)
         harmony_model.eval()  # Set to evaluation mode
+        harmony_model.set_precision(INFERENCE_PRECISION)
+        print(f"🎚️  Inference precision: {INFERENCE_PRECISION}")
+        harmony_model.set_attention(INFERENCE_ATTENTION)
+        print(f"🎯 Attention: {INFERENCE_ATTENTION}")
+        if COMPILE_MODE:
+            compiled_decoder(harmony_model, COMPILE_MODE, COMPILE_CACHE_DIR).warmup()
 
         # 5. Print model info
         total_params = sum(p.numel() for p in harmony_model.parameters())
@@ -139,7 +239,8 @@ def load_model():
         return False
 
 def generate_with_transformer(model, src_sequence, max_new_tokens=10, temperature=1.0, top_k=20, start_token=1,
-                              pad_token=0):
+                              pad_token=0, decode_mode='sample', generator=None, should_abort=None, on_token=None,
+                              speculative=0, draft=None):
     """
     使用你的 Transformer 模型生成序列
 
@@ -151,6 +252,12 @@ def generate_with_transformer(model, src_sequence, max_new_tokens=10, temperatur
         top_k: top-k采样
         start_token: 开始token的ID
         pad_token: 填充token的ID
+        decode_mode: 'sample' (温度 + top-k 采样) 或 'greedy' (取最大概率)
+        generator: torch.Generator，用于可复现的采样
+        should_abort: 每一步之前调用，返回 True 时抛出 DecodeCancelled 停止生成
+        on_token: 每生成一个token立即调用 on_token(step, next_token)，用于流式输出
+        speculative: 推测解码时草稿每次提出的token数，0 表示逐个解码
+        draft: 草稿模型 draft(tokens, n) -> n 个和弦id，默认重复上一个和弦
     """
     model.eval()
     device = next(model.parameters()).device
@@ -165,42 +272,59 @@ def generate_with_transformer(model, src_sequence, max_new_tokens=10, temperatur
     print(f"🔮 开始生成，源序列形状: {src_sequence.shape}, 初始目标序列: {tgt_sequence.shape}")
 
     with torch.no_grad():
-        for step in range(max_new_tokens):
-            # 创建目标mask
-            tgt_len = tgt_sequence.size(1)
-            tgt_mask = model.get_tgt_mask(tgt_len).to(device)
+        # 编码器只运行一次（相同旋律的编码结果会被缓存），每一步只运行解码器
+        memory = encoder_cache.encode(model, src_sequence)
 
-            try:
-                # 前向传播
-                outputs = model(src_sequence, tgt_sequence, tgt_mask=tgt_mask)
-
-                # 获取最后一个时间步的logits
-                next_token_logits = outputs[:, -1, :] / temperature
-
-                # Top-k 采样
-                if top_k > 0:
-                    # 获取每个样本的top-k
-                    top_k_logits, top_k_indices = torch.topk(next_token_logits, min(top_k, next_token_logits.size(-1)))
-
-                    # 创建mask，只保留top-k的值
-                    filtered_logits = torch.full_like(next_token_logits, float('-inf'))
-                    filtered_logits.scatter_(-1, top_k_indices, top_k_logits)
-                    next_token_logits = filtered_logits
-
-                # 应用softmax得到概率分布
-                probs = torch.softmax(next_token_logits, dim=-1)
-
-                # 从分布中采样
-                next_token = torch.multinomial(probs, num_samples=1)
-
-                # 将新token添加到目标序列
-                tgt_sequence = torch.cat([tgt_sequence, next_token], dim=-1)
+        # 编译模式：记忆填充到固定帧数，目标序列在 decode_at 中填充到固定长度，形状不变无需重新编译
+        compiled = compiled_decoder(model, COMPILE_MODE, COMPILE_CACHE_DIR) if COMPILE_MODE else None
+        if compiled is not None and compiled.fits(src_sequence.size(1), max_new_tokens + 1):
+            memory, memory_mask = compiled.pad_memory(memory)
+        else:
+            compiled = None
 
-                print(f"   步骤 {step + 1}: 生成token {next_token.squeeze().cpu().tolist()}")
+        # 推测解码：草稿一次提出多个和弦，Transformer 用一次解码器前向传播验证，输出分布不变
+        speculative_tokens = None
+        if speculative > 0:
+            speculative_tokens = speculative_decode(model, tgt_sequence, memory, max_new_tokens,
+                                                    draft or repeat_last_draft, speculative, temperature, top_k,
+                                                    decode_mode, generator, speculative_stats)
 
-            except Exception as e:
-                print(f"⚠️  生成步骤 {step} 出错: {e}")
-                break
+        for step in range(max_new_tokens):
+            # 请求已被同一客户端的新请求取代，停止生成
+            if should_abort is not None and should_abort():
+                print(f"🛑 请求已被取代，在步骤 {step} 停止生成")
+                raise DecodeCancelled()
+
+            if speculative_tokens is not None:
+                # 推测解码生成器产出全部token后结束；其他异常不在这里吞掉，由调用方处理
+                try:
+                    next_token = next(speculative_tokens)
+                except StopIteration:
+                    break
+            else:
+                tgt_len = tgt_sequence.size(1)
+                try:
+                    if compiled is not None:
+                        logits = compiled.decode_at(tgt_sequence, tgt_len, memory, memory_mask)
+                        next_token = sample_next_token(logits, temperature, top_k, decode_mode, generator)
+                    else:
+                        # 创建目标mask，前向传播
+                        tgt_mask = model.get_tgt_mask(tgt_len, device)
+                        outputs = model.decode(tgt_sequence, memory, tgt_mask=tgt_mask)
+
+                        # 温度 + Top-k 采样（或贪心解码）
+                        next_token = sample_next_token(outputs[:, -1, :], temperature, top_k, decode_mode, generator)
+                except Exception as e:
+                    print(f"⚠️  生成步骤 {step} 出错: {e}")
+                    break
+
+            # 将新token添加到目标序列
+            tgt_sequence = torch.cat([tgt_sequence, next_token], dim=-1)
+
+            if on_token is not None:
+                on_token(step, next_token)
+
+            print(f"   步骤 {step + 1}: 生成token {next_token.squeeze().cpu().tolist()}")
 
     print(f"✅ 生成完成，最终序列形状: {tgt_sequence.shape}")
     return tgt_sequence
@@ -313,7 +437,7 @@ def convert_midi_to_vocab_index(midi_note, note2in, in2note):
     return 0
 
 
-def enhance_chords_with_sevenths(chord_sequence, melody_midi_notes, enhancement_probability=0.7):
+def enhance_chords_with_sevenths(chord_sequence, melody_midi_notes, enhancement_probability=0.7, seed=None):
     """
     智能地将三和弦转换为七和弦
 
@@ -321,68 +445,29 @@ def enhance_chords_with_sevenths(chord_sequence, melody_midi_notes, enhancement_
         chord_sequence: AI模型生成的和弦序列 ['G', 'D', 'C']
         melody_midi_notes: 原始旋律的MIDI音符 [64, 67, 60]
         enhancement_probability: 转换为七和弦的概率 (0.0-1.0)
+        seed: 随机种子，相同种子得到相同结果
 
     Returns:
         增强后的和弦序列 ['Gmaj7', 'D7', 'Cmaj7']
     """
-    import random
-
     print(f"🎨 开始增强和弦序列: {chord_sequence}")
 
-    enhanced_chords = []
-
     # 分析旋律的调性（简化版）
     melody_key = analyze_melody_key(melody_midi_notes)
     print(f"🎼 检测到的调性: {melody_key}")
 
-    for i, chord in enumerate(chord_sequence):
-        # 检查是否为简单三和弦（没有数字或修饰符）
-        if is_simple_triad(chord):
-            # 决定是否增强这个和弦
-            if random.random() < enhancement_probability:
-                enhanced_chord = suggest_seventh_chord(chord, i, len(chord_sequence), melody_key)
-                enhanced_chords.append(enhanced_chord)
-                print(f"   ✨ 增强: {chord} → {enhanced_chord}")
-            else:
-                enhanced_chords.append(chord)
-                print(f"   ➡️  保持: {chord}")
-        else:
-            # 已经是复杂和弦，保持不变
-            enhanced_chords.append(chord)
-            print(f"   ✅ 复杂和弦保持: {chord}")
+    # 整个序列一次查表完成
+    chord_ids = chord_tables.encode(chord_sequence)[None, :]
+    enhanced_ids = chord_tables.enhance_sevenths(chord_ids, [chord_postprocessing.key_index(melody_key)],
+                                                 probability=enhancement_probability,
+                                                 rng=np.random.default_rng(seed))
+    enhanced_chords = chord_tables.decode(enhanced_ids[0])
 
     print(f"🎉 增强完成: {enhanced_chords}")
     return enhanced_chords
 
 
-def is_simple_triad(chord):
-    """检查是否为简单三和弦"""
-    # 简单三和弦模式：C, Cm, D, F#, Bb 等
-    # 不包含数字(7, 9, 11等)或复杂修饰符
-    import re
-
-    # 移除空格
-    chord = chord.strip()
-
-    # 匹配简单三和弦模式
-    simple_patterns = [
-        r'^[A-G][#b]?$',  # C, D#, Bb
-        r'^[A-G][#b]?m$',  # Cm, F#m, Bbm
-        r'^[A-G][#b]?M$',  # CM (大写M表示大调)
-        r'^[A-G][#b]?maj$',  # Cmaj
-        r'^[A-G][#b]?min$',  # Cmin
-        r'^[A-G][#b]?dim$',  # Cdim
-        r'^[A-G][#b]?aug$',  # Caug
-    ]
-
-    for pattern in simple_patterns:
-        if re.match(pattern, chord):
-            return True
-
-    return False
-
-
-def suggest_seventh_chord(basic_chord, position, total_chords, key='C'):
+def suggest_seventh_chord(basic_chord, position, total_chords, key='C', rng=None):
     """
     根据和弦在进行中的位置和调性，建议合适的七和弦
 
@@ -391,6 +476,7 @@ def suggest_seventh_chord(basic_chord, position, total_chords, key='C'):
         position: 在和弦进行中的位置 (0, 1, 2...)
         total_chords: 总和弦数量
         key: 调性
+        rng: numpy 随机数生成器（可选，用于复现结果）
 
     Returns:
         建议的七和弦 'G7' 或 'Gmaj7'
@@ -401,42 +487,23 @@ def suggest_seventh_chord(basic_chord, position, total_chords, key='C'):
     chord_quality = extract_chord_quality(basic_chord)
 
     # 根据功能和位置决定七和弦类型
-    seventh_type = decide_seventh_type(root, chord_quality, position, total_chords, key)
+    seventh_type = decide_seventh_type(root, chord_quality, position, total_chords, key, rng)
 
     # 构建最终和弦
-    if chord_quality == 'minor':
-        result = f"{root}m7"
-    elif chord_quality == 'diminished':
-        result = f"{root}dim7"
-    elif chord_quality == 'augmented':
-        result = f"{root}aug7"
-    else:  # major
-        result = f"{root}{seventh_type}"
-
-    return result
+    return chord_postprocessing.seventh_name(root, chord_quality, seventh_type)
 
 
 def extract_chord_root(chord):
     """提取和弦根音"""
-    import re
-    match = re.match(r'([A-G][#b]?)', chord)
-    return match.group(1) if match else 'C'
+    return chord_canonicalizer.chord_root(chord)
 
 
 def extract_chord_quality(chord):
     """提取和弦性质"""
-    chord_lower = chord.lower()
-    if 'm' in chord_lower or 'min' in chord_lower:
-        return 'minor'
-    elif 'dim' in chord_lower:
-        return 'diminished'
-    elif 'aug' in chord_lower:
-        return 'augmented'
-    else:
-        return 'major'
+    return chord_canonicalizer.chord_quality(chord)
 
 
-def decide_seventh_type(root, quality, position, total_chords, key):
+def decide_seventh_type(root, quality, position, total_chords, key, rng=None):
     """
     决定使用哪种七和弦
 
@@ -446,58 +513,12 @@ def decide_seventh_type(root, quality, position, total_chords, key):
     - 下属和弦（IV级）通常用大七和弦 (maj7)
     - 小调和弦通常用小七和弦 (m7)
     - 结束位置倾向于稳定的大七和弦
-    """
-
-    # 简化的功能分析
-    key_center = key[0] if key else 'C'  # 提取调性主音
 
-    # 计算根音与调性主音的关系
-    note_circle = ['C', 'C#', 'D', 'D#', 'E', 'F', 'F#', 'G', 'G#', 'A', 'A#', 'B']
-
-    try:
-        key_idx = note_circle.index(key_center)
-        root_clean = root.replace('#', '#').replace('b', 'b')  # 标准化
-
-        # 处理异名同音
-        if root_clean == 'Db' and 'C#' in note_circle:
-            root_clean = 'C#'
-        elif root_clean == 'Eb' and 'D#' in note_circle:
-            root_clean = 'D#'
-        # 可以添加更多异名同音处理
-
-        if root_clean in note_circle:
-            root_idx = note_circle.index(root_clean)
-            interval = (root_idx - key_idx) % 12
-        else:
-            interval = 0  # 默认
-    except:
-        interval = 0
-
-    # 根据音程关系决定七和弦类型
-    if interval == 7:  # 属音（V级）
-        return '7'  # 属七和弦
-    elif interval == 0:  # 主音（I级）
-        if quality == 'minor':
-            return 'm7'
-        else:
-            return 'maj7'  # 主大七和弦
-    elif interval == 5:  # 下属音（IV级）
-        if quality == 'minor':
-            return 'm7'
-        else:
-            return 'maj7'  # 下属大七和弦
-    elif quality == 'minor':
-        return 'm7'  # 小七和弦
-    elif position == total_chords - 1:  # 最后一个和弦
-        return 'maj7'  # 稳定的结束
-    else:
-        # 默认规则
-        if quality == 'minor':
-            return 'm7'
-        else:
-            # 随机选择增加变化
-            import random
-            return random.choice(['maj7', '7']) if random.random() < 0.6 else 'maj7'
+    规则表见 chord_postprocessing.SEVENTH_PRIMARY
+    """
+    interval = chord_postprocessing.interval_from_key(root, key)
+    position_class = chord_postprocessing.LAST if position == total_chords - 1 else chord_postprocessing.MIDDLE
+    return chord_postprocessing.seventh_type(quality, interval, position_class, rng)
 
 
 def analyze_melody_key(midi_notes):
@@ -547,58 +568,94 @@ def calculate_smart_chord_length(melody_length):
         return min(melody_length // 4 + 2, 8)  # 长旋律最多8个和弦
 
 
-def harmonize_melody_transformer(melody, temperature=1.0, k=20):
-    """简化版：直接使用 Transformer 模型生成和弦，相信模型判断"""
-    global harmony_model, device, chord2in, in2chord, note2in, in2note
+def prepare_transformer_inputs(melody):
+    """
+    将旋律转换为 Transformer 的输入
 
-    if harmony_model is None:
-        raise Exception("模型未加载")
+    Returns:
+        (src_sequence, smart_length, start_token, pad_token, midi_notes)
+    """
+    # 1. 提取MIDI音符
+    midi_notes = [note_dur[0] for note_dur in melody]
+    print(f"📝 MIDI音符序列: {midi_notes}")
 
-    try:
-        print(f"🎵 使用 Transformer 模型处理旋律: {melody}")
+    # 2. 转换MIDI到模型词汇
+    note_indices = []
+    for i, midi_note in enumerate(midi_notes):
+        try:
+            index = convert_midi_to_vocab_index(midi_note, note2in, in2note)
+            note_indices.append(index)
+            print(f"   音符 {i + 1}: MIDI {midi_note} -> 索引 {index}")
+        except Exception as e:
+            print(f"   ❌ 转换音符 {midi_note} 失败: {e}")
+            note_indices.append(1)  # 安全默认值
 
-        # 1. 提取MIDI音符
-        midi_notes = [note_dur[0] for note_dur in melody]
-        print(f"📝 MIDI音符序列: {midi_notes}")
+    if not note_indices:
+        raise Exception("无法转换任何输入音符到词汇表索引")
 
-        # 2. 转换MIDI到模型词汇
-        note_indices = []
-        for i, midi_note in enumerate(midi_notes):
-            try:
-                index = convert_midi_to_vocab_index(midi_note, note2in, in2note)
-                note_indices.append(index)
-                print(f"   音符 {i + 1}: MIDI {midi_note} -> 索引 {index}")
-            except Exception as e:
-                print(f"   ❌ 转换音符 {midi_note} 失败: {e}")
-                note_indices.append(1)  # 安全默认值
+    # 3. 准备模型输入
+    src_sequence = torch.tensor([note_indices], dtype=torch.long).to(device)
+    print(f"📊 源序列张量形状: {src_sequence.shape}")
+
+    # 4. ✅ 智能生成长度
+    smart_length = calculate_smart_chord_length(len(melody))
+    print(f"🧠 智能长度计算: {len(melody)}个音符 → {smart_length}个和弦")
+
+    # 5. 确定特殊token
+    start_token = 1
+    pad_token = 0
+
+    # 尝试找到真实的特殊token
+    for token_name in ['<START>', '<start>', 'START', '<SOS>', '<BOS>']:
+        if token_name in chord2in:
+            start_token = chord2in[token_name]
+            break
+
+    for token_name in ['<PAD>', '<pad>', 'PAD', '<UNK>']:
+        if token_name in chord2in:
+            pad_token = chord2in[token_name]
+            break
+
+    print(f"🎯 使用开始token: {start_token}, 填充token: {pad_token}")
+
+    return src_sequence, smart_length, start_token, pad_token, midi_notes
 
-        if not note_indices:
-            raise Exception("无法转换任何输入音符到词汇表索引")
 
-        # 3. 准备模型输入
-        src_sequence = torch.tensor([note_indices], dtype=torch.long).to(device)
-        print(f"📊 源序列张量形状: {src_sequence.shape}")
+def make_generator(seed):
+    """seed 不为 None 时返回独立的随机数生成器"""
+    if seed is None:
+        return None
+    generator = torch.Generator(device=device)
+    generator.manual_seed(seed)
+    return generator
 
-        # 4. ✅ 智能生成长度
-        smart_length = calculate_smart_chord_length(len(melody))
-        print(f"🧠 智能长度计算: {len(melody)}个音符 → {smart_length}个和弦")
 
-        # 5. 确定特殊token
-        start_token = 1
-        pad_token = 0
+def make_draft(draft_model, start_token):
+    """推测解码的草稿模型：'ngram' 沿 HMM 最可能的和弦转移（词表一致时），否则重复上一个和弦"""
+    if draft_model == 'ngram' and chord_hmm is not None \
+            and chord_hmm.chords == [in2chord[i] for i in range(len(in2chord))]:
+        next_chord, first_chord = chord_hmm.most_likely_transitions()
+        return TransitionDraft(next_chord, first_chord, start_token)
+    return repeat_last_draft
 
-        # 尝试找到真实的特殊token
-        for token_name in ['<START>', '<start>', 'START', '<SOS>', '<BOS>']:
-            if token_name in chord2in:
-                start_token = chord2in[token_name]
-                break
 
-        for token_name in ['<PAD>', '<pad>', 'PAD', '<UNK>']:
-            if token_name in chord2in:
-                pad_token = chord2in[token_name]
-                break
+def harmonize_melody_transformer(melody, temperature=1.0, k=20, seed=None, decode_mode='sample', should_abort=None,
+                                 speculative=0, draft_model='ngram'):
+    """简化版：直接使用 Transformer 模型生成和弦，相信模型判断
 
-        print(f"🎯 使用开始token: {start_token}, 填充token: {pad_token}")
+    seed 不为 None 时使用独立的随机数生成器，相同的输入和 seed 会得到相同的和弦
+    speculative > 0 时使用推测解码，draft_model 为 'repeat' 或 'ngram'
+    """
+    global harmony_model, device, chord2in, in2chord, note2in, in2note
+
+    if harmony_model is None:
+        raise Exception("模型未加载")
+
+    try:
+        print(f"🎵 使用 Transformer 模型处理旋律: {melody}")
+
+        src_sequence, smart_length, start_token, pad_token, midi_notes = prepare_transformer_inputs(melody)
+        generator = make_generator(seed)
 
         # 6. ✅ 生成和弦序列
         print("🧠 开始使用Transformer生成和弦...")
@@ -609,7 +666,12 @@ def harmonize_melody_transformer(melody, temperature=1.0, k=20):
             temperature=temperature,
             top_k=k,
             start_token=start_token,
-            pad_token=pad_token
+            pad_token=pad_token,
+            decode_mode=decode_mode,
+            generator=generator,
+            should_abort=should_abort,
+            speculative=speculative,
+            draft=make_draft(draft_model, start_token) if speculative > 0 else None
         )
 
         print(f"🔮 生成的序列: {generated_sequence[0].cpu().tolist()}")
@@ -697,31 +759,19 @@ def harmonize_melody_transformer(melody, temperature=1.0, k=20):
         # 然后正常 return final_chords
         return final_chords
 
+    except DecodeCancelled:
+        raise
     except Exception as e:
+        # 不在这里静默回退：由 harmonize_cached 以 fallback 档位作答，客户端和延迟预算统计才能看到真实档位
         print(f"❌ Transformer 处理失败: {str(e)}")
         import traceback
         traceback.print_exc()
-        print("🔄 回退到简单规则...")
-        return harmonize_melody_simple(melody, temperature, k)
+        raise
 
 
 def clean_chord_format(chord_name):
     """只修复明显的格式错误，不改变音乐内容"""
-    if not chord_name or not isinstance(chord_name, str):
-        return 'C'
-
-    chord = chord_name.strip()
-
-    # 只修复明显的双字母错误
-    if 'mm' in chord and not 'dim' in chord:  # 避免影响dim和弦
-        chord = chord.replace('mm', 'm')  # Dmm7 -> Dm7
-
-    # 移除明显的无效字符，但保持音乐符号
-    import re
-    if not re.match(r'^[A-G][#b]?', chord):
-        return 'C'  # 如果开头不是音符，返回默认
-
-    return chord
+    return chord_canonicalizer.clean_format(chord_name)
 
 def generate_chords_from_notes_smart(midi_notes):
     """基于MIDI音符生成智能和弦的方法"""
@@ -768,51 +818,14 @@ def standardize_chord_name(chord_name):
     Returns:
         标准化的和弦名称 'Am7', 'Dm', 'G#m7' 等
     """
-    if not chord_name or not isinstance(chord_name, str):
+    # 空值和特殊标记返回默认和弦
+    if not chord_name or not isinstance(chord_name, str) or chord_canonicalizer.is_special_token(chord_name.strip()):
         return 'C'
 
-    # 移除多余的空格
-    chord = chord_name.strip()
-
-    # 如果是特殊标记，返回默认和弦
-    special_tokens = ['<EOS>', '<SOS>', '<PAD>', '<UNK>', '<MASK>', '<START>', '<END>']
-    if chord in special_tokens or (chord.startswith('<') and chord.endswith('>')):
-        return 'C'
-
-    # 修复常见的错误模式
-    fixes = [
-        # 双m问题：Amm7 -> Am7, Dmm -> Dm
-        (r'([A-G][#b]?)mm(\d*)', lambda m: f"{m.group(1)}m{m.group(2) if m.group(2) else '7'}"),
-
-        # 重复的修饰符：C##7 -> C#7, Bbb -> Bb
-        (r'([A-G])##', r'\1#'),
-        (r'([A-G])bb', r'\1b'),
-
-        # 标准化maj表示法：CM -> Cmaj, C_maj -> Cmaj
-        (r'([A-G][#b]?)M(\d*)', r'\1maj\2'),
-        (r'([A-G][#b]?)_maj', r'\1maj'),
-
-        # 标准化min表示法：Cmin -> Cm, C_min -> Cm
-        (r'([A-G][#b]?)min(\d*)', r'\1m\2'),
-        (r'([A-G][#b]?)_min', r'\1m'),
-
-        # 修复异常的数字位置：C7m -> Cm7
-        (r'([A-G][#b]?)(\d+)m', r'\1m\2'),
-
-        # 标准化增减和弦：Caug -> C+, Cdim -> C°
-        (r'([A-G][#b]?)aug', r'\1+'),
-        (r'([A-G][#b]?)dim', r'\1°'),
-
-        # 移除无效字符
-        (r'[^\w#b+°]', ''),
-    ]
-
-    import re
-    for pattern, replacement in fixes:
-        chord = re.sub(pattern, replacement, chord)
+    chord = chord_canonicalizer.standardize(chord_name)
 
     # 验证和弦名称的基本格式
-    if not re.match(r'^[A-G][#b]?', chord):
+    if chord is None:
         print(f"⚠️  无效的和弦名称格式: '{chord_name}' -> 使用默认 'C'")
         return 'C'
 
@@ -825,30 +838,7 @@ def standardize_chord_name(chord_name):
 
 def validate_chord_quality(chord):
     """验证和弦是否为有效的音乐和弦"""
-
-    # 提取根音
-    import re
-    root_match = re.match(r'^([A-G][#b]?)', chord)
-    if not root_match:
-        return False
-
-    root = root_match.group(1)
-    suffix = chord[len(root):]
-
-    # 有效的和弦后缀
-    valid_suffixes = [
-        '', 'maj', 'm', 'min',  # 基本三和弦
-        '7', 'maj7', 'm7', 'min7',  # 七和弦
-        'dim', 'dim7', '°', '°7',  # 减和弦
-        'aug', '+', '+7',  # 增和弦
-        '9', 'maj9', 'm9',  # 九和弦
-        '11', '13',  # 延伸和弦
-        'sus2', 'sus4',  # 挂留和弦
-        '6', 'm6', 'maj6',  # 六和弦
-        'add9', 'add11'  # 加音和弦
-    ]
-
-    return suffix in valid_suffixes
+    return chord_canonicalizer.is_valid_quality(chord)
 
 
 def enhance_chord_sequence_with_validation(chord_sequence):
@@ -884,30 +874,7 @@ def enhance_chord_sequence_with_validation(chord_sequence):
 
 def suggest_valid_chord_alternative(invalid_chord):
     """为无效和弦建议有效的替代方案"""
-
-    # 提取根音
-    import re
-    root_match = re.match(r'^([A-G][#b]?)', invalid_chord)
-    if root_match:
-        root = root_match.group(1)
-
-        # 根据根音的特点建议合适的和弦
-        root_note_idx = {'C': 0, 'C#': 1, 'D': 2, 'D#': 3, 'E': 4, 'F': 5,
-                         'F#': 6, 'G': 7, 'G#': 8, 'A': 9, 'A#': 10, 'B': 11}
-
-        if root in root_note_idx:
-            idx = root_note_idx[root]
-
-            # 根据音程特点选择和弦类型
-            if idx in [0, 5, 7]:  # C, F, G - 常用的大调和弦
-                return f"{root}maj7"
-            elif idx in [2, 4, 9]:  # D, E, A - 常用的小调和弦
-                return f"{root}m7"
-            else:
-                return f"{root}7"  # 其他用属七和弦
-
-    # 如果无法提取根音，返回默认
-    return 'Cmaj7'
+    return chord_canonicalizer.suggest_alternative(invalid_chord)
 
 
 # 在 harmonize_melody_transformer 函数中集成验证
@@ -929,58 +896,20 @@ def integrate_chord_validation_in_transformer(basic_chords):
 def ensure_musical_progression(chord_sequence):
     """确保和弦进行符合基本的音乐逻辑"""
 
-    # 如果和弦进行中有太多相同的和弦，增加变化
-    if len(set(chord_sequence)) == 1 and len(chord_sequence) > 1:
-        root_chord = chord_sequence[0]
-        root = extract_chord_root(root_chord)
-
-        # 创建简单的 I-vi-IV-V 进行
-        progressions = {
-            'C': ['Cmaj7', 'Am7', 'Fmaj7', 'G7'],
-            'G': ['Gmaj7', 'Em7', 'Cmaj7', 'D7'],
-            'D': ['Dmaj7', 'Bm7', 'Gmaj7', 'A7'],
-            'A': ['Amaj7', 'F#m7', 'Dmaj7', 'E7'],
-            'E': ['Emaj7', 'C#m7', 'Amaj7', 'B7'],
-            'F': ['Fmaj7', 'Dm7', 'Bbmaj7', 'C7'],
-        }
-
-        if root in progressions:
-            prog = progressions[root]
-            result = prog[:len(chord_sequence)]
-            print(f"🎵 优化重复和弦进行: {chord_sequence} -> {result}")
-            return result
+    # 如果和弦进行中有太多相同的和弦，换成该根音的 I-vi-IV-V 进行
+    chord_ids = chord_tables.encode(chord_sequence)[None, :]
+    varied_ids, lengths = chord_tables.vary_repeated(chord_ids)
+    result = chord_tables.decode(varied_ids[0, :lengths[0]])
 
-    return chord_sequence
+    if result != list(chord_sequence):
+        print(f"🎵 优化重复和弦进行: {chord_sequence} -> {result}")
+    return result
 
-# 🆕 更新 is_simple_triad 函数，避免将 <EOS> 认为是复杂和弦
 def is_simple_triad(chord):
-    """检查是否为简单三和弦"""
-    import re
-
-    # 移除空格
-    chord = chord.strip()
+    """检查是否为简单三和弦（特殊标记如 <EOS> 不算）"""
+    return chord_canonicalizer.is_simple_triad(chord)
 
-    # 🆕 如果是特殊标记，直接返回 False
-    special_tokens = ['<EOS>', '<SOS>', '<PAD>', '<UNK>', '<MASK>', '<START>', '<END>']
-    if chord in special_tokens or chord.startswith('<') and chord.endswith('>'):
-        return False
 
-    # 匹配简单三和弦模式
-    simple_patterns = [
-        r'^[A-G][#b]?$',  # C, D#, Bb
-        r'^[A-G][#b]?m$',  # Cm, F#m, Bbm
-        r'^[A-G][#b]?M$',  # CM (大写M表示大调)
-        r'^[A-G][#b]?maj$',  # Cmaj
-        r'^[A-G][#b]?min$',  # Cmin
-        r'^[A-G][#b]?dim$',  # Cdim
-        r'^[A-G][#b]?aug$',  # Caug
-    ]
-
-    for pattern in simple_patterns:
-        if re.match(pattern, chord):
-            return True
-
-    return False
 def generate_chords_from_notes(midi_notes):
     """基于MIDI音符生成简单和弦的备用方法"""
     note_names = ['C', 'C#', 'D', 'D#', 'E', 'F', 'F#', 'G', 'G#', 'A', 'A#', 'B']
@@ -1022,6 +951,91 @@ def harmonize_melody_simple(melody, temperature=1.0, k=20):
     return ["Cmaj7", "Dm7", "G7"]
 
 
+def harmonize_melody_ngram(melody, temperature=1.0, decode_mode='sample', seed=None):
+    """使用 n-gram/HMM 引擎生成和弦：greedy 对应 Viterbi，sample 对应按温度采样"""
+    mode = ngram_engine.VITERBI if decode_mode == GREEDY else ngram_engine.SAMPLE
+    rng = np.random.default_rng(seed)
+    chords = chord_hmm.harmonize(melody, mode=mode, temperature=temperature, rng=rng)
+    return [clean_chord_format(chord) for chord in chords]
+
+
+def harmonize_fast_path(melody, temperature, k, decode_mode='sample', seed=None):
+    """低延迟档位：优先使用 HMM 引擎，未加载时回退到规则表"""
+    if chord_hmm is not None:
+        chords = harmonize_melody_ngram(melody, temperature, decode_mode, seed)
+        return {'chords': chords, 'seed': seed, 'model_info': "Chord HMM (n-gram engine)", 'tier': 'ngram'}
+    return harmonize_fallback(melody, temperature, k)
+
+
+def harmonize_fallback(melody, temperature, k):
+    """规则表档位：模型未加载或解码失败时作答"""
+    chords = harmonize_melody_simple(melody, temperature, k)
+    return {'chords': chords, 'seed': None, 'model_info': "Simplified Harmony Model (fallback)", 'tier': 'fallback'}
+
+
+def encode_melody_key(melody):
+    """将旋律转换为可哈希的缓存键 ((midi, duration), ...)"""
+    encoded = []
+    for note_dur in melody:
+        pitch, duration = note_dur[0], note_dur[1]
+        pitch = 'rest' if pitch == 'rest' else int(pitch)
+        encoded.append((pitch, int(duration)))
+    return tuple(encoded)
+
+
+def harmonize_cached(melody, temperature, k, decode_mode='sample', seed=None, should_abort=None, engine='transformer',
+                     speculative=0, draft_model='ngram'):
+    """
+    Runs harmonization through the result cache.
+
+    Requests without a seed share one cache entry per (melody, temperature, k, decode_mode, engine);
+    the seed actually used is returned so the client can reproduce the result later.
+    Model work waits for one of the inference slots; should_abort is checked once the
+    slot is acquired and between decoding steps, raising DecodeCancelled.
+    The 'ngram' engine (and the transformer when it isn't loaded) goes through the fast path.
+    If transformer decoding fails, the rule based fallback answers with tier 'fallback' and
+    cache status 'error'; neither errors nor fallback results are cached.
+    Speculative decoding keeps the output distribution but consumes the seed differently,
+    so its settings are part of the key.
+
+    Returns:
+    (result dict with 'chords', 'seed', 'model_info', 'tier', cache status)
+    """
+    key = (encode_melody_key(melody), float(temperature), int(k), decode_mode, seed, engine,
+           speculative, draft_model if speculative > 0 else None)
+
+    def compute():
+        run_seed = seed if seed is not None else random.randrange(2 ** 31)
+        if engine == 'transformer' and harmony_model is not None:
+            with inference_slots:
+                if should_abort is not None and should_abort():
+                    raise DecodeCancelled("Request superseded while queued", queued=True)
+
+                print("🧠 Using custom Transformer model for chord generation...")
+                chords = harmonize_melody_transformer(melody, temperature, k, seed=run_seed, decode_mode=decode_mode,
+                                                      should_abort=should_abort, speculative=speculative,
+                                                      draft_model=draft_model)
+            return {'chords': chords, 'seed': run_seed, 'model_info': "Custom Transformer Harmony Model",
+                    'tier': 'transformer'}
+
+        if engine == 'transformer':
+            print("⚠️  Transformer model not loaded, using fast path...")
+        return harmonize_fast_path(melody, temperature, k, decode_mode, run_seed)
+
+    while True:
+        try:
+            # 只缓存模型真正给出的结果，规则表的 fallback 下次重新计算
+            return result_cache.get_or_compute(key, compute, cacheable=lambda result: result['tier'] != 'fallback')
+        except DecodeCancelled:
+            # a coalesced computation started by a superseded request was cancelled,
+            # but this request is still current and has to compute the result itself
+            if should_abort is not None and should_abort():
+                raise
+        except Exception:
+            print("🔄 回退到简单规则...")
+            return harmonize_fallback(melody, temperature, k), 'error'
+
+
 # API endpoints
 @app.route('/api/status', methods=['GET', 'OPTIONS'])
 def api_status():
@@ -1045,10 +1059,39 @@ def api_status():
         'message': 'Backend server running normally',
         'model': 'Custom Transformer Harmony Model',
         'model_status': model_status,
+        'ngram_engine_status': "loaded" if chord_hmm is not None else "not_loaded",
+        'engines': list(ENGINES),
         'device': str(device) if device else 'unknown',
+        'precision': INFERENCE_PRECISION,
+        'compile_mode': COMPILE_MODE,
+        'attention': INFERENCE_ATTENTION,
         'vocab_info': vocab_info,
         'version': '2.1.0',
-        'cors': 'enabled'
+        'cors': 'enabled',
+        'result_cache': result_cache.stats(),
+        'encoder_cache': encoder_cache.stats(),
+        'sessions': session_store.stats(),
+        'superseded': latest_wins.stats(),
+        'streaming': stream_hub.stats(),
+        'latency_budget': latency_budget.stats(),
+        'speculative': speculative_stats.stats()
+    })
+
+
+@app.route('/api/metrics', methods=['GET', 'OPTIONS'])
+def api_metrics():
+    """Cache and inference counters"""
+    if request.method == 'OPTIONS':
+        return '', 200
+
+    return jsonify({
+        'result_cache': result_cache.stats(),
+        'encoder_cache': encoder_cache.stats(),
+        'sessions': session_store.stats(),
+        'superseded': latest_wins.stats(),
+        'streaming': stream_hub.stats(),
+        'latency_budget': latency_budget.stats(),
+        'speculative': speculative_stats.stats()
     })
 
 
@@ -1072,28 +1115,88 @@ def api_harmonize():
         temperature = float(data.get('temperature', 1.0))
         k_value = int(data.get('k', 20))
         mode = data.get('mode', 'notes')
+        decode_mode = data.get('decode_mode', 'sample')
+        engine = data.get('engine', 'transformer')
+        speculative = int(data.get('speculative', SPECULATIVE_DRAFT_LEN))
+        draft_model = data.get('draft', 'ngram')
+        seed = data.get('seed')
+        if seed is not None:
+            seed = int(seed)
+
+        if decode_mode not in DECODE_MODES:
+            return jsonify({'error': f'Unsupported decode_mode: {decode_mode}'}), 400
+        if engine not in ENGINES:
+            return jsonify({'error': f'Unsupported engine: {engine}'}), 400
+        if draft_model not in DRAFT_MODELS or speculative < 0:
+            return jsonify({'error': f'Unsupported speculative decoding settings: {speculative}, {draft_model}'}), 400
+
+        # 客户端id + 序列号：同一客户端只有最新的请求会被完整计算
+        client_id = data.get('client_id')
+        seq = data.get('seq')
+        if seq is not None:
+            seq = int(seq)
+        if not latest_wins.register(client_id, seq):
+            print(f"⏭️  Request {client_id}#{seq} already superseded, dropping")
+            return jsonify({'error': 'Request superseded by a newer request', 'superseded': True}), 409
+
+        # 延迟预算（毫秒）及超时后模型解码的处理策略
+        budget_ms = data.get('budget_ms', DEFAULT_BUDGET_MS)
+        budget_ms = float(budget_ms) if budget_ms is not None else None
+        budget_policy = data.get('budget_policy', DEFAULT_BUDGET_POLICY)
+        if budget_policy not in BUDGET_POLICIES:
+            return jsonify({'error': f'Unsupported budget_policy: {budget_policy}'}), 400
 
         print(f"📊 API call parameters:")
         print(f"   Mode: {mode}")
         print(f"   Input melody: {melody_input}")
         print(f"   Temperature: {temperature}")
         print(f"   K value: {k_value}")
+        print(f"   Decode mode: {decode_mode}")
+        print(f"   Engine: {engine}")
+        print(f"   Speculative: {speculative} ({draft_model})")
+        print(f"   Seed: {seed}")
+        print(f"   Budget: {budget_ms} ms ({budget_policy})")
 
         if mode == 'notes':
-            if harmony_model is not None:
-                print("🧠 Using custom Transformer model for chord generation...")
-                result_chords = harmonize_melody_transformer(melody_input, temperature, k_value)
-                model_info = "Custom Transformer Harmony Model"
-            else:
-                print("⚠️  Transformer model not loaded, using simplified version...")
-                result_chords = harmonize_melody_simple(melody_input, temperature, k_value)
-                model_info = "Simplified Harmony Model (fallback)"
+            superseded = latest_wins.abort_check(client_id, seq)
+            budget_expired = threading.Event()
+
+            def should_abort():
+                return budget_expired.is_set() or superseded()
+
+            def compute():
+                return harmonize_cached(melody_input, temperature, k_value, decode_mode, seed,
+                                        should_abort=should_abort, engine=engine, speculative=speculative,
+                                        draft_model=draft_model)
+
+            def fast_path():
+                print(f"⏱️  Budget of {budget_ms} ms expired, serving fast path")
+                return harmonize_fast_path(melody_input, temperature, k_value, decode_mode, seed), 'bypass'
+
+            try:
+                # HMM 解码只需亚毫秒，不需要延迟预算
+                if budget_ms is None or engine == 'ngram':
+                    result, cache_status = compute()
+                else:
+                    result, cache_status = latency_budget.run(
+                        compute, fast_path, budget_ms / 1000.0, budget_policy, budget_expired,
+                        answered_by_model=lambda value: value[0]['tier'] != 'fallback')
+            except DecodeCancelled as e:
+                latest_wins.record_cancelled(e)
+                print(f"⏭️  Request {client_id}#{seq} superseded: {e}")
+                return jsonify({'error': str(e), 'superseded': True}), 409
+            model_info = result['model_info']
+            tier = result['tier']
+            print(f"🗃️  Result cache: {cache_status}, tier: {tier}")
 
             response_data = {
                 'input': melody_input,
-                'output': result_chords,
+                'output': result['chords'],
                 'description': f'{model_info} Temperature:{temperature:.1f},Diversity:{k_value}',
                 'model_info': model_info,
+                'seed': result['seed'],
+                'cache': cache_status,
+                'tier': tier,
                 'success': True
             }
 
@@ -1114,6 +1217,324 @@ def api_harmonize():
         }), 500
 
 
+def session_chord_names(chord_ids):
+    """会话中的和弦id转换为和弦名称，特殊标记沿用上一个和弦"""
+    names = []
+    for chord_id in chord_ids:
+        chord_name = in2chord.get(chord_id, 'C')
+        if chord_name.startswith('<') and chord_name.endswith('>'):
+            chord_name = names[-1] if names else 'C'
+        names.append(clean_chord_format(chord_name))
+    return names
+
+
+def session_response(session, new_slots=()):
+    chords = session_chord_names(session.chord_ids())
+    return {
+        'session_id': session.session_id,
+        'seed': session.seed,
+        'frames': len(session.frames),
+        'slot_duration': FRAMES_PER_SLOT,
+        'chords': chords,
+        'new_chords': [{'slot': slot, 'chord': chords[slot], 'start': slot * FRAMES_PER_SLOT,
+                        'duration': FRAMES_PER_SLOT} for slot, _ in new_slots],
+        'success': True
+    }
+
+
+@app.route('/api/session', methods=['POST', 'OPTIONS'])
+def api_session_create():
+    """Create an incremental harmonization session for live input"""
+    if request.method == 'OPTIONS':
+        return '', 200
+
+    if harmony_model is None:
+        return jsonify({'error': 'Sessions require the Transformer model to be loaded'}), 503
+
+    data = request.json or {}
+    decode_mode = data.get('decode_mode', SAMPLE)
+    if decode_mode not in DECODE_MODES:
+        return jsonify({'error': f'Unsupported decode_mode: {decode_mode}'}), 400
+
+    seed = data.get('seed')
+    session = session_store.create(
+        temperature=float(data.get('temperature', 1.0)),
+        k=int(data.get('k', 20)),
+        decode_mode=decode_mode,
+        seed=int(seed) if seed is not None else None,
+        device=device
+    )
+    print(f"🎹 Created session {session.session_id}")
+
+    return jsonify(session_response(session))
+
+
+@app.route('/api/session/<session_id>/notes', methods=['POST', 'OPTIONS'])
+def api_session_append(session_id):
+    """Append notes to a session and decode the newly completed half-bar slots"""
+    if request.method == 'OPTIONS':
+        return '', 200
+
+    data = request.json or {}
+    try:
+        session = session_store.get(session_id)
+        temperature = data.get('temperature')
+        k = data.get('k')
+
+        with session.lock:
+            session.append_notes(data.get('notes', []), note2in)
+            sos_token, eos_token = loader.get_special_chars()
+            # 和 /api/harmonize、流式及批量请求一样占用推理槽位；没有新完成的半小节时不解码，也不等待槽位
+            decoding = session.committed_slots() < session.completed_slots()
+            with inference_slots if decoding else contextlib.nullcontext():
+                new_slots = session.decode_new_slots(
+                    harmony_model, chord2in, note2in, sos_token, eos_token,
+                    temperature=float(temperature) if temperature is not None else None,
+                    k=int(k) if k is not None else None
+                )
+            response_data = session_response(session, new_slots)
+    except SessionNotFound as e:
+        return jsonify({'error': str(e)}), 404
+    except SessionError as e:
+        return jsonify({'error': str(e)}), 400
+
+    print(f"🎹 Session {session_id}: {len(new_slots)} new chord(s) {response_data['chords']}")
+    return jsonify(response_data)
+
+
+@app.route('/api/session/<session_id>', methods=['GET', 'DELETE', 'OPTIONS'])
+@app.route('/api/session/<session_id>/chords', methods=['GET', 'OPTIONS'])
+def api_session_chords(session_id):
+    """Get the chords committed so far, or close the session"""
+    if request.method == 'OPTIONS':
+        return '', 200
+
+    if request.method == 'DELETE':
+        if not session_store.delete(session_id):
+            return jsonify({'error': f'Unknown or expired session: {session_id}'}), 404
+        return jsonify({'session_id': session_id, 'success': True})
+
+    try:
+        session = session_store.get(session_id)
+    except SessionNotFound as e:
+        return jsonify({'error': str(e)}), 404
+
+    with session.lock:
+        return jsonify(session_response(session))
+
+
+def run_chord_stream(channel, stream_id, cancel_event, melody, temperature, k, decode_mode, seed):
+    """
+    Decodes chords for one stream and publishes every chord on the channel as soon
+    as it is sampled, so playback can start before the whole progression exists.
+    """
+    started_at = stream_hub.begin()
+    first_chord_at = None
+
+    try:
+        if harmony_model is None:
+            # no model: the rule based progression is available immediately
+            chords = harmonize_melody_simple(melody, temperature, k)
+            total_duration = sum(note_dur[1] for note_dur in melody)
+            slot_duration = total_duration / len(chords)
+            first_chord_at = time.monotonic()
+            for slot, chord in enumerate(chords):
+                channel.publish('chord', {'stream_id': stream_id, 'slot': slot, 'chord': chord,
+                                          'start': slot * slot_duration, 'duration': slot_duration})
+            channel.publish('done', {'stream_id': stream_id, 'chords': chords, 'tier': 'fallback'})
+            stream_hub.record('completed', started_at, first_chord_at)
+            return
+
+        with inference_slots:
+            if cancel_event.is_set():
+                raise DecodeCancelled("Stream cancelled while queued", queued=True)
+
+            src_sequence, smart_length, start_token, pad_token, _ = prepare_transformer_inputs(melody)
+            total_duration = sum(note_dur[1] for note_dur in melody)
+            slot_duration = total_duration / smart_length
+            chords = []
+
+            def on_token(step, next_token):
+                nonlocal first_chord_at
+                chord_name = in2chord.get(int(next_token[0, 0]), '')
+                if chord_name.startswith('<') and chord_name.endswith('>'):
+                    return
+                chord_name = clean_chord_format(chord_name)
+                chords.append(chord_name)
+                if first_chord_at is None:
+                    first_chord_at = time.monotonic()
+                channel.publish('chord', {'stream_id': stream_id, 'slot': step, 'chord': chord_name,
+                                          'start': step * slot_duration, 'duration': slot_duration})
+
+            generate_with_transformer(
+                model=harmony_model,
+                src_sequence=src_sequence,
+                max_new_tokens=smart_length,
+                temperature=temperature,
+                top_k=k,
+                start_token=start_token,
+                pad_token=pad_token,
+                decode_mode=decode_mode,
+                generator=make_generator(seed),
+                should_abort=cancel_event.is_set,
+                on_token=on_token
+            )
+
+        channel.publish('done', {'stream_id': stream_id, 'chords': chords, 'seed': seed, 'tier': 'transformer'})
+        stream_hub.record('completed', started_at, first_chord_at)
+    except DecodeCancelled:
+        channel.publish('cancelled', {'stream_id': stream_id})
+        stream_hub.record('cancelled', started_at, first_chord_at)
+    except Exception as e:
+        print(f"❌ Stream {stream_id} failed: {e}")
+        channel.publish('error', {'stream_id': stream_id, 'error': str(e)})
+        stream_hub.record('failed', started_at, first_chord_at)
+    finally:
+        channel.finish_stream(stream_id, cancel_event)
+
+
+@app.route('/api/stream', methods=['GET'])
+def api_stream():
+    """Server-Sent Events connection carrying the chords of all streams of one client"""
+    client_id = request.args.get('client_id')
+    if not client_id:
+        return jsonify({'error': 'client_id query parameter required'}), 400
+
+    channel = stream_hub.open(client_id)
+    print(f"📡 Stream channel opened for client {client_id}")
+
+    def events():
+        try:
+            yield from channel.iter_events()
+        finally:
+            stream_hub.remove(channel)
+            print(f"📡 Stream channel closed for client {client_id}")
+
+    return Response(stream_with_context(events()), mimetype='text/event-stream',
+                    headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'})
+
+
+@app.route('/api/stream/harmonize', methods=['POST', 'OPTIONS'])
+def api_stream_harmonize():
+    """Start a harmonization whose chords are pushed over the client's stream channel"""
+    if request.method == 'OPTIONS':
+        return '', 200
+
+    data = request.json or {}
+    client_id = data.get('client_id')
+    stream_id = data.get('stream_id')
+    melody_input = data.get('melody', [])
+    if not client_id or stream_id is None:
+        return jsonify({'error': 'client_id and stream_id are required'}), 400
+    if not melody_input:
+        return jsonify({'error': 'melody is required'}), 400
+
+    decode_mode = data.get('decode_mode', SAMPLE)
+    if decode_mode not in DECODE_MODES:
+        return jsonify({'error': f'Unsupported decode_mode: {decode_mode}'}), 400
+
+    seed = data.get('seed')
+    seed = int(seed) if seed is not None else random.randrange(2 ** 31)
+
+    channel = stream_hub.get(client_id)
+    cancel_event = channel.start_stream(stream_id)
+    worker = threading.Thread(
+        target=run_chord_stream,
+        args=(channel, stream_id, cancel_event, melody_input, float(data.get('temperature', 1.0)),
+              int(data.get('k', 20)), decode_mode, seed),
+        daemon=True
+    )
+    worker.start()
+
+    return jsonify({'client_id': client_id, 'stream_id': stream_id, 'seed': seed, 'success': True}), 202
+
+
+@app.route('/api/stream/cancel', methods=['POST', 'OPTIONS'])
+def api_stream_cancel():
+    """Cancel one stream (stream_id) or every stream of a client mid-decode"""
+    if request.method == 'OPTIONS':
+        return '', 200
+
+    data = request.json or {}
+    channel = stream_hub.get(data.get('client_id'), create=False)
+    if channel is None:
+        return jsonify({'error': 'No open stream channel for this client'}), 404
+
+    cancelled = channel.cancel(data.get('stream_id'))
+    return jsonify({'cancelled': cancelled, 'success': True})
+
+
+def get_batch_pool():
+    """批量和声共用的进程池（HARMONY_BATCH_WORKERS 个工作进程），首次调用时创建"""
+    global batch_pool
+    with batch_pool_lock:
+        if batch_pool is None:
+            print(f"📦 Starting batch worker pool with {BATCH_WORKERS} worker(s)...")
+            batch_pool = batch_harmonizer.create_pool(model_path, (in2chord, chord2in, note2in), BATCH_WORKERS,
+                                                      INFERENCE_PRECISION, COMPILE_MODE, INFERENCE_ATTENTION)
+        return batch_pool
+
+
+@app.route('/api/harmonize_batch', methods=['POST', 'OPTIONS'])
+def api_harmonize_batch():
+    """
+    Harmonize many melodies in one request. Phrases are length-bucketed and decoded in
+    padded batches; results are streamed back as NDJSON lines as soon as each batch is
+    done, followed by a summary line with throughput.
+    """
+    if request.method == 'OPTIONS':
+        return '', 200
+
+    if harmony_model is None:
+        return jsonify({'error': 'Batch harmonization requires the Transformer model to be loaded'}), 503
+
+    data = request.json or {}
+    melodies = data.get('melodies', [])
+    if not isinstance(melodies, list) or not melodies:
+        return jsonify({'error': 'melodies must be a non-empty list'}), 400
+    if len(melodies) > MAX_BATCH_MELODIES:
+        return jsonify({'error': f'At most {MAX_BATCH_MELODIES} melodies per request'}), 413
+
+    decode_mode = data.get('decode_mode', SAMPLE)
+    if decode_mode not in DECODE_MODES:
+        return jsonify({'error': f'Unsupported decode_mode: {decode_mode}'}), 400
+
+    temperature = float(data.get('temperature', 1.0))
+    k_value = int(data.get('k', 20))
+    seed = data.get('seed')
+    seed = int(seed) if seed is not None else random.randrange(2 ** 31)
+    batch_size = int(data.get('batch_size', BATCH_SIZE))
+    workers = min(int(data.get('workers', BATCH_WORKERS)), BATCH_WORKERS)
+
+    print(f"📦 Batch request: {len(melodies)} melodies, batch size {batch_size}, {workers} worker(s)")
+
+    # 进程池在独立进程中解码，不占用推理槽位；单进程时每个批次单独占用槽位，输出结果前释放，
+    # 慢速客户端不会阻塞交互式请求
+    pool = get_batch_pool() if workers > 1 else None
+
+    # 所有旋律在发送响应头之前编码，格式错误的旋律返回 400 而不是中断数据流
+    try:
+        harmonized = batch_harmonizer.harmonize_many(
+            melodies, model_path, (in2chord, chord2in, note2in), temperature, k_value, decode_mode, seed,
+            batch_size, workers, model=harmony_model, precision=INFERENCE_PRECISION,
+            compile_mode=COMPILE_MODE, attention=INFERENCE_ATTENTION, pool=pool, slot=inference_slots)
+    except ValueError as error:
+        print(f"❌ Invalid batch melody: {error}")
+        return jsonify({'error': f'Invalid melody: {error}'}), 400
+
+    def results():
+        start = time.perf_counter()
+        for index, chords in harmonized:
+            yield json.dumps({'index': index, 'chords': chords}) + '\n'
+        elapsed = time.perf_counter() - start
+        summary = {'phrases': len(melodies), 'seconds': elapsed, 'seed': seed,
+                   'phrases_per_second': len(melodies) / elapsed if elapsed > 0 else 0.0}
+        print(f"📦 Batch done: {summary}")
+        yield json.dumps({'summary': summary}) + '\n'
+
+    return Response(stream_with_context(results()), mimetype='application/x-ndjson')
+
+
 @app.errorhandler(404)
 def not_found(error):
     return jsonify({'error': 'Endpoint not found'}), 404
@@ -1129,6 +1550,14 @@ if __name__ == '__main__':
     print("📍 Endpoints:")
     print("  GET  /api/status     - Health check")
     print("  POST /api/harmonize  - Chord generation")
+    print("  GET  /api/metrics    - Cache and inference counters")
+    print("  POST /api/session    - Create live harmonization session")
+    print("  POST /api/session/<id>/notes  - Append notes, decode completed slots")
+    print("  GET  /api/session/<id>/chords - Chords committed so far")
+    print("  GET  /api/stream?client_id=    - SSE channel streaming chords as they are decoded")
+    print("  POST /api/stream/harmonize     - Start a streamed harmonization")
+    print("  POST /api/stream/cancel        - Cancel a stream mid-decode")
+    print("  POST /api/harmonize_batch      - Harmonize many melodies, streamed NDJSON results")
     print("🌐 Server URL: http://localhost:5001")
     print("🔧 CORS: Enabled, allowing all origins")
     print("=" * 60)
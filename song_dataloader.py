@@ -1,10 +1,38 @@
 import torch
 from torch.utils.data import DataLoader,random_split
 import json
+import re
+from collections import Counter
+
+import chord_canonicalizer
+from mapped_checkpoint import read_metadata
 
 REST_TOKEN = "rest"
 SOS_TOKEN = "<SOS>"
 EOS_TOKEN = "<EOS>"
+# bucket for chords below the vocabulary frequency threshold
+UNK_TOKEN = "<UNK>"
+
+# chord root/bass spelling: letter followed by sharps (#) or flats (-)
+NOTE_SPELLING = re.compile(r'([A-G])([#-]*)')
+LETTER_PITCH = {'C': 0, 'D': 2, 'E': 4, 'F': 5, 'G': 7, 'A': 9, 'B': 11}
+
+
+def spelling_pitch_class(spelling):
+    letter, accidentals = NOTE_SPELLING.fullmatch(spelling).groups()
+    return (LETTER_PITCH[letter] + accidentals.count('#') - accidentals.count('-')) % 12
+
+
+def replace_unknown_chords(chords):
+    """Holds the previous chord wherever the model produced the <UNK> bucket or another special token"""
+    known = [chord for chord in chords if chord not in chord_canonicalizer.SPECIAL_TOKENS]
+    previous = known[0] if known else "C"
+    replaced = []
+    for chord in chords:
+        previous = previous if chord in chord_canonicalizer.SPECIAL_TOKENS else chord
+        replaced.append(previous)
+    return replaced
+
 
 class Song_Dataloader:
 
@@ -15,8 +43,145 @@ class Song_Dataloader:
     - break into 8 measure chunks with two measure overlap
     -divide into notes vs chords (inputs vs outputs)
     -one hot as 16th note frames, batch, pad etc
+
+    Optional chord vocabulary stage (all off by default, the pretrained model uses the plain vocabulary):
+    - canonicalize_chords: repair spellings (chord_canonicalizer.repair_spelling, as at output time) and
+      merge enharmonic spellings of the same root/bass into the corpus' most common one
+    - min_chord_count: chords occurring fewer times are replaced by <UNK>
+    - order_by_frequency: chord ids ordered by descending frequency after the special tokens
     """
-        
+
+    def __init__(self, canonicalize_chords=False, min_chord_count=1, order_by_frequency=False):
+        self.vocab_options = {
+            'canonicalize_chords': canonicalize_chords,
+            'min_chord_count': min_chord_count,
+            'order_by_frequency': order_by_frequency,
+        }
+        self.vocab_report = None
+        self.stored_vocab = None
+
+    @classmethod
+    def for_checkpoint(cls, checkpoint):
+        """
+        Loader building the chord vocabulary a saved model was trained with.
+
+        Parameters:
+        - checkpoint: checkpoint path (only the header of a mapped checkpoint is read), or a
+          checkpoint from mapped_checkpoint.load_checkpoint when the model is loaded as well
+        """
+        metadata = read_metadata(checkpoint) if isinstance(checkpoint, str) else checkpoint
+        loader = cls(**metadata.get('vocab_options') or {})
+        if metadata.get('vocab') is not None:
+            loader.stored_vocab = metadata['vocab']
+            loader.chord2in, loader.in2chord, loader.note2in, loader.in2note = metadata['vocab']
+        return loader
+
+    def load_vocab(self):
+        """
+        (chord2in, in2chord, note2in, in2note) without building dataloaders: the vocabularies
+        saved with the checkpoint if it has them, else read from the datasets
+        """
+        if self.stored_vocab is not None:
+            return self.stored_vocab
+        _, chord2in, in2chord, note2in, in2note = self.read_songs()
+        return chord2in, in2chord, note2in, in2note
+
+    def uses_default_vocab(self):
+        return self.vocab_options == Song_Dataloader().vocab_options
+
+    def build_chord_vocab(self, datasets):
+        """
+        Runs the optional vocabulary stage over the raw song data. Chord outputs are rewritten
+        in place (canonical spelling, <UNK>) so the encoded data matches the vocabulary.
+
+        Parameters:
+        - datasets: list of datasets, each a list of [melody, chords] pairs, in vocabulary order
+
+        Returns:
+        (chord2in, in2chord)
+        """
+        options = self.vocab_options
+        outputs = [output for dataset in datasets for _, output in dataset]
+        original = Counter(chord for output in outputs for chord in output)
+
+        if options['canonicalize_chords']:
+            repaired = {chord: ' '.join(chord_canonicalizer.repair_spelling(chord).split()) for chord in original}
+
+            # most common spelling of every pitch class among roots and bass notes
+            spelling_counts = Counter()
+            for chord, count in original.items():
+                for spelling in NOTE_SPELLING.findall(repaired[chord]):
+                    spelling_counts[''.join(spelling)] += count
+            preferred = {}
+            for spelling, _ in spelling_counts.most_common():
+                preferred.setdefault(spelling_pitch_class(spelling), spelling)
+
+            def respell(match):
+                return preferred[spelling_pitch_class(match.group(0))]
+
+            canonical = {}
+            for chord, name in repaired.items():
+                if chord in (SOS_TOKEN, EOS_TOKEN):
+                    canonical[chord] = chord
+                    continue
+                # root at the start, bass after '/'
+                name = re.sub(r'^[A-G][#-]*', respell, name)
+                canonical[chord] = re.sub(r'(?<=/)[A-G][#-]*', respell, name)
+
+            for output in outputs:
+                for i, chord in enumerate(output):
+                    output[i] = canonical[chord]
+
+        counts = Counter(chord for output in outputs for chord in output)
+        first_seen = {}
+        for output in outputs:
+            for chord in output:
+                first_seen.setdefault(chord, len(first_seen))
+
+        dropped = {chord for chord, count in counts.items()
+                   if count < options['min_chord_count'] and chord not in (SOS_TOKEN, EOS_TOKEN)}
+        if dropped:
+            for output in outputs:
+                for i, chord in enumerate(output):
+                    if chord in dropped:
+                        output[i] = UNK_TOKEN
+
+        chords = [chord for chord in counts if chord not in dropped and chord not in (SOS_TOKEN, EOS_TOKEN)]
+        if options['order_by_frequency']:
+            chords.sort(key=lambda chord: (-counts[chord], first_seen[chord]))
+        else:
+            chords.sort(key=lambda chord: first_seen[chord])
+
+        vocabulary = [SOS_TOKEN, EOS_TOKEN] + ([UNK_TOKEN] if dropped else []) + chords
+        chord2in = {chord: i for i, chord in enumerate(vocabulary)}
+        in2chord = {i: chord for i, chord in enumerate(vocabulary)}
+
+        total = sum(counts.values())
+        self.vocab_report = {
+            'original_size': len(original),
+            'size': len(vocabulary),
+            'merged_spellings': len(original) - len(counts),
+            'unk_chords': len(dropped),
+            'unk_token_fraction': sum(counts[chord] for chord in dropped) / total if total else 0.0,
+            # output projection and top-k both scale with the vocabulary on every decoding step
+            'projection_rows_saved': len(original) - len(vocabulary),
+            'projection_compute_saved': 1 - len(vocabulary) / len(original),
+        }
+        return chord2in, in2chord
+
+    def print_vocab_report(self, output_embedding_dim=None):
+        report = self.vocab_report
+        if report is None:
+            print("Chord vocabulary:", len(self.chord2in), "chords (default vocabulary)")
+            return
+        print(f"Chord vocabulary: {report['original_size']} -> {report['size']} chords "
+              f"({report['merged_spellings']} spellings merged, {report['unk_chords']} rare chords -> {UNK_TOKEN}, "
+              f"{report['unk_token_fraction']:.2%} of chord tokens)")
+        saved = f"{report['projection_rows_saved']} output projection rows ({report['projection_compute_saved']:.1%})"
+        if output_embedding_dim:
+            saved += f", {report['projection_rows_saved'] * output_embedding_dim:,} multiply-adds"
+        print("Saved per decoding step:", saved)
+
     def read_songs(self):
         
         cm_path = "Datasets/CHORD_MELODY_DATASET.json"
@@ -59,6 +224,10 @@ class Song_Dataloader:
         in2note[len(in2note)] = "rest"
 
 
+        if not self.uses_default_vocab():
+            chord2in, in2chord = self.build_chord_vocab(
+                [combined_wikifonia_data, combined_jazz_data, combined_pdsa_data, combined_chord_melody_data])
+
         for input,output in combined_wikifonia_data:
             for chord in output:
                 if chord not in chord2in:
@@ -127,6 +296,10 @@ class Song_Dataloader:
         # combine datasets
         combined_data = combined_jazz_data+combined_wikifonia_data+combined_pdsa_data+combined_chord_melody_data
 
+        # source dataset of every chunk, in combined order (per-dataset validation metrics)
+        self.dataset_names = (["jazz"]*len(combined_jazz_data) + ["wikifonia"]*len(combined_wikifonia_data)
+                              + ["pdsa"]*len(combined_pdsa_data) + ["chord_melody"]*len(combined_chord_melody_data))
+
 
         # print("Total 8 measure chunks of data read:", len(combined_data))
        
@@ -146,6 +319,7 @@ class Song_Dataloader:
 
 
         split_indice = int(len(combined_data)*training_split)
+        self.split_index = split_indice
 
         training_data = combined_data[:split_indice]
         test_data = combined_data[split_indice:]
@@ -172,6 +346,13 @@ class Song_Dataloader:
 
         return train_dataloader,validation_dataloader,chord2in,in2chord,note2in, in2note
     
+    def split_dataset_names(self):
+        """
+        Returns:
+        (source dataset name of every training example, of every validation example), in dataloader order
+        """
+        return self.dataset_names[:self.split_index], self.dataset_names[self.split_index:]
+
     def get_vocab(self):
         return self.in2chord, self.chord2in, self.note2in, self.in2note 
 
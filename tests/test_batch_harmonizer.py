@@ -0,0 +1,98 @@
+"""
+Batched decoding cuts every row at its own first <EOS>: the remaining slots of that phrase hold
+its last chord, other phrases of the batch are unaffected. Malformed melodies are rejected
+before anything is decoded.
+"""
+import os
+import sys
+
+import pytest
+import torch
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from batch_harmonizer import harmonize_many, harmonize_padded_batch
+from decoding import GREEDY
+from song_dataloader import replace_unknown_chords
+
+IN2CHORD = {0: "<SOS>", 1: "<EOS>", 2: "C", 3: "G", 4: "Am"}
+CHORD2IN = {chord: i for i, chord in IN2CHORD.items()}
+NOTE2IN = {**{note: note + 3 for note in range(12)}, "rest": 2, "<EOS>": 1}
+VOCAB = (IN2CHORD, CHORD2IN, NOTE2IN)
+
+
+class ScriptedDecoder(torch.nn.Module):
+    """Greedy decoding of row i yields scripts[i], whatever the melody"""
+
+    def __init__(self, scripts):
+        super().__init__()
+        self.scripts = scripts
+        self.weight = torch.nn.Parameter(torch.zeros(1))
+
+    def encode(self, src, src_key_padding_mask=None):
+        return torch.zeros(src.size(0), src.size(1), 4)
+
+    def get_tgt_mask(self, size, device=None):
+        return None
+
+    def decode(self, tgt, memory, tgt_mask=None, memory_key_padding_mask=None):
+        logits = torch.zeros(tgt.size(0), tgt.size(1), len(IN2CHORD))
+        for row, script in enumerate(self.scripts):
+            logits[row, -1, CHORD2IN[script[tgt.size(1) - 1]]] = 1.0
+        return logits
+
+
+def frames(slots):
+    # slots half bars of melody frames + EOS
+    return [NOTE2IN[0]] * (8 * slots) + [NOTE2IN["<EOS>"]]
+
+
+def decode(scripts, slots):
+    model = ScriptedDecoder(scripts).eval()
+    return harmonize_padded_batch(model, [frames(n) for n in slots], CHORD2IN, IN2CHORD, decode_mode=GREEDY)
+
+
+def test_rows_without_eos():
+    assert decode([["C", "G", "Am"], ["Am", "G", "C"]], [3, 3]) == [["C", "G", "Am"], ["Am", "G", "C"]]
+
+
+def test_row_cut_at_first_eos():
+    # chords after <EOS> are not kept, even if the model goes on
+    assert decode([["C", "<EOS>", "G"], ["G", "Am", "C"]], [3, 3]) == [["C", "C", "C"], ["G", "Am", "C"]]
+
+
+def test_leading_eos():
+    assert decode([["<EOS>", "G", "Am"]], [3]) == [["C", "C", "C"]]
+    assert decode([["<EOS>", "<EOS>", "<EOS>"], ["Am", "Am", "Am"]], [3, 3]) == [["C", "C", "C"],
+                                                                                  ["Am", "Am", "Am"]]
+
+
+def test_shorter_phrase_in_padded_batch():
+    # the shorter phrase decodes only its own two slots, its EOS after them does not matter
+    assert decode([["G", "Am", "<EOS>"], ["Am", "<EOS>", "C"]], [3, 2]) == [["G", "Am", "Am"], ["Am", "Am"]]
+
+
+def test_replace_unknown_chords():
+    assert replace_unknown_chords(["<UNK>", "G", "<EOS>", "Am", "<SOS>"]) == ["G", "G", "G", "Am", "Am"]
+    assert replace_unknown_chords(["<UNK>", "<EOS>"]) == ["C", "C"]
+    assert replace_unknown_chords([]) == []
+
+
+def test_harmonize_many():
+    model = ScriptedDecoder([["C", "<EOS>", "G"]]).eval()
+    results = dict(harmonize_many([[[60, 16], [62, 8]], [[67, 24]]], None, VOCAB, decode_mode=GREEDY,
+                                  batch_size=1, model=model))
+    assert results == {0: ["C", "C", "C"], 1: ["C", "C", "C"]}
+
+
+@pytest.mark.parametrize("melody", [
+    [[60, 16], ["x", 8]],
+    [[60, 16], [62]],
+    [[60, float("nan")]],
+    "C D E",
+])
+def test_malformed_melody_rejected_before_decoding(melody):
+    model = ScriptedDecoder([])
+    # raised by the call itself, before the first result is requested
+    with pytest.raises(ValueError, match="melody 1"):
+        harmonize_many([[[60, 16]], melody], None, VOCAB, model=model)
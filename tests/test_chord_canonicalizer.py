@@ -0,0 +1,72 @@
+"""
+Pins the chord-name normalization of the CLI (evaluation_helpers.fixChordName), the server
+(clean_chord_format, standardize_chord_name, suggest_valid_chord_alternative,
+validate_chord_quality) and the seventh-chord suggestions (extract_chord_root,
+extract_chord_quality, is_simple_triad), all backed by chord_canonicalizer.parse, for every chord
+of the dataset vocabulary and for malformed names.
+
+chord_normalization.json holds the expected outputs, recorded from the implementations these
+functions had before chord_canonicalizer replaced them. fixChordName now formats its result from
+the parsed record, so the double spaces a removed 'alter'/'pedal' left are single spaces
+('Bm7 alter b5' -> 'Bm7 b5'); music21 reads both spellings as the same chord.
+"""
+import json
+import os
+import sys
+
+import pytest
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import chord_canonicalizer
+import evaluation_helpers
+import server
+
+with open(os.path.join(os.path.dirname(os.path.abspath(__file__)), "chord_normalization.json")) as cases_file:
+    CASES = json.load(cases_file)
+
+FUNCTIONS = {
+    "fixChordName": evaluation_helpers.fixChordName,
+    "clean_chord_format": server.clean_chord_format,
+    "standardize_chord_name": server.standardize_chord_name,
+    "suggest_valid_chord_alternative": server.suggest_valid_chord_alternative,
+    "validate_chord_quality": server.validate_chord_quality,
+    "extract_chord_root": server.extract_chord_root,
+    "extract_chord_quality": server.extract_chord_quality,
+    "is_simple_triad": server.is_simple_triad,
+}
+
+
+@pytest.mark.parametrize("case", CASES["vocabulary"], ids=lambda case: case["chord"])
+def test_vocabulary(case):
+    for name, function in FUNCTIONS.items():
+        assert function(case["chord"]) == case[name], name
+
+
+@pytest.mark.parametrize("case", CASES["malformed"], ids=lambda case: repr(case["chord"]))
+def test_malformed(case):
+    for name, function in FUNCTIONS.items():
+        assert function(case["chord"]) == case[name], name
+
+
+@pytest.mark.parametrize("chord", [None, 7, ["C"]])
+def test_non_string(chord):
+    assert server.clean_chord_format(chord) == "C"
+    assert server.standardize_chord_name(chord) == "C"
+
+
+@pytest.mark.parametrize("case", CASES["vocabulary"], ids=lambda case: case["chord"])
+def test_parse_round_trip(case):
+    record = chord_canonicalizer.parse(case["chord"])
+    if chord_canonicalizer.is_special_token(case["chord"]):
+        assert record is None
+    else:
+        assert chord_canonicalizer.format_record(record) == case["chord"]
+
+
+def test_parse_fields():
+    assert chord_canonicalizer.parse("Dm7/C alter b5") == chord_canonicalizer.ChordRecord("D", "m7", ("alter b5",), "C")
+    assert chord_canonicalizer.parse("B-7 add 4 subtract 3") == chord_canonicalizer.ChordRecord("B-", "7", ("add 4", "subtract 3"), None)
+    assert chord_canonicalizer.parse("C6/9") == chord_canonicalizer.ChordRecord("C", "6/9", (), None)
+    assert chord_canonicalizer.parse("xyz") is None
+    assert chord_canonicalizer.vocabulary_records({0: "<SOS>", 1: "A-/C"}) == {0: None, 1: chord_canonicalizer.ChordRecord("A-", "", (), "C")}
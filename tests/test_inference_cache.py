@@ -0,0 +1,227 @@
+"""
+ResultCache: expiry after ttl_seconds, LRU eviction, one computation for identical concurrent
+requests, errors and rejected (cacheable) values never stored.
+EncoderCache: memory is reused only for the same model instance with unchanged weights and settings.
+"""
+import gc
+import os
+import sys
+import threading
+
+import pytest
+import torch
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import inference_cache
+from inference_cache import EncoderCache, ResultCache
+from Model.Transformer import Transformer
+
+
+class Clock:
+    def __init__(self):
+        self.now = 1000.0
+
+    def __call__(self):
+        return self.now
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    clock = Clock()
+    monkeypatch.setattr(inference_cache.time, "monotonic", clock)
+    return clock
+
+
+def counting(value):
+    calls = []
+
+    def compute():
+        calls.append(1)
+        return value
+    return compute, calls
+
+
+def test_hit_until_ttl_expires(clock):
+    cache = ResultCache(ttl_seconds=10.0)
+    compute, calls = counting("C G Am F")
+
+    assert cache.get_or_compute("melody", compute) == ("C G Am F", "miss")
+    clock.now += 9.9
+    assert cache.get_or_compute("melody", compute) == ("C G Am F", "hit")
+    clock.now += 0.1
+    assert cache.get_or_compute("melody", compute) == ("C G Am F", "miss")
+
+    assert len(calls) == 2
+    assert cache.stats()["expirations"] == 1
+
+
+def test_no_ttl_never_expires(clock):
+    cache = ResultCache(ttl_seconds=None)
+    compute, calls = counting(1)
+    cache.get_or_compute("melody", compute)
+    clock.now += 1e9
+    assert cache.get_or_compute("melody", compute) == (1, "hit")
+    assert len(calls) == 1
+
+
+def test_least_recently_used_evicted():
+    cache = ResultCache(max_entries=2)
+    for key in "abc":
+        if key == "c":
+            # touching "a" makes "b" the least recently used
+            cache.get_or_compute("a", lambda: None)
+        cache.get_or_compute(key, lambda key=key: key)
+
+    assert cache.get_or_compute("a", lambda: "again")[1] == "hit"
+    assert cache.get_or_compute("c", lambda: "again")[1] == "hit"
+    assert cache.get_or_compute("b", lambda: "again") == ("again", "miss")
+    assert cache.stats()["evictions"] == 2
+
+
+def test_concurrent_requests_computed_once():
+    cache = ResultCache()
+    started, release = threading.Event(), threading.Event()
+    calls = []
+
+    def slow():
+        calls.append(1)
+        started.set()
+        release.wait(5)
+        return "chords"
+
+    results = {}
+    leader = threading.Thread(target=lambda: results.setdefault("leader", cache.get_or_compute("melody", slow)))
+    leader.start()
+    started.wait(5)
+    follower = threading.Thread(target=lambda: results.setdefault("follower", cache.get_or_compute("melody", slow)))
+    follower.start()
+    # the follower waits on the leader's flight
+    follower.join(0.2)
+    assert follower.is_alive()
+    release.set()
+    leader.join(5)
+    follower.join(5)
+
+    assert results == {"leader": ("chords", "miss"), "follower": ("chords", "coalesced")}
+    assert len(calls) == 1
+    assert cache.stats()["inflight"] == 0
+
+
+def test_errors_are_shared_but_not_cached():
+    cache = ResultCache()
+    started, release = threading.Event(), threading.Event()
+
+    def failing():
+        started.set()
+        release.wait(5)
+        raise RuntimeError("model failed")
+
+    errors = []
+
+    def request():
+        try:
+            cache.get_or_compute("melody", failing)
+        except RuntimeError as e:
+            errors.append(e)
+
+    leader = threading.Thread(target=request)
+    leader.start()
+    started.wait(5)
+    follower = threading.Thread(target=request)
+    follower.start()
+    follower.join(0.2)
+    release.set()
+    leader.join(5)
+    follower.join(5)
+
+    assert len(errors) == 2 and errors[0] is errors[1]
+    assert cache.get_or_compute("melody", lambda: "chords") == ("chords", "miss")
+
+
+def test_rejected_values_are_not_cached():
+    cache = ResultCache()
+    fallback, calls = counting({"fallback": True})
+    cacheable = lambda result: not result["fallback"]
+
+    assert cache.get_or_compute("melody", fallback, cacheable)[1] == "miss"
+    assert cache.get_or_compute("melody", fallback, cacheable)[1] == "miss"
+    assert len(calls) == 2
+    assert cache.stats()["uncached"] == 2
+    assert cache.stats()["entries"] == 0
+
+    assert cache.get_or_compute("melody", lambda: {"fallback": False}, cacheable)[1] == "miss"
+    assert cache.get_or_compute("melody", fallback, cacheable) == ({"fallback": False}, "hit")
+
+
+def tiny_model(seed=0):
+    torch.manual_seed(seed)
+    return Transformer(inputVocab=14, outputVocab=12, input_embedding_dim=16, output_embedding_dim=16,
+                       num_heads=2, num_encoder_layers=1, num_decoder_layers=1, dropout_p=0.1,
+                       dim_feedforward=32).eval()
+
+
+SRC = torch.tensor([[3, 3, 5, 7, 7, 12]])
+
+
+def test_same_source_hits():
+    cache, model = EncoderCache(), tiny_model()
+    memory = cache.encode(model, SRC)
+    assert cache.encode(model, SRC) is memory
+    assert cache.encode(model, SRC.flip(1)) is not memory
+    assert cache.stats()["hits"] == 1 and cache.stats()["misses"] == 2
+
+
+def test_other_model_misses():
+    cache = EncoderCache()
+    memory = cache.encode(tiny_model(0), SRC)
+    other = tiny_model(1)
+    assert not torch.equal(cache.encode(other, SRC), memory)
+    assert cache.stats()["hits"] == 0
+
+
+def test_collected_model_not_confused_with_new_one():
+    cache = EncoderCache()
+    model = tiny_model(0)
+    cache.encode(model, SRC)
+    del model
+    gc.collect()
+    # the new model may reuse the collected one's id()
+    model = tiny_model(1)
+    with torch.no_grad():
+        assert torch.equal(cache.encode(model, SRC), model.encode(SRC))
+    assert cache.stats()["hits"] == 0
+
+
+@pytest.mark.parametrize("change", [
+    lambda model: model.load_state_dict(tiny_model(1).state_dict()),
+    lambda model: model.set_precision("bf16"),
+    lambda model: model.set_attention("sdpa"),
+    lambda model: torch.nn.init.normal_(next(model.parameters())),
+], ids=["load_state_dict", "set_precision", "set_attention", "in_place_update"])
+def test_changed_model_misses(change):
+    cache, model = EncoderCache(), tiny_model()
+    cache.encode(model, SRC)
+    with torch.no_grad():
+        change(model)
+    cache.encode(model, SRC)
+    assert cache.stats()["hits"] == 0
+    assert cache.encode(model, SRC) is not None
+    assert cache.stats()["hits"] == 1
+
+
+def test_training_mode_bypasses_cache():
+    cache, model = EncoderCache(), tiny_model().train()
+    cache.encode(model, SRC)
+    cache.encode(model, SRC)
+    assert cache.stats()["entries"] == 0
+    assert cache.stats()["hits"] == cache.stats()["misses"] == 0
+
+
+def test_padding_mask_is_part_of_the_key():
+    cache, model = EncoderCache(), tiny_model()
+    cache.encode(model, SRC, torch.zeros_like(SRC, dtype=torch.bool))
+    mask = torch.zeros_like(SRC, dtype=torch.bool)
+    mask[0, -1] = True
+    cache.encode(model, SRC, mask)
+    assert cache.stats()["hits"] == 0
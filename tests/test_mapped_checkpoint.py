@@ -0,0 +1,96 @@
+"""
+A mapped checkpoint loads into the same model as the .pth it was written from: every tensor
+bitwise equal, the same outputs, and its metadata and vocabularies round-tripped. Checked on a
+randomly initialized model, so no two tensors happen to be alike.
+"""
+import os
+import sys
+
+import pytest
+import torch
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import mapped_checkpoint
+from Model.Transformer import Transformer
+from song_dataloader import Song_Dataloader
+
+MODEL_KWARGS = dict(inputVocab=15, outputVocab=6, input_embedding_dim=16, output_embedding_dim=16, num_heads=2,
+                    num_encoder_layers=2, num_decoder_layers=1, dropout_p=0.1, dim_feedforward=32)
+IN2CHORD = {0: "<SOS>", 1: "<EOS>", 2: "<UNK>", 3: "C", 4: "G7/B", 5: "B-m7 add 9"}
+IN2NOTE = {**{i: i for i in range(12)}, 12: "rest", 13: "<SOS>", 14: "<EOS>"}
+VOCAB = ({chord: i for i, chord in IN2CHORD.items()}, IN2CHORD, {note: i for i, note in IN2NOTE.items()}, IN2NOTE)
+VOCAB_OPTIONS = {'canonicalize_chords': True, 'min_chord_count': 2, 'order_by_frequency': True}
+
+
+@pytest.fixture
+def model():
+    torch.manual_seed(0)
+    return Transformer(**MODEL_KWARGS).eval()
+
+
+def outputs(model):
+    src = torch.tensor([[3, 3, 5, 12, 7, 14], [4, 4, 4, 4, 9, 14]])
+    tgt = torch.tensor([[0, 3, 4], [0, 5, 5]])
+    with torch.no_grad():
+        return model(src, tgt, model.get_tgt_mask(tgt.size(1)))
+
+
+def assert_same_model(loaded, model):
+    expected = model.state_dict()
+    state = loaded.state_dict()
+    assert set(state) == set(expected)
+    for name, tensor in expected.items():
+        assert state[name].dtype == tensor.dtype and torch.equal(state[name], tensor), name
+    assert torch.equal(outputs(loaded), outputs(model))
+
+
+def test_round_trip(model, tmp_path):
+    path = str(tmp_path / "model.safetensors")
+    mapped_checkpoint.save_mapped(path, model.kwargs, model.state_dict(), model.model_type, VOCAB_OPTIONS, VOCAB)
+    assert mapped_checkpoint.is_mapped(path)
+
+    checkpoint = mapped_checkpoint.load_checkpoint(path)
+    kwargs, _, model_type = checkpoint['model']
+    assert kwargs == model.kwargs
+    assert model_type == model.model_type
+    assert checkpoint['vocab_options'] == VOCAB_OPTIONS
+    # integer note keys and ids survive the JSON header
+    assert checkpoint['vocab'] == VOCAB
+    assert_same_model(mapped_checkpoint.checkpoint_model(checkpoint), model)
+
+
+def test_header_alone_holds_metadata(model, tmp_path):
+    path = str(tmp_path / "model.safetensors")
+    mapped_checkpoint.save_mapped(path, model.kwargs, model.state_dict(), model.model_type)
+    metadata = mapped_checkpoint.read_metadata(path)
+    assert metadata['kwargs'] == model.kwargs
+    assert metadata['vocab_options'] == {}
+    assert metadata['vocab'] is None
+
+
+def test_convert_matches_pth(model, tmp_path, monkeypatch):
+    pth = str(tmp_path / "model.pth")
+    torch.save({'model': [model.kwargs, model.state_dict(), model.model_type], 'vocab_options': VOCAB_OPTIONS,
+                'vocab': VOCAB}, pth)
+    # the vocabularies come from the checkpoint, the datasets are never read
+    monkeypatch.setattr(Song_Dataloader, "read_songs", lambda self: pytest.fail("datasets read"))
+
+    out_path = mapped_checkpoint.convert(pth)
+    assert out_path == str(tmp_path / "model.safetensors")
+    # the .pth path now resolves to the converted sibling
+    assert mapped_checkpoint.resolve(pth) == out_path
+
+    pth_model = mapped_checkpoint.checkpoint_model(torch.load(pth, weights_only=False))
+    assert_same_model(mapped_checkpoint.load_model(pth), pth_model)
+    assert Song_Dataloader.for_checkpoint(pth).load_vocab() == VOCAB
+
+
+def test_older_sibling_not_used(model, tmp_path):
+    pth = str(tmp_path / "model.pth")
+    torch.save({'model': [model.kwargs, model.state_dict(), model.model_type]}, pth)
+    mapped_checkpoint.save_mapped(mapped_checkpoint.mapped_path(pth), model.kwargs, model.state_dict(),
+                                  model.model_type)
+    os.utime(mapped_checkpoint.mapped_path(pth), (0, 0))
+    assert mapped_checkpoint.resolve(pth) == pth
+    assert mapped_checkpoint.load_checkpoint(pth)['vocab'] is None
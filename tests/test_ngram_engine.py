@@ -0,0 +1,75 @@
+"""
+The chord HMM: tables fitted on encoded phrases decode the chords they were fitted on, and
+load_or_fit reuses saved tables only for the chord vocabulary they were fitted with.
+"""
+import os
+import sys
+
+import numpy as np
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from ngram_engine import FRAMES_PER_SLOT, ChordHMM, load_or_fit
+
+IN2CHORD = {0: "<SOS>", 1: "<EOS>", 2: "<UNK>", 3: "C", 4: "G", 5: "F"}
+IN2NOTE = {**{i: i for i in range(12)}, 12: "rest", 13: "<EOS>"}
+# the melody note of each chord's slots
+ROOTS = {3: 0, 4: 7, 5: 5}
+
+
+def phrase(chords):
+    inputs = [ROOTS[chord] for chord in chords for _ in range(FRAMES_PER_SLOT)] + [13]
+    return inputs, [0] + chords + [1]
+
+
+DATA = [phrase([3, 4, 3, 5, 4, 3]), phrase([3, 5, 3, 4, 3]), phrase([5, 4, 3, 3])]
+
+
+def training_data(calls):
+    def load():
+        calls.append(1)
+        return DATA
+    return load
+
+
+def test_fitted_chords_decoded():
+    hmm = ChordHMM.fit(DATA, IN2CHORD, IN2NOTE)
+    assert hmm.chords == [IN2CHORD[i] for i in range(len(IN2CHORD))]
+    assert hmm.harmonize([[60, 8], [67, 8], [65, 8], [72, 8]]) == ["C", "G", "F", "C"]
+
+
+def test_special_tokens_never_emitted():
+    hmm = ChordHMM.fit(DATA, IN2CHORD, IN2NOTE)
+    rng = np.random.default_rng(0)
+    for _ in range(20):
+        chords = hmm.harmonize([[62, 8], [66, 8], ["rest", 8]], mode="sample", temperature=2.0, rng=rng)
+        assert not set(chords) & {"<SOS>", "<EOS>", "<UNK>"}
+
+
+def test_saved_tables_reused(tmp_path):
+    path = str(tmp_path / "ngram_engine.npz")
+    calls = []
+    fitted = load_or_fit(path, training_data(calls), IN2CHORD, IN2NOTE)
+    loaded = load_or_fit(path, training_data(calls), IN2CHORD, IN2NOTE)
+
+    # the training split is only read to fit
+    assert len(calls) == 1
+    assert loaded.chords == fitted.chords
+    assert np.array_equal(loaded.log_transition, fitted.log_transition)
+    assert np.array_equal(loaded.log_emission, fitted.log_emission)
+
+
+def test_other_vocabulary_refitted(tmp_path):
+    path = str(tmp_path / "ngram_engine.npz")
+    calls = []
+    load_or_fit(path, training_data(calls), IN2CHORD, IN2NOTE)
+
+    # the same chords with other ids, e.g. a vocabulary ordered by frequency
+    reordered = {0: "<SOS>", 1: "<EOS>", 2: "<UNK>", 3: "G", 4: "C", 5: "F"}
+    hmm = load_or_fit(path, training_data(calls), reordered, IN2NOTE)
+    assert len(calls) == 2
+    assert hmm.chords == ["<SOS>", "<EOS>", "<UNK>", "G", "C", "F"]
+    # the refitted tables are saved for the new vocabulary
+    assert ChordHMM.load(path).chords == hmm.chords
+    load_or_fit(path, training_data(calls), reordered, IN2NOTE)
+    assert len(calls) == 2
@@ -0,0 +1,139 @@
+"""
+Latest-wins cancellation: a request is superseded once its client sent a newer sequence number,
+and its decoder stops at the next step with DecodeCancelled.
+LatencyBudget: the fast path answers once the budget expires or too many model runs are pending.
+"""
+import os
+import sys
+import threading
+import time
+
+import pytest
+import torch
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import server
+from Model.Transformer import Transformer
+from request_scheduler import CANCEL, DecodeCancelled, LatencyBudget, LatestWinsRegistry
+
+
+def test_newer_request_supersedes_older():
+    registry = LatestWinsRegistry()
+    assert registry.register("client", 1)
+    assert not registry.is_superseded("client", 1)
+
+    assert registry.register("client", 2)
+    assert registry.is_superseded("client", 1)
+    assert not registry.is_superseded("client", 2)
+    # other clients are independent
+    assert registry.register("other", 1)
+    assert not registry.is_superseded("other", 1)
+
+
+def test_stale_on_arrival():
+    registry = LatestWinsRegistry()
+    registry.register("client", 5)
+    assert not registry.register("client", 4)
+    # a repeated sequence number is not stale
+    assert registry.register("client", 5)
+    assert registry.stats()["stale_on_arrival"] == 1
+    assert registry.stats()["clients"] == 1
+
+
+def test_requests_without_client_never_superseded():
+    registry = LatestWinsRegistry()
+    assert registry.register(None, 3)
+    assert registry.register("client", None)
+    assert not registry.is_superseded(None, 1)
+    assert not registry.is_superseded("client", None)
+    assert registry.stats()["registered"] == 0
+
+
+def test_abort_check_follows_later_requests():
+    registry = LatestWinsRegistry()
+    registry.register("client", 1)
+    should_abort = registry.abort_check("client", 1)
+    assert not should_abort()
+    registry.register("client", 2)
+    assert should_abort()
+
+
+def test_record_cancelled():
+    registry = LatestWinsRegistry()
+    registry.record_cancelled(DecodeCancelled(queued=True))
+    registry.record_cancelled(DecodeCancelled())
+    registry.record_cancelled(DecodeCancelled())
+    stats = registry.stats()
+    assert (stats["dropped_queued"], stats["aborted_inflight"], stats["superseded_total"]) == (1, 2, 3)
+
+
+@pytest.mark.parametrize("speculative", [0, 3])
+def test_decoder_stops_when_superseded(speculative):
+    torch.manual_seed(0)
+    model = Transformer(inputVocab=14, outputVocab=12, input_embedding_dim=16, output_embedding_dim=16,
+                        num_heads=2, num_encoder_layers=1, num_decoder_layers=1, dropout_p=0.1, dim_feedforward=32)
+    registry = LatestWinsRegistry()
+    registry.register("client", 1)
+    should_abort = registry.abort_check("client", 1)
+
+    tokens = []
+
+    def on_token(step, token):
+        tokens.append(step)
+        if step == 2:
+            # the client sends a newer request while this one decodes
+            registry.register("client", 2)
+
+    with pytest.raises(DecodeCancelled) as error:
+        server.generate_with_transformer(model, torch.tensor([[3, 5, 7, 8]]), max_new_tokens=8, start_token=0,
+                                         decode_mode='greedy', should_abort=should_abort, on_token=on_token,
+                                         speculative=speculative)
+    assert not error.value.queued
+    assert tokens == [0, 1, 2]
+
+
+def test_budget_met_and_missed():
+    budget = LatencyBudget(max_workers=1)
+    assert budget.run(lambda: "model", lambda: "fast", 5.0) == "model"
+
+    release, cancel = threading.Event(), threading.Event()
+
+    def slow():
+        release.wait(5)
+        if cancel.is_set():
+            raise DecodeCancelled()
+        return "model"
+
+    assert budget.run(slow, lambda: "fast", 0.05, policy=CANCEL, cancel_event=cancel) == "fast"
+    assert cancel.is_set()
+    release.set()
+    budget.executor.shutdown(wait=True)
+    stats = budget.stats()
+    assert (stats["met"], stats["missed"], stats["background_cancelled"]) == (1, 1, 1)
+
+
+def test_pending_runs_capped():
+    budget = LatencyBudget(max_workers=1, max_pending=2)
+    release = threading.Event()
+    calls = []
+
+    def slow():
+        calls.append(1)
+        release.wait(5)
+        return "model"
+
+    # one run decoding and one queued behind it, both past their budget
+    assert budget.run(slow, lambda: "fast", 0.01) == "fast"
+    assert budget.run(slow, lambda: "fast", 0.01) == "fast"
+    # no more work is queued while both are pending
+    assert budget.run(slow, lambda: "fast", 5.0) == "fast"
+    assert budget.stats()["overloaded"] == 1
+
+    release.set()
+    deadline = time.monotonic() + 5
+    while budget.stats()["background_finished"] < 2 and time.monotonic() < deadline:
+        time.sleep(0.01)
+    assert len(calls) == 2
+    # finished runs free their places
+    assert budget.run(lambda: "model", lambda: "fast", 5.0) == "model"
@@ -0,0 +1,108 @@
+"""
+Speculative decoding keeps the output of token-by-token decoding: greedy decoding gives the same
+chords whatever the draft proposes, and a sampled token follows the distribution
+sample_next_token draws from, whether its drafted token was accepted or replaced.
+"""
+import os
+import sys
+
+import pytest
+import torch
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from decoding import (GREEDY, SpeculativeStats, TransitionDraft, repeat_last_draft, sample_next_token,
+                      speculative_decode, speculative_step, token_probabilities)
+from Model.Transformer import Transformer
+
+SOS = 0
+CHORDS = 12
+
+
+class FixedLogits:
+    """Decoder predicting the same next-token logits at every position"""
+
+    def __init__(self, logits):
+        self.logits = logits
+
+    def get_tgt_mask(self, size, device=None):
+        return None
+
+    def decode(self, tgt, memory, tgt_mask=None, memory_key_padding_mask=None):
+        return self.logits.expand(tgt.size(0), tgt.size(1), -1)
+
+
+def tiny_model(seed=0):
+    torch.manual_seed(seed)
+    return Transformer(inputVocab=14, outputVocab=CHORDS, input_embedding_dim=16, output_embedding_dim=16,
+                       num_heads=2, num_encoder_layers=1, num_decoder_layers=1, dropout_p=0.1,
+                       dim_feedforward=32).eval()
+
+
+def greedy_reference(model, memory, steps):
+    sequence = torch.tensor([[SOS]])
+    with torch.no_grad():
+        for _ in range(steps):
+            logits = model.decode(sequence, memory, model.get_tgt_mask(sequence.size(1)))
+            sequence = torch.cat([sequence, sample_next_token(logits[:, -1], decode_mode=GREEDY)], dim=1)
+    return sequence[0, 1:].tolist()
+
+
+@pytest.mark.parametrize("draft", [
+    repeat_last_draft,
+    lambda tokens, n: [3] * n,
+    TransitionDraft([(chord + 1) % CHORDS for chord in range(CHORDS)], first_chord=2, start_token=SOS),
+], ids=["repeat", "constant", "transition"])
+@pytest.mark.parametrize("draft_len", [1, 3, 8])
+def test_greedy_matches_token_by_token(draft, draft_len):
+    model = tiny_model()
+    src = torch.randint(0, 14, (1, 40), generator=torch.Generator().manual_seed(1))
+    with torch.no_grad():
+        memory = model.encode(src)
+        expected = greedy_reference(model, memory, 9)
+
+        stats = SpeculativeStats()
+        tokens = list(speculative_decode(model, torch.tensor([[SOS]]), memory, 9, draft, draft_len,
+                                         decode_mode=GREEDY, stats=stats))
+
+    assert torch.cat(tokens, dim=1)[0].tolist() == expected
+    assert stats.stats()['tokens'] == 9
+    assert stats.stats()['sequences'] == 1
+
+
+@pytest.mark.parametrize("drafted", [0, 2, 4])
+def test_sampled_token_keeps_distribution(drafted):
+    # token 4 is outside the top 4 and never accepted, its replacement still follows p
+    logits = torch.tensor([2.0, 1.0, 0.5, 0.0, -1.0])
+    probs = token_probabilities(logits, temperature=1.0, top_k=4)
+    model = FixedLogits(logits)
+    generator = torch.Generator().manual_seed(drafted)
+
+    samples = 6000
+    counts = torch.zeros(len(logits))
+    accepted = 0
+    for _ in range(samples):
+        tokens, n = speculative_step(model, torch.tensor([[SOS]]), None, [drafted], temperature=1.0, top_k=4,
+                                     generator=generator)
+        counts[int(tokens[0, 0])] += 1
+        accepted += n
+
+    assert torch.allclose(counts / samples, probs, atol=0.025)
+    # the drafted token is kept with its own probability
+    assert accepted / samples == pytest.approx(float(probs[drafted]), abs=0.025)
+
+
+def test_full_acceptance_adds_one_token():
+    logits = torch.tensor([0.0, 5.0, 0.0])
+    tokens, accepted = speculative_step(FixedLogits(logits), torch.tensor([[SOS]]), None, [1, 1, 1],
+                                        decode_mode=GREEDY)
+    assert accepted == 3
+    assert tokens[0].tolist() == [1, 1, 1, 1]
+
+
+def test_rejection_stops_at_first_mismatch():
+    logits = torch.tensor([0.0, 5.0, 0.0])
+    tokens, accepted = speculative_step(FixedLogits(logits), torch.tensor([[SOS]]), None, [1, 2, 1],
+                                        decode_mode=GREEDY)
+    assert accepted == 1
+    assert tokens[0].tolist() == [1, 1]
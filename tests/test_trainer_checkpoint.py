@@ -0,0 +1,90 @@
+"""
+Resuming from a periodic checkpoint continues training exactly: a run interrupted after an epoch
+and resumed ends with the same weights, optimizer state, losses and step count as an
+uninterrupted one (shuffling and dropout included, through the saved RNG state).
+"""
+import os
+import sys
+
+import pytest
+import torch
+from torch.optim.lr_scheduler import LambdaLR
+from torch.utils.data import DataLoader, TensorDataset
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from Model.Transformer import Transformer
+from Trainer.trainer import Trainer
+
+MODEL_KWARGS = dict(inputVocab=14, outputVocab=12, input_embedding_dim=16, output_embedding_dim=16, num_heads=2,
+                    num_encoder_layers=1, num_decoder_layers=1, dropout_p=0.1, dim_feedforward=32)
+
+
+def phrases(count=24, frames=16):
+    generator = torch.Generator().manual_seed(0)
+    inputs = torch.randint(2, 14, (count, frames), generator=generator)
+    inputs[:, -1] = 1
+    # SOS, two chords, EOS
+    targets = torch.cat([torch.zeros(count, 1, dtype=torch.long),
+                         torch.randint(3, 12, (count, frames // 8), generator=generator),
+                         torch.ones(count, 1, dtype=torch.long)], dim=1)
+    return TensorDataset(inputs, targets)
+
+
+def make_trainer(checkpoint_dir, model_kwargs=MODEL_KWARGS):
+    torch.manual_seed(0)
+    model = Transformer(**model_kwargs)
+    optimizer = torch.optim.Adam(model.parameters(), lr=1e-3)
+    trainer = Trainer(model, optimizer, torch.nn.CrossEntropyLoss(), DataLoader(phrases(), batch_size=8, shuffle=True),
+                      DataLoader(phrases(8), batch_size=8), torch.device("cpu"), scheduler=None, eval_every_epochs=2,
+                      checkpoint_dir=str(checkpoint_dir), checkpoint_every=1, keep_checkpoints=0)
+    trainer.scheduler = LambdaLR(optimizer, lr_lambda=lambda epoch: (epoch + 1) / 2 if epoch < 2 else 1.0)
+    return trainer
+
+
+def test_resumed_run_matches_uninterrupted(tmp_path):
+    uninterrupted = make_trainer(tmp_path / "uninterrupted")
+    uninterrupted.train(3)
+
+    interrupted = make_trainer(tmp_path / "resumed")
+    interrupted.train(1)
+    resumed = make_trainer(tmp_path / "resumed")
+    path = resumed.resume()
+    assert path.endswith("checkpoint_epoch_0001.pth")
+    assert (resumed.epoch, resumed.global_step) == (1, 3)
+    resumed.train(3)
+
+    assert (resumed.epoch, resumed.global_step) == (uninterrupted.epoch, uninterrupted.global_step) == (3, 9)
+    assert resumed.train_losses == uninterrupted.train_losses
+    assert resumed.test_losses == uninterrupted.test_losses
+    assert resumed.best_loss == uninterrupted.best_loss
+    assert resumed.scheduler.state_dict() == uninterrupted.scheduler.state_dict()
+    expected = uninterrupted.model.state_dict()
+    for name, tensor in resumed.model.state_dict().items():
+        assert torch.equal(tensor, expected[name]), name
+    expected_optimizer = uninterrupted.optimizer.state_dict()['state']
+    for index, state in resumed.optimizer.state_dict()['state'].items():
+        assert torch.equal(state['exp_avg'], expected_optimizer[index]['exp_avg'])
+
+
+def test_checkpoints_load_for_inference(tmp_path):
+    trainer = make_trainer(tmp_path)
+    trainer.train(1)
+    checkpoint = torch.load(trainer.checkpoints.latest(), weights_only=False)
+    kwargs, state, _ = checkpoint['model']
+    model = Transformer(**kwargs)
+    model.load_state_dict(state)
+    assert os.path.exists(trainer.checkpoints.best_path)
+
+
+def test_resume_without_checkpoint(tmp_path):
+    trainer = make_trainer(tmp_path)
+    assert trainer.resume() is None
+    assert trainer.epoch == 0
+
+
+def test_resume_with_other_model_arguments(tmp_path):
+    make_trainer(tmp_path).train(1)
+    other = make_trainer(tmp_path, dict(MODEL_KWARGS, dim_feedforward=64))
+    with pytest.raises(ValueError):
+        other.resume()